@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of file lookups by hash id: hash_id index against decode to primary key
+
+    Also times filling the table with and without storing the hash ids.
+    Run from the repository root: python benchmarks/bench_hashid_lookup.py [rows] [lookups]
+"""
+
+import os, sys, random, tempfile, time
+from datetime import datetime
+from sqlalchemy import create_engine, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sms.database import HashidCodec, File, Blob
+
+BATCH = 50000
+
+def populate(engine, codec: HashidCodec, rows: int, store_hash_id: bool) -> float:
+    """Create the files table and insert rows files, return the elapsed time"""
+    Blob.__table__.create(engine)
+    File.__table__.create(engine)
+    now = datetime.now()
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        for first in range(1, rows + 1, BATCH):
+            connection.execute(File.__table__.insert(), [
+                {"id": i, "hash_id": codec.encode(i) if store_hash_id else "", "created_time": now, "format": "pdf", "name": f"file{i}", "type": 0}
+                for i in range(first, min(first + BATCH, rows + 1))
+            ])
+    return time.perf_counter() - start
+
+def bench(engine, lookup, hash_ids) -> float:
+    """Return the time taken to look up every hash id"""
+    with engine.connect() as connection:
+        start = time.perf_counter()
+        for hash_id in hash_ids:
+            assert lookup(connection, hash_id) != None
+        return time.perf_counter() - start
+
+def report(name: str, elapsed: float, count: int) -> None:
+    print(f"{name:<32}{elapsed:>8.3f}s {elapsed / count * 1e6:>8.1f}us/row")
+
+def main(rows: int = 1000000, lookups: int = 100000) -> None:
+    codec = HashidCodec("benchmark")
+    files = File.__table__
+    hash_ids = [codec.encode(random.randint(1, rows)) for _ in range(lookups)]
+    with tempfile.TemporaryDirectory() as directory:
+        stored = create_engine("sqlite:///" + os.path.join(directory, "stored.db"))
+        unstored = create_engine("sqlite:///" + os.path.join(directory, "unstored.db"))
+        report("insert, hash_id stored", populate(stored, codec, rows, True), rows)
+        report("insert, hash_id not stored", populate(unstored, codec, rows, False), rows)
+
+        scan = bench(stored,
+            lambda connection, hash_id: connection.execute(select(files).where(files.c.hash_id == hash_id)).first(), hash_ids)
+        fetch = bench(unstored,
+            lambda connection, hash_id: connection.execute(select(files).where(files.c.id == codec.decode(hash_id))).first(), hash_ids)
+        decode = time.perf_counter()
+        for hash_id in hash_ids:
+            codec.decode(hash_id)
+        decode = time.perf_counter() - decode
+        report("lookup, hash_id index", scan, lookups)
+        report("lookup, decode + primary key", fetch, lookups)
+        report("  of which decode", decode, lookups)
+        stored.dispose()
+        unstored.dispose()
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
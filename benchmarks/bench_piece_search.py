@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of the full text search of pieces, see sms/database/search.py
+
+    Run from the repository root: python benchmarks/bench_piece_search.py [pieces] [searches]
+"""
+
+import os, sys, random, tempfile, time
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sms.database import Piece
+from sms.database.search import search_query
+
+WORDS = ["symphony", "sonata", "concerto", "suite", "dances", "overture", "requiem", "fantasia", "nocturne", "serenade"]
+COMPOSERS = ["Antonín Dvořák", "Bedřich Smetana", "Frédéric Chopin", "Gabriel Fauré", "Camille Saint-Saëns",
+    "Johannes Brahms", "Leoš Janáček", "Béla Bartók", "Edvard Grieg", "Zoltán Kodály"]
+QUERIES = ["dvor", "dvorak sym", "faure req", "chopin noc", "bart", "saint saens", "smetana dances", "grieg s"]
+
+def main(pieces: int = 100000, searches: int = 1000) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine("sqlite:///" + os.path.join(directory, "search.db"))
+        # Creates the index and its triggers too
+        Piece.__table__.create(engine)
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(Piece.__table__.insert(), [
+                {"id": i, "name": f"{random.choice(WORDS).title()} No. {i}", "author": random.choice(COMPOSERS),
+                    "arranger": random.choice(COMPOSERS) if i % 10 == 0 else None}
+                for i in range(1, pieces + 1)
+            ])
+        print(f"insert {pieces} pieces with the index {time.perf_counter() - start:>8.3f}s")
+        with engine.connect() as connection:
+            for text in QUERIES:
+                query = search_query(text, 20)
+                start = time.perf_counter()
+                for _ in range(searches // len(QUERIES)):
+                    rows = connection.execute(query).all()
+                elapsed = (time.perf_counter() - start) / (searches // len(QUERIES))
+                print(f"{text!r:<20}{len(rows):>4} results {elapsed * 1000:>8.2f}ms")
+        engine.dispose()
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of reads while uploads commit: default SQLite engine against the SQLITE_PRAGMAS profile
+
+    Writers insert files in transactions held open for a while, like the
+    commit of an upload, while readers look files up by id. The default
+    engine opens a connection per checkout with the rollback journal, the
+    profile reads through a read-only pool and writes through one WAL
+    connection, see sms/database/engine.py.
+    Run from the repository root: python benchmarks/bench_sqlite_profile.py [seconds] [readers] [writers]
+"""
+
+import os, sys, random, tempfile, threading, time
+from datetime import datetime
+from functools import partial
+from sqlalchemy import create_engine, select, exc
+from sqlalchemy.pool import QueuePool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sms.config import Config
+from sms.database import File, Blob
+from sms.database.engine import connect_sqlite
+
+ROWS = 10000
+# Seconds a write transaction stays open
+HOLD = 0.005
+
+def populate(engine) -> None:
+    Blob.__table__.create(engine)
+    File.__table__.create(engine)
+    now = datetime.now()
+    with engine.begin() as connection:
+        connection.execute(File.__table__.insert(), [
+            {"id": i, "hash_id": "", "created_time": now, "format": "pdf", "name": f"file{i}", "type": 0}
+            for i in range(1, ROWS + 1)
+        ])
+
+def run(reader, writer, seconds: float, readers: int, writers: int) -> dict:
+    files = File.__table__
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    stop = time.perf_counter() + seconds
+    def count(name):
+        with lock:
+            counts[name] += 1
+    def read():
+        while time.perf_counter() < stop:
+            try:
+                with reader.connect() as connection:
+                    connection.execute(select(files).where(files.c.id == random.randint(1, ROWS))).first()
+                count("reads")
+            except exc.OperationalError:
+                count("errors")
+    def write(number):
+        i = 0
+        while time.perf_counter() < stop:
+            i += 1
+            try:
+                with writer.begin() as connection:
+                    connection.execute(files.insert(), {"hash_id": "", "created_time": datetime.now(), "format": "pdf",
+                        "name": f"upload{number}_{i}", "type": 0})
+                    time.sleep(HOLD)
+                count("writes")
+            except (exc.OperationalError, exc.TimeoutError):
+                count("errors")
+    threads = [threading.Thread(target=read) for _ in range(readers)] + [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+def report(name: str, counts: dict, seconds: float) -> None:
+    print(f"{name:<10}{counts['reads'] / seconds:>10.0f} reads/s{counts['writes'] / seconds:>8.0f} writes/s{counts['errors']:>6} locked")
+
+def main(seconds: float = 5, readers: int = 8, writers: int = 2) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "default.db")
+        engine = create_engine("sqlite:///" + path, connect_args={"timeout": 1, "check_same_thread": False})
+        populate(engine)
+        report("default", run(engine, engine, seconds, readers, writers), seconds)
+        engine.dispose()
+
+        path = os.path.join(directory, "profile.db")
+        writer = create_engine("sqlite://", creator=partial(connect_sqlite, path, Config.SQLITE_PRAGMAS),
+            poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=Config.SQLITE_POOL_TIMEOUT)
+        populate(writer)
+        reader = create_engine("sqlite://", creator=partial(connect_sqlite, path, Config.SQLITE_PRAGMAS, True),
+            poolclass=QueuePool, pool_size=readers, max_overflow=0)
+        report("profile", run(reader, writer, seconds, readers, writers), seconds)
+        reader.dispose()
+        writer.dispose()
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -8,8 +8,10 @@ from werkzeug.utils import import_string
 import os, logging
 
 from .logger import init_logger
-from .database import db, create_everything
+from .database import db, create_everything, upgrade_everything
 from .interface import api, register_blueprints
+from .commands import register_commands
+from .utils import UploadRequest, enqueue_job, init_storage, init_file_index, init_thumbnailer, init_job_queue
 
 def create_app(mode="production") -> Flask:
     """Fatory function to initiallize the app
@@ -17,6 +19,8 @@ def create_app(mode="production") -> Flask:
     :param mode: development, testing or production(default)
     """
     app = Flask(__name__)
+    # Uploaded files are spooled into BLOBS_DIR while they are received
+    app.request_class = UploadRequest
 
     # Load configs
     if mode == "development":
@@ -38,16 +42,51 @@ def create_app(mode="production") -> Flask:
     api.init_app(app)
     register_blueprints()
 
+    # init commands
+    register_commands(app)
+
     # Check whether files folder exists
     if not os.path.isdir(app.config["FILES_DIR"]):
         logger.warning("No file folder is found")
         os.mkdir(app.config["FILES_DIR"])
         logger.info(f'Create new file folder at {app.config["FILES_DIR"]}')
 
+    # Check whether blobs folder exists
+    if not os.path.isdir(app.config["BLOBS_DIR"]):
+        os.mkdir(app.config["BLOBS_DIR"])
+        logger.info(f'Create new blob folder at {app.config["BLOBS_DIR"]}')
+
+    # Check whether trash folder exists
+    if not os.path.isdir(app.config["TRASH_DIR"]):
+        os.mkdir(app.config["TRASH_DIR"])
+        logger.info(f'Create new trash folder at {app.config["TRASH_DIR"]}')
+
+    # Pick the storage of the blob contents
+    init_storage(app)
+
+    # Start the workers rendering thumbnails
+    init_thumbnailer(app)
+
+    # Index the piece folders once, duplicate checks are lookups afterwards
+    init_file_index(app)
+
     # Check whether database exists
     if not os.path.exists(os.path.join("sms", app.config['DB_FILE'])) and not app.config['TESTING']:
         app.app_context().push()
         create_everything(db)
+    elif not app.config['TESTING']:
+        with app.app_context():
+            upgrade_everything(db)
+
+    # Start the workers running the jobs, tests run them in the request instead
+    queue = init_job_queue(app)
+    if app.config["JOB_WORKERS"] and not app.config["TESTING"]:
+        queue.start()
+    if app.config["SCRUB_INTERVAL"] and not app.config["TESTING"]:
+        with app.app_context():
+            # Kept if already scheduled by an earlier start
+            enqueue_job("scrub_storage", unique=True, delay=app.config["SCRUB_INTERVAL"])
+            db.session.commit()
 
     # Base Routes
     @app.get('/')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    Command line interface of the app, run with flask <group> <command>
+"""
+
+import json, click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .interface.schemas import PieceCreateSchema
+from .utils import shard_files, scrub_storage, CATALOG_FORMATS, read_catalog, import_catalog, get_job_queue
+
+files_cli = AppGroup("files", help="Manage the stored files")
+
+@files_cli.command("shard")
+@click.option("--workers", default=4, show_default=True, help="Number of piece folders moved in parallel")
+def shard_command(workers: int) -> None:
+    """Move piece folders of the flat layout to the sharded layout
+
+    Safe to run while the app is serving requests"""
+    moved = shard_files(current_app.config["FILES_DIR"], workers)
+    click.echo(f"Moved {moved} piece folders")
+
+@files_cli.command("scrub")
+@click.option("--workers", default=None, type=int, help="Number of blobs checked in parallel, defaults to SCRUB_WORKERS")
+@click.option("--rate", default=None, type=float, help="MiB read per second by all workers together, 0 for no limit, defaults to SCRUB_RATE")
+@click.option("--json", "as_json", is_flag=True, help="Print the whole report as json")
+def scrub_command(workers: int, rate: float, as_json: bool) -> None:
+    """Check stored contents and FILES_DIR against the database
+
+    Report missing, corrupt and orphaned blobs, and missing and orphaned
+    files and piece folders. Nothing is changed, exit with 1 if anything is found"""
+    config = current_app.config
+    report = scrub_storage(workers or config["SCRUB_WORKERS"], config["SCRUB_RATE"] if rate == None else rate * 1024 * 1024)
+    if as_json:
+        click.echo(json.dumps(report.to_dict(), indent=2, sort_keys=True))
+    else:
+        click.echo(f"Checked {report.checked_blobs} blobs, {report.checked_bytes} bytes")
+        for kind in report.KINDS:
+            for item in sorted(getattr(report, kind)):
+                click.echo(f"{kind.replace('_', ' ')[:-1]}: {item}")
+    if not report.ok:
+        raise SystemExit(1)
+
+pieces_cli = AppGroup("pieces", help="Manage the pieces")
+
+@pieces_cli.command("import")
+@click.argument("catalog", type=click.File("r", encoding="utf-8", lazy=False))
+@click.option("--format", "format", type=click.Choice(CATALOG_FORMATS), default=None, help="Format of the catalog, guessed from the extension by default")
+@click.option("--chunk-size", default=None, type=int, help="Pieces inserted per transaction, defaults to IMPORT_CHUNK_SIZE")
+@click.option("--workers", default=None, type=int, help="Number of piece folders created in parallel, defaults to IMPORT_WORKERS")
+def import_command(catalog, format: str, chunk_size: int, workers: int) -> None:
+    """Import a catalog of pieces from a CSV or NDJSON file, - for stdin
+
+    Rows which can not be imported are skipped and printed with their line,
+    exit with 1 if there is any"""
+    format = format or ("csv" if catalog.name.lower().endswith(".csv") else "ndjson")
+    progress = lambda report: click.echo(f"{report.rows} rows read, {report.imported} pieces imported", err=True)
+    report = import_catalog(read_catalog(catalog, format), PieceCreateSchema(), chunk_size, workers, progress)
+    for line, messages in report.errors:
+        click.echo(f"line {line}: {json.dumps(messages)}")
+    click.echo(f"Imported {report.imported} of {report.rows} pieces")
+    if report.errors:
+        raise SystemExit(1)
+
+jobs_cli = AppGroup("jobs", help="Manage the background jobs")
+
+@jobs_cli.command("run")
+@click.option("--workers", default=None, type=click.IntRange(min=1), help="Number of worker threads, defaults to JOB_WORKERS")
+def run_command(workers: int) -> None:
+    """Run the job workers until interrupted
+
+    Runs the jobs in a process of its own, next to servers which do not
+    run enough workers themselves"""
+    queue = get_job_queue()
+    queue.workers = workers or current_app.config["JOB_WORKERS"] or 1
+    queue.start()
+    click.echo(f"Running {queue.workers} job workers", err=True)
+    try:
+        queue.join()
+    except KeyboardInterrupt:
+        queue.stop()
+
+def register_commands(app) -> None:
+    """Register all commands"""
+    app.cli.add_command(files_cli)
+    app.cli.add_command(pieces_cli)
+    app.cli.add_command(jobs_cli)
@@ -13,8 +13,80 @@ class Config(object):
     BACKUPCOUNT = 1
     # DB
     DB_FILE = "data.db"
+    # Pragmas run on every connection to the database, None for the defaults of SQLite
+    SQLITE_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        # Negative sizes are in KiB
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+        # Off, upgrade_everything rebuilds tables with DROP TABLE, which would fail on the rows
+        # pointing to them, and older databases may still hold rows of deleted pieces
+        "foreign_keys": "off"
+    }
+    # Connections of the read-only pool, 0 to read through the single writer connection too
+    SQLITE_READERS = 8
+    # Seconds to wait for a free connection of a pool
+    SQLITE_POOL_TIMEOUT = 30
     # FILE
     FILES_DIR = "files"
+    # Content addressed storage, files in FILES_DIR are links into it
+    BLOBS_DIR = "blobs"
+    # Where the contents of blobs are stored: "filesystem" in BLOBS_DIR or "s3".
+    # FILES_DIR is only kept as a mirror of links with the filesystem backend
+    STORAGE_BACKEND = "filesystem"
+    S3_BUCKET = None
+    S3_PREFIX = ""
+    # None for AWS, the url of the store for other S3 compatible ones
+    S3_ENDPOINT_URL = None
+    # Larger uploads are sent in parts of this size, at least 5 MiB
+    S3_PART_SIZE = 8 * 1024 * 1024
+    # Blobs of files of these formats are stored gzip compressed, clients
+    # accepting gzip get the compressed content as is
+    COMPRESSED_FORMATS = {"xml", "musicxml", "mei", "mid", "midi", "txt", "abc", "ly", "krn", "json", "svg"}
+    COMPRESSION_LEVEL = 6
+    # Store the hash id of files in the database, lookups decode it to the id either way
+    STORE_HASH_ID = True
+    # Marks around the matched words in the snippets of search results
+    SEARCH_HIGHLIGHT = ("<mark>", "</mark>")
+    # Lists are returned page by page: rows of a page without a limit, largest limit
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # Rows the export reads from the database at a time
+    EXPORT_BATCH_SIZE = 500
+    # Deleted piece folders are moved here until a job removes them
+    TRASH_DIR = "trash"
+    # Seconds deleted pieces and files can be restored from the trash, and
+    # files and blobs removed per second when it is purged (0 for no limit)
+    TRASH_RETENTION = 3600
+    TRASH_PURGE_RATE = 200
+    # Job queue: worker threads, seconds between polls of the jobs table,
+    # seconds before a running job is considered dead, first retry delay
+    JOB_WORKERS = 2
+    JOB_POLL_INTERVAL = 5
+    JOB_TIMEOUT = 600
+    JOB_RETRY_DELAY = 10
+    JOB_MAX_ATTEMPTS = 3
+    # Resumable uploads: size of the chunks, seconds without a chunk before a session is removed
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    UPLOAD_EXPIRY = 24 * 3600
+    # Integrity scrubber: checksum threads, bytes read per second by all of
+    # them together (0 for no limit), seconds between scheduled scrubs (0 for none)
+    SCRUB_WORKERS = 4
+    SCRUB_RATE = 32 * 1024 * 1024
+    SCRUB_INTERVAL = 7 * 24 * 3600
+    # Catalog imports: pieces inserted per transaction, threads creating their folders
+    IMPORT_CHUNK_SIZE = 500
+    IMPORT_WORKERS = 4
+    # Workers rendering thumbnails and previews, 0 renders them in the request
+    THUMBNAIL_WORKERS = 2
+    # Renderings stored next to the blobs, least recently used ones are removed beyond this size
+    THUMBNAIL_CACHE_SIZE = 256 * 1024 * 1024
+    # Let the front proxy send files: None, "x-sendfile" or "x-accel-redirect"
+    SENDFILE_MODE = None
+    # Internal location of FILES_DIR in the proxy, used by "x-accel-redirect"
+    X_ACCEL_REDIRECT_PREFIX = "/protected/files/"
 
     # Flask configs
     DEBUG = False
@@ -52,6 +124,10 @@ class TestingConfig(Config):
     LOG_FILE = "sms_test.log"
     DB_FILE = "test.db"
     FILES_DIR = "test_files"
+    BLOBS_DIR = "test_blobs"
+    TRASH_DIR = "test_trash"
+    THUMBNAIL_WORKERS = 0
+    JOB_WORKERS = 0
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -4,7 +4,11 @@
 """
 
 from .model import db
-from .setup import create_everything
+from .codec import HashidCodec, get_hashid_codec
+from .search import create_search_index, search_pieces
+from .versions import get_version
+from .setlist import ORDER_GAP, OrderConflict, renumber_event, place_event_piece, check_order
+from .setup import create_everything, upgrade_everything
 from .model import (
     Group,
     Part,
@@ -14,5 +18,9 @@ from .model import (
     Piece,
     Instrumentation,
     File,
-    Transpose
+    Transpose,
+    Blob,
+    Job,
+    UploadSession,
+    Trash
 )
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+    Hash id codec, translating between file ids and the hash ids exposed by the api
+"""
+
+from typing import Optional
+from flask import current_app
+from hashids import Hashids
+
+class HashidCodec(object):
+    """Encode ids to hash ids and decode them back
+
+    Building Hashids shuffles its alphabets with the salt, so one codec is
+    built per app and shared, see get_hashid_codec.
+    """
+    def __init__(self, salt: str) -> None:
+        self._hashids = Hashids(salt)
+
+    def encode(self, id: int) -> str:
+        return self._hashids.encode(id)
+
+    def decode(self, hash_id: str) -> Optional[int]:
+        """Return the id encoded in hash_id, None if it is not a valid hash id"""
+        # Hashids only decodes the canonical encoding of the ids
+        ids = self._hashids.decode(hash_id)
+        if len(ids) != 1:
+            return None
+        return ids[0]
+
+def get_hashid_codec() -> HashidCodec:
+    """Return the codec of the current app, built with SECRET_KEY on first use"""
+    codec = current_app.extensions.get("hashid_codec")
+    if codec is None:
+        codec = current_app.extensions.setdefault("hashid_codec", HashidCodec(current_app.config["SECRET_KEY"]))
+    return codec
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    SQLite engine profile: pragmas on every connection, a read-only pool and a single writer connection
+"""
+
+import sqlite3
+from functools import partial
+from typing import Dict
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+def connect_sqlite(path: str, pragmas: Dict, read_only: bool = False) -> sqlite3.Connection:
+    """Open a connection to the database file and run the pragmas on it
+
+    Connections are pooled, so they may be used by another thread than
+    the one which opened them, but never by two at a time.
+
+    :param pragmas: name to value, like {"journal_mode": "wal"}
+    :param read_only: refuse any write on the connection
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    for name, value in pragmas.items():
+        connection.execute(f"PRAGMA {name} = {value}")
+    if read_only:
+        connection.execute("PRAGMA query_only = ON")
+    return connection
+
+class RoutingSession(SignallingSession):
+    """Session reading through the read-only pool until it writes
+
+    Selects go to the readers. Anything else, and every statement after
+    the first write of a transaction, go to the writer, so a transaction
+    always reads what it wrote."""
+    def __init__(self, db, **options) -> None:
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self.info.get("writing") and isinstance(clause, Select):
+            reader = self._db.get_reader_engine(self.app)
+            if reader != None:
+                return reader
+        self.info["writing"] = True
+        return super().get_bind(mapper, clause)
+
+def _end_writing(session, *args) -> None:
+    session.info.pop("writing", None)
+
+event.listen(RoutingSession, "after_commit", _end_writing)
+event.listen(RoutingSession, "after_rollback", _end_writing)
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension opening file SQLite databases with the SQLITE_PRAGMAS profile
+
+    With SQLITE_READERS, sessions read through a pool of that many read-only
+    connections and write through a single connection. SQLite lets one
+    writer at a time in anyway, waiting on the pool is cheaper than busy
+    loops on locks, and with WAL readers are never stalled by the writer."""
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app: Flask, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        pragmas = app.config.get("SQLITE_PRAGMAS")
+        if sa_url.drivername == "sqlite" and sa_url.database not in (None, "", ":memory:") and pragmas != None:
+            options["creator"] = partial(connect_sqlite, sa_url.database, pragmas)
+            options["poolclass"] = QueuePool
+            options["pool_size"] = 1
+            options["max_overflow"] = 0
+            options["pool_timeout"] = app.config["SQLITE_POOL_TIMEOUT"]
+        return sa_url, options
+
+    def get_reader_engine(self, app: Flask) -> Engine:
+        """Return the engine of the read-only pool of the app, None if reads go to the writer"""
+        if "sqlite_reader" in app.extensions:
+            return app.extensions["sqlite_reader"]
+        writer = self.get_engine(app)
+        with self._engine_lock:
+            if "sqlite_reader" not in app.extensions:
+                reader = None
+                if app.config.get("SQLITE_READERS") and app.config.get("SQLITE_PRAGMAS") != None \
+                        and writer.url.drivername == "sqlite" and writer.url.database not in (None, "", ":memory:"):
+                    reader = create_engine(writer.url, poolclass=QueuePool, pool_size=app.config["SQLITE_READERS"], max_overflow=0,
+                        pool_timeout=app.config["SQLITE_POOL_TIMEOUT"],
+                        creator=partial(connect_sqlite, writer.url.database, app.config["SQLITE_PRAGMAS"], True))
+                app.extensions["sqlite_reader"] = reader
+        return app.extensions["sqlite_reader"]
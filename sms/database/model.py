@@ -3,32 +3,39 @@
     SqlAlchemy models for database
 """
 
-from flask_sqlalchemy import SQLAlchemy
 from flask import current_app
-from sqlalchemy import event
+from sqlalchemy import event, bindparam
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from datetime import datetime
-from hashids import Hashids
 
-db = SQLAlchemy()
+from .codec import get_hashid_codec
+from .engine import ProfiledSQLAlchemy
+
+db = ProfiledSQLAlchemy()
 
 # Models
 # Middle Tables
 # Groups & Pieces
 groups_pieces = db.Table('groupsPieces',
     db.Column('group_id', db.Integer, db.ForeignKey('groups.id'), primary_key=True, nullable=False),
-    db.Column('piece_id', db.Integer, db.ForeignKey('pieces.id'), primary_key=True, nullable=False)
+    db.Column('piece_id', db.Integer, db.ForeignKey('pieces.id'), primary_key=True, nullable=False),
+    # The primary key only serves lookups by group, this one covers the groups of a piece
+    db.Index('ix_groupsPieces_piece_id', 'piece_id', 'group_id')
 )
 
 # Groups & Events
 groups_events = db.Table('groupsEvents',
     db.Column('group_id', db.Integer, db.ForeignKey('groups.id'), primary_key=True, nullable=False),
-    db.Column('event_id', db.Integer, db.ForeignKey('events.id'), primary_key=True, nullable=False)
+    db.Column('event_id', db.Integer, db.ForeignKey('events.id'), primary_key=True, nullable=False),
+    db.Index('ix_groupsEvents_event_id', 'event_id', 'group_id')
 )
 
 # Instrumentations & Files
 instrumentations_files = db.Table('instrumentationsFiles',
     db.Column('instrumentation_id', db.Integer, db.ForeignKey('instrumentations.id'), primary_key=True),
-    db.Column('file_id', db.Integer, db.ForeignKey('files.id'), primary_key=True, nullable=False)
+    db.Column('file_id', db.Integer, db.ForeignKey('files.id'), primary_key=True, nullable=False),
+    db.Index('ix_instrumentationsFiles_file_id', 'file_id', 'instrumentation_id')
 )
 
 # Tables
@@ -70,7 +77,7 @@ class Part(db.Model):
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
     name = db.Column(db.Text, nullable=False)
     # Foreign Keys
-    group_id = db.Column(db.Integer, db.ForeignKey('groups.id'), nullable=False)
+    group_id = db.Column(db.Integer, db.ForeignKey('groups.id'), index=True, nullable=False)
     # Relationships
     instruments = db.relationship("Instrument", backref="part", lazy=True)
     
@@ -95,7 +102,7 @@ class Instrument(db.Model):
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
     name = db.Column(db.Text, nullable=False)
     # Foreign Keys
-    part_id = db.Column(db.Integer, db.ForeignKey("parts.id"), nullable=False)
+    part_id = db.Column(db.Integer, db.ForeignKey("parts.id"), index=True, nullable=False)
     # Relationships
     instrumentations = db.relationship('Instrumentation', backref="instrument", lazy=True)
     transposes = db.relationship('Transpose', backref="instrument", lazy=True)
@@ -118,9 +125,10 @@ class Event(db.Model):
     __tablename__ = "events"
     # Columns
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
-    name = db.Column(db.Text, nullable=False)
+    name = db.Column(db.Text, index=True, nullable=False)
     # Relationships
-    events_pieces = db.relationship("EventPiece", backref="event", lazy=True)
+    # In setlist order
+    events_pieces = db.relationship("EventPiece", backref="event", lazy=True, order_by="[EventPiece.order, EventPiece.id]")
     # groups_events many-to-many
 
     def __repr__(self) -> str:
@@ -149,14 +157,15 @@ class Piece(db.Model):
     __tablename__ = "pieces"
     # Columns
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
-    name = db.Column(db.Text, nullable=False)
-    author = db.Column(db.Text)
-    lyricist = db.Column(db.Text)
-    arranger = db.Column(db.Text)
-    opus = db.Column(db.Integer)
-    type = db.Column(db.Integer, default=0)
-    copyright_expire_date = db.Column(db.Date)
-    created_time = db.Column(db.DateTime, default=datetime.now())
+    # Every column pieces can be filtered by is indexed
+    name = db.Column(db.Text, index=True, nullable=False)
+    author = db.Column(db.Text, index=True)
+    lyricist = db.Column(db.Text, index=True)
+    arranger = db.Column(db.Text, index=True)
+    opus = db.Column(db.Integer, index=True)
+    type = db.Column(db.Integer, index=True, default=0)
+    copyright_expire_date = db.Column(db.Date, index=True)
+    created_time = db.Column(db.DateTime, index=True, default=datetime.now())
     # Relationships
     # groups_pieces many-to-many
     instrumentations = db.relationship("Instrumentation", backref="piece", lazy=True)
@@ -181,7 +190,7 @@ class EventPiece(db.Model):
     """Model class for the middle table of Events & Pieces
 
     :column id: Primary Key
-    :column order: Order of the piece in an event
+    :column order: Order of the piece in an event, entries placed by place_event_piece leave gaps between them
     :relationship events: Relationship with events, one-to-many, many end
     :relationship pieces: Relationship with pieces, one-to-many, many end
     """
@@ -190,8 +199,8 @@ class EventPiece(db.Model):
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
     order = db.Column(db.Integer, nullable=False)
     # Foreign Keys
-    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
-    piece_id = db.Column(db.Integer, db.ForeignKey('pieces.id'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), index=True, nullable=False)
+    piece_id = db.Column(db.Integer, db.ForeignKey('pieces.id'), index=True, nullable=False)
     # Relationships
     # events_events_pieces, one-to-many, many end
     # events_events_pieces, one-to-many, many end
@@ -215,8 +224,8 @@ class Instrumentation(db.Model):
     # Columns
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
     # Foreign Keys
-    piece_id = db.Column(db.Integer, db.ForeignKey('pieces.id'), nullable=False)
-    instrument_id = db.Column(db.Integer, db.ForeignKey('instruments.id'), nullable=False)
+    piece_id = db.Column(db.Integer, db.ForeignKey('pieces.id'), index=True, nullable=False)
+    instrument_id = db.Column(db.Integer, db.ForeignKey('instruments.id'), index=True, nullable=False)
     # Relationships
     files = db.relationship("File", secondary=instrumentations_files, lazy="subquery", backref=db.backref("instrumentations", lazy=True))
 
@@ -226,31 +235,70 @@ class Instrumentation(db.Model):
             "id": self.id
         })
 
+class Blob(db.Model):
+    """Model class for blobs, the content addressed storage of file contents
+
+    :column id: Primary Key
+    :column sha256: sha256 hex digest of the content
+    :column size: size of the content in bytes
+    :column encoding: content coding the content is stored with, like "gzip", None if stored as is
+    :column ref_count: number of files referencing the blob
+    :column created_time: created time of the blob
+    :relationship files: Relationship with files, one-to-many, one end
+    """
+    __tablename__ = "blobs"
+    # Columns
+    id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
+    sha256 = db.Column(db.Text, index=True, unique=True, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    encoding = db.Column(db.Text)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_time = db.Column(db.DateTime, default=datetime.now)
+    # Relationships
+    files = db.relationship("File", backref="blob", lazy=True)
+    # Only the unreferenced blobs purge_blobs looks for are indexed
+    __table_args__ = (db.Index("ix_blobs_unreferenced", "id", sqlite_where=ref_count <= 0),)
+
+    def __repr__(self) -> str:
+        return str({
+            "Table": "blobs",
+            "id": self.id,
+            "sha256": self.sha256,
+            "size": self.size,
+            "ref_count": self.ref_count
+        })
+
 class File(db.Model):
     """Model class for files
 
     :column id: Primary Key
-    :column hash_id: hash id for the file, generated with respect to id
+    :column hash_id: hash id for the file, generated with respect to id. Only stored if STORE_HASH_ID, lookups decode it to the id
     :column created_time: created time of the file
     :column format: file format (extention) of the file
     :column filename: file system storeage name of the file, often consisted by almost all attributes of File
     :column name: display name of the file, often consisted by instrument name+voice. e.g. Violin 1/Violin 2
     :column type: type of the file. e.g. original/revised
+    :column blob_id: Foreign Key, id of the blob holding the content
     :relationship transpose: Relationship with tranposes, one-to-one, nullable
     :relationship instrumentations: Relationship with instrumentations, many-to-many
     """
     __tablename__ = "files"
     # Columns
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
-    hash_id = db.Column(db.Text, index=True, default="", nullable=False)
+    hash_id = db.Column(db.Text, default="", nullable=False)
     created_time = db.Column(db.DateTime, default=datetime.now())
-    format = db.Column(db.Text)
-    name = db.Column(db.String, nullable=False)
-    type = db.Column(db.Integer, default=0)
+    # Every column files can be filtered by is indexed
+    format = db.Column(db.Text, index=True)
+    name = db.Column(db.String, index=True, nullable=False)
+    type = db.Column(db.Integer, index=True, default=0)
     # Foreign Keys
+    blob_id = db.Column(db.Integer, db.ForeignKey('blobs.id'), index=True)
     # Relationships
     # instrumentations_files many-to-many
+    # blob, one-to-many, many end
     transpose = db.relationship("Transpose", backref="file", lazy=True, uselist=False)
+    # Ids of deleted files are never taken again, their hash ids and the trash keep pointing at them
+    __table_args__ = {"sqlite_autoincrement": True}
 
     def __repr__(self) -> str:
         return str({
@@ -274,8 +322,9 @@ class Transpose(db.Model):
     # Columns
     id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
     # Foreign Keys
-    file_id = db.Column(db.Integer, db.ForeignKey('files.id'))
-    instrument_id = db.Column(db.Integer, db.ForeignKey('instruments.id'))
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'), index=True)
+    instrument_id = db.Column(db.Integer, db.ForeignKey('instruments.id'), index=True)
+    __table_args__ = {"sqlite_autoincrement": True}
 
     def __repr__(self) -> str:
         return str({
@@ -283,13 +332,162 @@ class Transpose(db.Model):
             "id": self.id
         })
 
+class Job(db.Model):
+    """Model class for jobs, the durable queue of work done outside of requests
+
+    :column id: Primary Key
+    :column name: name of the job handler
+    :column payload: json encoded keyword arguments of the handler
+    :column status: pending, running, done or failed
+    :column attempts: number of times the job has been started
+    :column max_attempts: number of attempts before the job is failed
+    :column error: error of the last failed attempt
+    :column result: json encoded return value of the handler, if any
+    :column run_after: the job is not started before this time, used to back off retries
+    :column locked_until: lease of a running job, expired if the worker died
+    :column created_time: created time of the job
+    :column finished_time: time the job was done or failed
+    """
+    __tablename__ = "jobs"
+    # Columns
+    id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
+    # Lists filter by name and status, enqueue_job looks unique jobs up by name, payload and status
+    name = db.Column(db.Text, index=True, nullable=False)
+    payload = db.Column(db.Text, default="{}", nullable=False)
+    status = db.Column(db.Text, index=True, default="pending", nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=3, nullable=False)
+    error = db.Column(db.Text)
+    result = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    locked_until = db.Column(db.DateTime)
+    created_time = db.Column(db.DateTime, default=datetime.now)
+    finished_time = db.Column(db.DateTime)
+
+    def __repr__(self) -> str:
+        return str({
+            "Table": "jobs",
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "attempts": self.attempts
+        })
+
+class UploadSession(db.Model):
+    """Model class for resumable upload sessions, the content is staged chunk by chunk
+
+    :column id: Primary Key
+    :column token: random public id of the session
+    :column filename: name of the uploaded file
+    :column format: file format (extention) of the file
+    :column data: json encoded data of the File to create, as in a multipart upload
+    :column size: size of the whole content in bytes
+    :column chunk_size: size of every chunk but the last one
+    :column received: number of bytes received from the start, the offset to resume from
+    :column status: open, or done once the File is created
+    :column file_id: id of the created File
+    :column created_time: created time of the session
+    :column updated_time: time of the last received chunk
+    :relationship file: Relationship with the created file, many-to-one, nullable
+    """
+    __tablename__ = "upload_sessions"
+    # Columns
+    id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
+    token = db.Column(db.Text, index=True, unique=True, nullable=False)
+    filename = db.Column(db.Text, nullable=False)
+    format = db.Column(db.Text)
+    data = db.Column(db.Text, default="{}", nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Integer, default=0, nullable=False)
+    status = db.Column(db.Text, default="open", nullable=False)
+    created_time = db.Column(db.DateTime, default=datetime.now)
+    updated_time = db.Column(db.DateTime, default=datetime.now)
+    # Foreign Keys
+    file_id = db.Column(db.Integer, db.ForeignKey('files.id'))
+    # Relationships
+    file = db.relationship("File", lazy=True)
+
+    def __repr__(self) -> str:
+        return str({
+            "Table": "upload_sessions",
+            "id": self.id,
+            "token": self.token,
+            "size": self.size,
+            "received": self.received,
+            "status": self.status
+        })
+
+class Trash(db.Model):
+    """Model class for the trash, deleted pieces and files kept for a while to be restored
+
+    Blobs of the deleted files are referenced by the trash until it is purged.
+
+    :column id: Primary Key
+    :column kind: piece or file
+    :column item_id: id of the deleted piece or file
+    :column name: name of the deleted piece or file
+    :column rows: json encoded rows deleted from each table, restored as they were
+    :column folder: folder of the piece moved into TRASH_DIR, None if there is none
+    :column created_time: time of the deletion
+    :column purge_after: the trash is purged after this time and can not be restored anymore
+    """
+    __tablename__ = "trash"
+    # Columns
+    id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False, autoincrement=True)
+    kind = db.Column(db.Text, index=True, nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.Text, nullable=False)
+    rows = db.Column(db.Text, default="[]", nullable=False)
+    folder = db.Column(db.Text)
+    created_time = db.Column(db.DateTime, default=datetime.now)
+    purge_after = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self) -> str:
+        return str({
+            "Table": "trash",
+            "id": self.id,
+            "kind": self.kind,
+            "item_id": self.item_id,
+            "name": self.name
+        })
+
 # Hooks
-@event.listens_for(File, 'after_insert')
-def add_hash(mapper, connection, target):
-    file_table = mapper.local_table
-    hashid = Hashids(current_app.config["SECRET_KEY"])
-    connection.execute(
+@event.listens_for(Session, 'after_flush')
+def add_hashes(session, flush_context):
+    """Store the hash ids of the files inserted by the flush, a single UPDATE for all of them"""
+    files = [file for file in session.new if isinstance(file, File) and not file.hash_id]
+    if not files or not current_app.config["STORE_HASH_ID"]:
+        return
+    codec = get_hashid_codec()
+    file_table = File.__table__
+    hashes = [(file, codec.encode(file.id)) for file in files]
+    session.connection().execute(
         file_table.update().
-            values(hash_id=hashid.encode(target.id)).
-            where(file_table.c.id==target.id)
+            values(hash_id=bindparam("new_hash_id")).
+            where(file_table.c.id==bindparam("file_id")),
+        [{"file_id": file.id, "new_hash_id": hash_id} for file, hash_id in hashes]
+    )
+    for file, hash_id in hashes:
+        set_committed_value(file, "hash_id", hash_id)
+
+def _add_blob_ref(connection, blob_id: int, count: int) -> None:
+    blob_table = Blob.__table__
+    connection.execute(
+        blob_table.update().
+            values(ref_count=blob_table.c.ref_count + count).
+            where(blob_table.c.id==blob_id)
     )
+
+# References to the blobs files point at are taken by store_blob
+@event.listens_for(File, 'after_update')
+def move_blob(mapper, connection, target):
+    history = get_history(target, "blob_id")
+    for blob_id in history.deleted:
+        if blob_id is not None:
+            _add_blob_ref(connection, blob_id, -1)
+
+@event.listens_for(File, 'after_delete')
+def release_blob(mapper, connection, target):
+    if target.blob_id is not None:
+        _add_blob_ref(connection, target.blob_id, -1)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    Full text index of the pieces, an SQLite FTS5 table kept in sync by triggers
+"""
+
+import re
+from typing import List, Optional
+from sqlalchemy import event, func, select, table, column, literal_column
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.sql import Select
+
+from .model import db, Piece
+
+# Indexed columns of pieces and their bm25 weights, a match in the name counts most
+SEARCH_COLUMNS = ("name", "author", "lyricist", "arranger")
+SEARCH_WEIGHTS = (10.0, 4.0, 2.0, 2.0)
+
+pieces_fts = table("pieces_fts", column("rowid"), *(column(name) for name in SEARCH_COLUMNS))
+
+def _search_ddl() -> List[str]:
+    columns = ", ".join(SEARCH_COLUMNS)
+    new = ", ".join(f"new.{name}" for name in SEARCH_COLUMNS)
+    old = ", ".join(f"old.{name}" for name in SEARCH_COLUMNS)
+    # Deleting from an external content index needs the indexed values
+    delete = f"INSERT INTO pieces_fts(pieces_fts, rowid, {columns}) VALUES ('delete', old.id, {old});"
+    insert = f"INSERT INTO pieces_fts(rowid, {columns}) VALUES (new.id, {new});"
+    return [
+        # Accents are folded away in the index and in queries, prefixes of 2 to 4 characters are indexed
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS pieces_fts USING fts5({columns}, content='pieces', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')",
+        f"CREATE TRIGGER IF NOT EXISTS pieces_fts_insert AFTER INSERT ON pieces BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS pieces_fts_delete AFTER DELETE ON pieces BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS pieces_fts_update AFTER UPDATE ON pieces BEGIN {delete} {insert} END"
+    ]
+
+def create_search_index(connection: Connection) -> None:
+    """Create the full text index of the pieces with its triggers and fill it with the existing pieces"""
+    if connection.dialect.name != "sqlite":
+        return
+    for statement in _search_ddl():
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("INSERT INTO pieces_fts(pieces_fts) VALUES ('rebuild')")
+
+def drop_search_index(connection: Connection) -> None:
+    """Drop the full text index, its triggers go with the pieces table"""
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("DROP TABLE IF EXISTS pieces_fts")
+
+event.listen(Piece.__table__, "after_create", lambda target, connection, **kwargs: create_search_index(connection))
+event.listen(Piece.__table__, "before_drop", lambda target, connection, **kwargs: drop_search_index(connection))
+
+def to_match(text: str) -> str:
+    """Turn the words of a user query into an FTS5 query matching pieces with all of them as prefixes
+
+    Operators and quotes of the FTS5 syntax are not passed through, so any
+    text is a valid query. Return "" if there is no word"""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+def search_query(text: str, limit: int, start: str = "<mark>", end: str = "</mark>") -> Optional[Select]:
+    """Return the query of the rowid, the bm25 rank and a snippet of the pieces matching the text, best first
+
+    Ranks are negative, lower is better. The matched words of the snippet
+    are put between start and end. None if the text has no word"""
+    match = to_match(text)
+    if not match:
+        return None
+    fts = literal_column("pieces_fts")
+    return select(
+        pieces_fts.c.rowid,
+        func.bm25(fts, *SEARCH_WEIGHTS).label("rank"),
+        func.snippet(fts, -1, start, end, "…", 12).label("snippet")
+    ).where(fts.op("MATCH")(match)).order_by(literal_column("rank")).limit(limit)
+
+def search_pieces(text: str, limit: int, start: str = "<mark>", end: str = "</mark>") -> List[Row]:
+    """Run search_query in the session"""
+    query = search_query(text, limit, start, end)
+    if query == None:
+        return []
+    return db.session.execute(query).all()
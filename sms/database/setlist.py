@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    Gap based order of the pieces of events, so that an edit of a setlist only writes the entry it edits
+"""
+
+from typing import Optional
+from sqlalchemy import bindparam
+
+from .model import db, EventPiece
+
+# Distance between the orders of consecutive entries, the number of entries
+# which can be put between two of them before the event is renumbered is its log2
+ORDER_GAP = 1024
+
+class OrderConflict(Exception):
+    """A concurrent edit of the setlist took the order an entry was given"""
+
+def renumber_event(event_id: int) -> None:
+    """Spread the orders of the entries of the event ORDER_GAP apart, keeping their order
+
+    The entries are updated with a single executemany, the ones loaded in
+    the session read their order again"""
+    table = EventPiece.__table__
+    with db.session.no_autoflush:
+        ids = [id for id, in db.session.query(EventPiece.id).filter_by(event_id=event_id).order_by(EventPiece.order, EventPiece.id)]
+        db.session.execute(table.update().where(table.c.id == bindparam("entry_id")).values(order=bindparam("entry_order")),
+            [{"entry_id": id, "entry_order": i * ORDER_GAP} for i, id in enumerate(ids, 1)])
+    for entry in list(db.session.identity_map.values()):
+        if isinstance(entry, EventPiece) and entry.event_id == event_id:
+            db.session.expire(entry, ["order"])
+
+def place_event_piece(entry: EventPiece, after: Optional[EventPiece] = None, before: Optional[EventPiece] = None) -> None:
+    """Give the entry the order placing it right after an entry, right before one, or last if neither is given
+
+    The order is picked between the ones of the neighbours, only the entry
+    is written unless there is no room left between them and the event is
+    renumbered first.
+
+    :param entry: new or existing entry of the event, its event_id is set
+    :param after: entry of the same event to place it after
+    :param before: entry of the same event to place it before
+    """
+    with db.session.no_autoflush:
+        others = db.session.query(EventPiece.order).filter(EventPiece.event_id == entry.event_id)
+        if entry.id != None:
+            others = others.filter(EventPiece.id != entry.id)
+        if after != None:
+            low = after.order
+            high = others.filter(EventPiece.order > low).order_by(EventPiece.order).limit(1).scalar()
+        elif before != None:
+            high = before.order
+            low = others.filter(EventPiece.order < high).order_by(EventPiece.order.desc()).limit(1).scalar()
+        else:
+            low = others.order_by(EventPiece.order.desc()).limit(1).scalar()
+            high = None
+    if low == None and high == None:
+        entry.order = ORDER_GAP
+    elif high == None:
+        entry.order = low + ORDER_GAP
+    elif low == None:
+        entry.order = high - ORDER_GAP
+    elif high - low > 1:
+        entry.order = (low + high) // 2
+    else:
+        renumber_event(entry.event_id)
+        place_event_piece(entry, after, before)
+
+def check_order(entry: EventPiece) -> None:
+    """Raise OrderConflict if another entry of the event has the order of the entry
+
+    Call it once the entry is flushed: the transaction holds the write lock
+    of the database then, so what it reads can not change until the commit"""
+    if EventPiece.query.filter(EventPiece.event_id == entry.event_id, EventPiece.order == entry.order, EventPiece.id != entry.id).first() != None:
+        raise OrderConflict(f"Another entry of the event was given order {entry.order}")
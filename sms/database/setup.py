@@ -5,6 +5,10 @@
 from flask import current_app
 import logging, json
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, Table
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateTable
+from .search import create_search_index
 from .model import (
     Group,
     Part,
@@ -35,4 +39,63 @@ def create_everything(db:SQLAlchemy) -> None:
             db.session.add(group)
         db.session.commit()
 
-    logger.info("Database created by config")
\ No newline at end of file
+    logger.info("Database created by config")
+
+def _has_autoincrement(connection: Connection, table: Table) -> bool:
+    sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)).scalar()
+    return "AUTOINCREMENT" in sql.upper()
+
+def _rebuild_table(connection: Connection, table: Table) -> None:
+    """Create the table again from the model and copy the rows into it
+
+    SQLite can not alter how the ids of a table are assigned. Its indexes
+    are dropped along, create them again afterwards"""
+    preparer = connection.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    new_name = preparer.quote(table.name + "_new")
+    ddl = str(CreateTable(table).compile(dialect=connection.dialect)).replace(f"CREATE TABLE {name}", f"CREATE TABLE {new_name}", 1)
+    columns = ", ".join(preparer.quote(column.name) for column in table.columns)
+    connection.exec_driver_sql(ddl)
+    connection.exec_driver_sql(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {name}")
+    connection.exec_driver_sql(f"DROP TABLE {name}")
+    connection.exec_driver_sql(f"ALTER TABLE {new_name} RENAME TO {name}")
+
+def upgrade_everything(db:SQLAlchemy) -> None:
+    """Bring an existing database up to date with the models
+
+    Missing tables are created, missing columns and indexes are added to
+    existing tables and indexes the models dropped are dropped. Tables
+    created without their AUTOINCREMENT ids are rebuilt"""
+    logger = logging.getLogger(__name__)
+    with current_app.app_context():
+        db.create_all()
+        # Through the connection of the session, the only writer connection
+        inspector = inspect(db.session.connection())
+        for table in db.metadata.sorted_tables:
+            columns = [column["name"] for column in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in columns:
+                    db.session.execute(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(db.engine.dialect)}')
+                    logger.info(f"Add column {column.name} to table {table.name}")
+            # Tables whose ids must never be taken again, like files
+            if db.engine.dialect.name == "sqlite" and table.kwargs.get("sqlite_autoincrement") \
+                    and not _has_autoincrement(db.session.connection(), table):
+                _rebuild_table(db.session.connection(), table)
+                logger.info(f"Rebuild table {table.name} with AUTOINCREMENT ids")
+            # create_all only creates the indexes of the tables it creates
+            indexes = [index["name"] for index in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(db.session.connection())
+                    logger.info(f"Create index {index.name} on table {table.name}")
+            # Indexes of earlier models only slow the writes down
+            names = {index.name for index in table.indexes}
+            for name in indexes:
+                if name.startswith("ix_") and name not in names:
+                    db.session.execute(f'DROP INDEX "{name}"')
+                    logger.info(f"Drop index {name} of table {table.name}")
+        # Created along with the pieces table, filled from the existing pieces otherwise
+        if db.engine.dialect.name == "sqlite" and not inspector.has_table("pieces_fts"):
+            create_search_index(db.session.connection())
+            logger.info("Create the full text index of the pieces")
+        db.session.commit()
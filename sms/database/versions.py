@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+    Version stamps of sets of tables, changed by SQLite triggers on every write to them
+"""
+
+from typing import Optional
+from sqlalchemy import event, select
+from sqlalchemy.engine import Connection
+
+from .model import db
+
+# Name of a stamp to the tables it watches
+VERSIONED_TABLES = {
+    "info": ("groups", "parts", "instruments")
+}
+
+versions = db.Table("versions",
+    db.Column("name", db.Text, primary_key=True, nullable=False),
+    db.Column("stamp", db.Text, nullable=False)
+)
+
+# A random stamp is never taken again, not even by a write which was rolled back
+NEW_STAMP = "lower(hex(randomblob(8)))"
+
+def create_version_triggers(connection: Connection) -> None:
+    """Create the stamps and the triggers changing them, if they do not exist yet"""
+    if connection.dialect.name != "sqlite":
+        return
+    for name, tables in VERSIONED_TABLES.items():
+        connection.exec_driver_sql(f"INSERT OR IGNORE INTO versions(name, stamp) VALUES ('{name}', {NEW_STAMP})")
+        for table in tables:
+            for operation in ("INSERT", "UPDATE", "DELETE"):
+                connection.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {table}_{name}_{operation.lower()} AFTER {operation} ON {table} "
+                    f"BEGIN UPDATE versions SET stamp = {NEW_STAMP} WHERE name = '{name}'; END")
+
+# Once every table exists, create_all runs it on existing databases too
+event.listen(db.metadata, "after_create", lambda target, connection, **kwargs: create_version_triggers(connection))
+
+def get_version(name: str) -> Optional[str]:
+    """Return the stamp of the tables of the name, None if they are not versioned"""
+    return db.session.execute(select(versions.c.stamp).where(versions.c.name == name)).scalar()
@@ -6,6 +6,10 @@ from .info import info_blp
 from .events import event_blp
 from .pieces import piece_blp
 from .files import file_blp
+from .jobs import job_blp
+from .uploads import upload_blp
+from .trash import trash_blp
+from .export import export_blp
 
 api = Api()
 
@@ -15,4 +19,8 @@ def register_blueprints() -> None:
     api.register_blueprint(event_blp)
     api.register_blueprint(piece_blp)
     api.register_blueprint(file_blp)
+    api.register_blueprint(job_blp)
+    api.register_blueprint(upload_blp)
+    api.register_blueprint(trash_blp)
+    api.register_blueprint(export_blp)
 
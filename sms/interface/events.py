@@ -3,12 +3,17 @@
     Api for Events
 """
 
+from flask import Response
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from flask_smorest.error_handler import ErrorSchema
+from werkzeug.utils import secure_filename
 
-from .schemas import EventSchema, EventQuerySchema, EventCreateSchema, EventUpdateSchema, EventDeleteSchema
-from ..database import db, Event, EventPiece
+from .pagination import paginate
+from .schemas import EVENT_LOADING, PageQuerySchema, EventSchema, EventQuerySchema, EventCreateSchema, EventUpdateSchema, EventDeleteSchema, \
+    EventPieceOperationSchema
+from ..database import db, OrderConflict, place_event_piece, check_order, Event, EventPiece, Piece
+from ..utils import delete_events, get_piece_entries, stream_archive, get_storage
 
 event_blp = Blueprint("eventsApi", __name__,
     url_prefix="/api/events", description="Api for Event")
@@ -17,10 +22,13 @@ event_blp = Blueprint("eventsApi", __name__,
 class EventsApi(MethodView):
 
     @event_blp.arguments(EventQuerySchema, location="query")
+    @event_blp.arguments(PageQuerySchema, location="query")
     @event_blp.response(200, EventSchema(many=True))
-    def get(self, args):
-        """Get all events list"""
-        return Event.query.filter_by(**args).all()
+    def get(self, args, page_args):
+        """Get all events list, a page at a time
+
+        Follow X-Next-Cursor, or the next link, until there is none"""
+        return paginate(Event.query.options(*EVENT_LOADING).filter_by(**args), Event.id, page_args)
 
     @event_blp.arguments(EventCreateSchema, location="json")
     @event_blp.response(201, EventSchema)
@@ -56,15 +64,12 @@ class EventsApi(MethodView):
         return None
 
     @event_blp.arguments(EventDeleteSchema(many=True), location="json")
+    @event_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
     @event_blp.response(204)
     def delete(self, args):
-        """Delete events"""
-        for event in args:
-            event = Event.query.filter_by(id=event["id"]).first()
-            for eventPiece in event.events_pieces:
-                db.session.delete(eventPiece)
-            db.session.delete(event)
-        db.session.commit()
+        """Delete events, nothing is deleted if one of them is not found"""
+        if not delete_events([event["id"] for event in args]):
+            return abort(404)
         return None
 
 @event_blp.route("/<id>", endpoint="byid")
@@ -76,7 +81,7 @@ class EventsApiById(MethodView):
         """Get event by id"""
         # param id in query string can overide id specified in original url
         id = args.pop("id", False) or id
-        return Event.query.filter_by(id=id, **args).first()
+        return Event.query.options(*EVENT_LOADING).filter_by(id=id, **args).first()
 
     @event_blp.response(403, ErrorSchema)
     def post(self, id):
@@ -95,12 +100,78 @@ class EventsApiById(MethodView):
     def delete(self, id):
         """Delete event by id"""
         # id = args.pop("id", False) or id
-        event = Event.query.filter_by(id=id).first()
-        if event:
-            for eventPiece in event.events_pieces:
-                db.session.delete(eventPiece)
-            db.session.delete(event)
-            db.session.commit()
+        if delete_events([id]):
             return None
         else:
             return abort(404)
+
+@event_blp.route("/<id>/pieces", endpoint="pieces")
+class EventsPiecesApi(MethodView):
+
+    @event_blp.arguments(EventPieceOperationSchema(many=True), location="json")
+    @event_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the event, an entry or a piece is not found")
+    @event_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if a concurrent edit took the place of an entry")
+    @event_blp.response(200, EventSchema)
+    def patch(self, args, id):
+        """Edit the setlist of an event, operations are applied in order
+
+        - insert: add piece_id to the event
+        - move: move the entry id
+        - remove: remove the entry id
+
+        Inserted and moved entries are placed after the entry after, before
+        the entry before, or last. Only the edited entries are written, the
+        others keep their ids and orders, so edits of other entries made in
+        the meantime are kept."""
+        event = Event.query.filter_by(id=id).first()
+        if event == None:
+            return abort(404)
+        entries = {entry.id: entry for entry in event.events_pieces}
+        def get_entry(entry_id):
+            if entry_id == None:
+                return None
+            if entry_id not in entries:
+                db.session.rollback()
+                abort(404, message=f"No entry {entry_id} in the event")
+            return entries[entry_id]
+        for operation in args:
+            if operation["op"] == "remove":
+                db.session.delete(get_entry(operation["id"]))
+                del entries[operation["id"]]
+                continue
+            if operation["op"] == "insert":
+                if Piece.query.filter_by(id=operation["piece_id"]).first() == None:
+                    db.session.rollback()
+                    return abort(404, message=f"No piece {operation['piece_id']}")
+                entry = EventPiece(event_id=event.id, piece_id=operation["piece_id"])
+                db.session.add(entry)
+            else:
+                entry = get_entry(operation["id"])
+            place_event_piece(entry, get_entry(operation.get("after")), get_entry(operation.get("before")))
+            db.session.flush()
+            entries[entry.id] = entry
+            try:
+                check_order(entry)
+            except OrderConflict as error:
+                db.session.rollback()
+                return abort(409, message=str(error))
+        db.session.commit()
+        return event
+
+@event_blp.route("/<id>/archive", endpoint="archive")
+class EventsArchiveApi(MethodView):
+
+    @event_blp.response(200)
+    @event_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
+    def get(self, id):
+        """Download all files of the pieces of an event as a zip archive, one folder per piece in order"""
+        event = Event.query.filter_by(id=id).first()
+        if event == None:
+            return abort(404)
+        entries = []
+        event_pieces = sorted(event.events_pieces, key=lambda event_piece: event_piece.order)
+        for i, event_piece in enumerate(event_pieces, 1):
+            piece = event_piece.piece
+            entries.extend(get_piece_entries(piece, f"{i:02d}_{secure_filename(piece.name)}"))
+        return Response(stream_archive(entries, get_storage()), mimetype="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{secure_filename(event.name)}.zip"'})
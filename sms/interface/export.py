@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+    Api for the export of the whole catalog
+"""
+
+import json
+from typing import Iterator
+from flask import Response, current_app, stream_with_context
+from flask.views import MethodView
+from flask_smorest import Blueprint
+
+from .schemas import EVENT_LOADING, EXPORT_PIECE_LOADING, ExportPieceSchema, EventSchema
+from ..database import Piece, Event
+
+export_blp = Blueprint("exportApi", __name__,
+    url_prefix="/api/export", description="Api for the export of the whole catalog")
+
+def generate_export(batch_size: int) -> Iterator[str]:
+    """Generate the NDJSON lines of the export, {"piece": ...} for every piece then {"event": ...} for every event
+
+    Rows are read batch_size at a time with yield_per and dumped one by one,
+    so nothing but a batch is held in memory"""
+    schemas = (("piece", Piece, EXPORT_PIECE_LOADING, ExportPieceSchema()), ("event", Event, EVENT_LOADING, EventSchema()))
+    for kind, model, loading, schema in schemas:
+        for row in model.query.options(*loading).order_by(model.id).yield_per(batch_size):
+            yield json.dumps({kind: schema.dump(row)}) + "\n"
+
+@export_blp.route("/", endpoint="all")
+class ExportApi(MethodView):
+
+    @export_blp.response(200)
+    def get(self):
+        """Export every piece, with its instrumentations, files, transposes and places in events, and every event as NDJSON
+
+        The export is streamed as it is read, a line per row"""
+        return Response(stream_with_context(generate_export(current_app.config["EXPORT_BATCH_SIZE"])), mimetype="application/x-ndjson")
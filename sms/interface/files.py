@@ -3,71 +3,107 @@
     Api for Files
 """
 
-import os
-from flask import send_from_directory, current_app
+from typing import List
 from flask.views import MethodView
+from werkzeug.datastructures import FileStorage
 from flask_smorest import Blueprint, abort
 from flask_smorest.error_handler import ErrorSchema
-from sqlalchemy.orm import joinedload
 
-from .schemas import FileSchema, FileQuerySchema, FileSingleCreateSchema, FileUploadSchema, FileCreateSchema, FileUpdateSchema, FileDeleteSchema
-from ..database import db, File, Instrumentation, Transpose
-from ..utils import save_file, delete_file, get_filename
+from .pagination import paginate
+from .schemas import FILE_LOADING, PageQuerySchema, FileSchema, FileQuerySchema, ThumbnailQuerySchema, FileSingleCreateSchema, FileUploadSchema, FileCreateSchema, FileUpdateSchema, FileDeleteSchema
+from ..database import db, get_hashid_codec, File, Instrumentation, Transpose
+from ..utils import save_files, link_files, discard_files, delete_files, send_stored_file, send_thumbnail, schedule_thumbnails, wake_jobs
 
 file_blp = Blueprint("filesApi", __name__,
     url_prefix="/api/files", description="Api for Files")
 
+def get_file(hash_id: str, *options) -> File:
+    """Return the file with the hash id, None if there is none
+
+    The hash id is decoded to the primary key, no index on hash_id is needed"""
+    id = get_hashid_codec().decode(hash_id)
+    if id == None:
+        return None
+    return File.query.options(*options).filter_by(id=id).first()
+
+def build_files(args: List[dict], formats: List[str]) -> List[File]:
+    """Return new File instances from their create data, abort with 404 if an instrumentation id is not valid"""
+    file_instances = []
+
+    # Handling instrumentation, resolved with one query
+    instrumentation_ids = {id for data in args for id in data["instrumentation_ids"]}
+    instrumentations = {instrumentation.id: instrumentation for instrumentation in
+        Instrumentation.query.filter(Instrumentation.id.in_(instrumentation_ids))}
+
+    for format, data in zip(formats, args):
+        data = dict(data)
+        instrumentation_ids = data.pop("instrumentation_ids")
+        transpose = data.pop("transpose", None)
+        file_instance = File(**data)
+        # Handling transpose
+        if transpose:
+            file_instance.transpose = Transpose(instrument_id=transpose["instrument_id"])
+
+        # Handling instrumentation
+        for instrumentation_id in instrumentation_ids:
+            if instrumentation_id not in instrumentations:
+                db.session.rollback()
+                return abort(404, message=f"Instrumentation {instrumentation_id} not found")
+            file_instance.instrumentations.append(instrumentations[instrumentation_id])
+
+        # Handling format
+        file_instance.format = format
+        file_instances.append(file_instance)
+    return file_instances
+
+def store_files(file_instances: List[File], files: List[FileStorage]) -> List[File]:
+    """Save the files and insert all rows in one transaction, abort with 409 on a duplicate
+
+    The contents are stored first, the ids are only assigned by the flush
+    right before the commit"""
+    if not save_files(file_instances, files):
+        return abort(409)
+    db.session.add_all(file_instances)
+    try:
+        db.session.flush()
+        link_files(file_instances)
+    except Exception:
+        discard_files(file_instances)
+        raise
+    # Rendered by the job workers, the response does not wait for them
+    schedule_thumbnails(file_instances)
+    db.session.commit()
+    wake_jobs()
+
+    ids = [file_instance.id for file_instance in file_instances]
+    return File.query.options(*FILE_LOADING).filter(File.id.in_(ids)).order_by(File.id).all()
+
 @file_blp.route("/", endpoint="all")
 class FilesApi(MethodView):
 
     @file_blp.arguments(FileQuerySchema, location="query")
+    @file_blp.arguments(PageQuerySchema, location="query")
     @file_blp.response(200, FileSchema(many=True, exclude=("id",)))
-    def get(self, args):
-        """Get all files list"""
-        return File.query.filter_by(**args).all()
+    def get(self, args, page_args):
+        """Get all files list, a page at a time
+
+        Follow X-Next-Cursor, or the next link, until there is none"""
+        if "hash_id" in args:
+            args["id"] = get_hashid_codec().decode(args.pop("hash_id"))
+        return paginate(File.query.options(*FILE_LOADING).filter_by(**args), File.id, page_args)
 
     @file_blp.arguments(FileUploadSchema, location="files")
     @file_blp.arguments(FileCreateSchema, location="form")
+    @file_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if an instrumentation id is not valid")
     @file_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if the provided name is the same as an existing name")
     @file_blp.response(201, FileSchema(many=True, exclude=("id",)))
     def post(self, file_args, args):
         """Upload File"""
         files = file_args["files"]
         args = args["data"][0]
-        num_of_files = len(files)
-        file_instances = []
         args = FileSingleCreateSchema(many=True).loads(args)
-
-        for i in range(num_of_files):
-            file = files[i]
-            data = args[i]
-            instrumentation_ids = data.pop("instrumentation_ids")
-            transpose = data.pop("transpose") or None
-            file_instance = File(**data)
-            # Handling transpose
-            if transpose:
-                file_instance.transpose = Transpose(instrument_id=transpose["instrument_id"])
-
-            # Handling instrumentation
-            for instrumentation_id in instrumentation_ids:
-                instrumentation = Instrumentation.query.filter_by(id=instrumentation_id).first()
-                file_instance.instrumentations.append(instrumentation)
-
-            # Handling format
-            format = file.filename.split(".")[1]
-            file_instance.format = format
-
-            # Flush and save file
-            db.session.add(file_instance)
-            db.session.commit()
-            if save_file(file_instance, file):
-                new_file_instance = File.query.options(joinedload("transpose")).filter_by(id=file_instance.id).first()
-                file_instances.append(new_file_instance)
-            else:
-                db.session.delete(File.query.order_by(File.id.desc()).first())
-                return abort(409)
-
-        return file_instances
+        file_instances = build_files(args, [file.filename.split(".")[1] for file in files])
+        return store_files(file_instances, files)
 
     @file_blp.response(403, ErrorSchema)
     def put(self):
@@ -78,22 +114,14 @@ class FilesApi(MethodView):
     @file_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
     @file_blp.response(204)
     def delete(self, args):
-        """Delete files in a list"""
-        for arg in args:
-            file = File.query.options(joinedload("instrumentations")).filter_by(hash_id=arg["hash_id"]).first()
-            if file == None:
-                return abort(404)
-            else:
-                # Handle transpose
-                transpose = file.transpose
-                db.session.delete(transpose)
-                db.session.delete(file)
-
-                if delete_file(file):
-                    db.session.commit()
-                    return None
-                else:
-                    return abort(404)
+        """Delete files in a list, nothing is deleted if one of them is not found
+
+        Deleted files are restorable from the trash until it is purged"""
+        codec = get_hashid_codec()
+        ids = [codec.decode(arg["hash_id"]) for arg in args]
+        if None in ids or not delete_files(ids):
+            return abort(404)
+        return None
 
 
 @file_blp.route("/<hash_id>", endpoint="byid")
@@ -103,11 +131,11 @@ class FilesApiById(MethodView):
     @file_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
     def get(self, hash_id):
         """Download file by hash_id"""
-        file = File.query.filter_by(hash_id=hash_id).first()
+        file = get_file(hash_id)
+        if file == None:
+            return abort(404)
         try:
-            return send_from_directory(
-                os.path.join(os.getcwd(), current_app.config["FILES_DIR"],
-                file.instrumentations[0].piece.name), get_filename(file))
+            return send_stored_file(file)
         except FileNotFoundError:
             return abort(404, message="File not found")
 
@@ -128,18 +156,27 @@ class FilesApiById(MethodView):
     def delete(self, hash_id):
         """Delete file by id"""
         # hash_id = args.pop("hash_id", False) or hash_id
-        file = File.query.options(joinedload("instrumentations")).filter_by(hash_id=hash_id).first()
-        if file == None:
-            return abort(404)
+        # Restorable until purged by a job
+        id = get_hashid_codec().decode(hash_id)
+        if id != None and delete_files([id]):
+            return None
         else:
-            # Handle transpose
-            transpose = file.transpose
-            db.session.delete(transpose)
-            db.session.delete(file)
+            return abort(404)
+
 
-            if delete_file(file):
-                db.session.commit()
-                return None
-            else:
-                return abort(404)
+@file_blp.route("/<hash_id>/thumbnail", endpoint="thumbnail")
+class FilesThumbnailApi(MethodView):
 
+    @file_blp.arguments(ThumbnailQuerySchema, location="query")
+    @file_blp.response(200)
+    @file_blp.alt_response(202, None, description="Return 202 Accepted while the thumbnail is rendered, ask again after Retry-After seconds")
+    @file_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid or the file can not be rendered")
+    def get(self, args, hash_id):
+        """Get the first page thumbnail (or the preview with kind=preview) of the file as png"""
+        file = get_file(hash_id)
+        if file == None:
+            return abort(404)
+        response = send_thumbnail(file, args["kind"])
+        if response == None:
+            return abort(404, message="No thumbnail for this file")
+        return response
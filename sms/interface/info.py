@@ -3,26 +3,55 @@
     Api for Groups, Parts and Instruments in one get
 """
 
+import json
+from typing import Optional, Tuple
+from flask import Response, current_app, request
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
+from sqlalchemy.orm import lazyload
 
 from .schemas import InfoSchema
-from ..database import Group, Part, Instrument
+from ..database import get_version, Group, Part, Instrument
 
 info_blp = Blueprint("infoApi", __name__,
     url_prefix="/api/info", description="Api for Group, Part and Instrument info")
 
+def get_info() -> Tuple[Optional[str], bytes]:
+    """Return the version stamp and the serialized info
+
+    The info is serialized once per version of the groups, parts and
+    instruments tables and kept in the app. None as the stamp if they are
+    not versioned, the info is serialized on every call then"""
+    stamp = get_version("info")
+    cached = current_app.extensions.get("info_cache")
+    if stamp != None and cached != None and cached[0] == stamp:
+        return cached
+    # The pieces and events of the groups are not part of the info
+    info = dict(
+        groups = Group.query.options(lazyload("*")).all(),
+        parts = Part.query.options(lazyload("*")).all(),
+        instruments = Instrument.query.options(lazyload("*")).all()
+    )
+    cached = (stamp, json.dumps(InfoSchema().dump(info)).encode())
+    if stamp != None:
+        current_app.extensions["info_cache"] = cached
+    return cached
+
 @info_blp.route('/', endpoint="all")
 class InfoApi(MethodView):
 
     @info_blp.response(200, InfoSchema)
+    @info_blp.alt_response(304, None, description="Return 304 Not Modified if the ETag in If-None-Match is still the one of the info")
     def get(self):
-        groups = Group.query.all()
-        parts = Part.query.all()
-        instruments = Instrument.query.all()
-
-        return dict(
-            groups = groups,
-            parts = parts,
-            instruments = instruments
-        )
+        """Get all groups, parts and instruments
+
+        Send the ETag back in If-None-Match to get 304 Not Modified until
+        they change"""
+        stamp, data = get_info()
+        response = Response(data, mimetype="application/json")
+        if stamp != None:
+            response.set_etag(stamp)
+        else:
+            response.add_etag()
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
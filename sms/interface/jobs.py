@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    Api for the status of Jobs
+"""
+
+from flask.views import MethodView
+from flask_smorest import Blueprint, abort
+from flask_smorest.error_handler import ErrorSchema
+
+from .pagination import paginate
+from .schemas import PageQuerySchema, JobSchema, JobQuerySchema
+from ..database import Job
+
+job_blp = Blueprint("jobsApi", __name__,
+    url_prefix="/api/jobs", description="Api for the status of background jobs")
+
+@job_blp.route('/', endpoint="all")
+class JobsApi(MethodView):
+
+    @job_blp.arguments(JobQuerySchema, location="query")
+    @job_blp.arguments(PageQuerySchema, location="query")
+    @job_blp.response(200, JobSchema(many=True))
+    def get(self, args, page_args):
+        """Get all jobs list, a page at a time
+
+        Follow X-Next-Cursor, or the next link, until there is none"""
+        return paginate(Job.query.filter_by(**args), Job.id, page_args)
+
+@job_blp.route("/<int:id>", endpoint="byid")
+class JobsApiById(MethodView):
+
+    @job_blp.response(200, JobSchema)
+    @job_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
+    def get(self, id):
+        """Get the status of a job"""
+        job = Job.query.get(id)
+        if job == None:
+            return abort(404)
+        return job
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    Keyset pagination of the lists of the interface
+"""
+
+from typing import Dict, List, Tuple
+from urllib.parse import urlencode
+from flask import current_app, request
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import Column
+
+from .schemas import Cursor
+
+def paginate(query: BaseQuery, key: Column, args: Dict) -> Tuple[List, Dict]:
+    """Return a page of the query and the headers describing it
+
+    Rows are sorted by the indexed key and a page starts after the key of
+    the last row of the previous one, so every page costs the same whatever
+    its position. X-Next-Cursor and the next link are only sent if there are
+    more rows, X-Total-Count if args asks for the count.
+
+    :param args: loaded by PageQuerySchema
+    """
+    limit = min(args.get("limit") or current_app.config["PAGE_SIZE"], current_app.config["MAX_PAGE_SIZE"])
+    headers = {}
+    if args["count"]:
+        headers["X-Total-Count"] = query.order_by(None).count()
+    if args.get("cursor") != None:
+        query = query.filter(key > args["cursor"])
+    # One more row tells whether there is a next page
+    items = query.order_by(key).limit(limit + 1).all()
+    if len(items) > limit:
+        items = items[:limit]
+        cursor = Cursor().serialize("cursor", {"cursor": getattr(items[-1], key.key)})
+        headers["X-Next-Cursor"] = cursor
+        query_string = request.args.to_dict()
+        query_string["cursor"] = cursor
+        headers["Link"] = f'<{request.base_url}?{urlencode(query_string)}>; rel="next"'
+    return items, headers
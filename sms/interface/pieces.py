@@ -3,14 +3,19 @@
     Api for Pieces
 """
 
+import io
+from flask import Response, current_app, request
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 from flask_smorest.error_handler import ErrorSchema
 from werkzeug.utils import secure_filename
 
-from .schemas import PieceSchema, PieceQuerySchema, PieceCreateSchema, PieceUpdateSchema, PieceDeleteSchema
-from ..database import db, Piece, Group, Instrumentation
-from ..utils import create_piece, delete_piece, rename_piece
+from .pagination import paginate
+from sqlalchemy.exc import IntegrityError
+from .schemas import PIECE_LOADING, PageQuerySchema, PieceSchema, PieceQuerySchema, PieceSearchQuerySchema, PieceSearchResultSchema, PieceCreateSchema, \
+    PieceImportQuerySchema, ImportReportSchema, PieceUpdateSchema, PieceDeleteSchema
+from ..database import db, search_pieces, Piece, Group, Instrumentation
+from ..utils import create_piece, delete_pieces, rename_piece, get_piece_entries, stream_archive, get_storage, read_catalog, import_catalog
 
 piece_blp = Blueprint("piecesApi", __name__,
     url_prefix="/api/pieces", description="Api for Pieces")
@@ -19,10 +24,13 @@ piece_blp = Blueprint("piecesApi", __name__,
 class PiecesApi(MethodView):
 
     @piece_blp.arguments(PieceQuerySchema, location="query")
+    @piece_blp.arguments(PageQuerySchema, location="query")
     @piece_blp.response(200, PieceSchema(many=True))
-    def get(self, args):
-        """Get all pieces list"""
-        return Piece.query.filter_by(**args).all()
+    def get(self, args, page_args):
+        """Get all pieces list, a page at a time
+
+        Follow X-Next-Cursor, or the next link, until there is none"""
+        return paginate(Piece.query.options(*PIECE_LOADING).filter_by(**args), Piece.id, page_args)
 
     @piece_blp.arguments(PieceCreateSchema, location="json")
     @piece_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if the provided name is the same as an existing name")
@@ -60,15 +68,17 @@ class PiecesApi(MethodView):
         # TODO: Complete update with instrumentation
         group_ids = args.pop("group_ids", None)
         piece = Piece.query.filter_by(id=args["id"])
-        if piece.first() == None:
+        # Held for the whole update, the identity map only keeps a weak reference
+        instance = piece.first()
+        if instance == None:
             return abort(404)
         else:
-            original_name = piece.first().name
+            original_name = instance.name
             if not secure_filename(original_name) == secure_filename(args["name"]):
                 rename_piece(original_name, args["name"])
-            piece.first().groups = []
+            instance.groups = []
             for group_id in group_ids:
-                piece.first().groups.append(Group.query.filter_by(id=group_id).first())
+                instance.groups.append(Group.query.filter_by(id=group_id).first())
             piece.update(args)
             db.session.commit()
             return None
@@ -77,21 +87,52 @@ class PiecesApi(MethodView):
     @piece_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
     @piece_blp.response(204)
     def delete(self, args):
-        """Delete pieces from a list"""
-        for arg in args:
-            piece = Piece.query.filter_by(id=arg["id"]).first()
-            if piece:
-                for instrumentation in piece.instrumentations:
-                    for file in instrumentation.files:
-                        db.session.delete(file)
-                    db.session.delete(instrumentation)
-                db.session.delete(piece)
-                db.session.commit()
-                delete_piece(piece)
-            else:
-                return abort(404)
+        """Delete pieces from a list, nothing is deleted if one of them is not found
+
+        Deleted pieces are restorable from the trash until it is purged"""
+        if not delete_pieces([arg["id"] for arg in args]):
+            return abort(404)
         return None
 
+@piece_blp.route("/search", endpoint="search")
+class PiecesSearchApi(MethodView):
+
+    @piece_blp.arguments(PieceSearchQuerySchema, location="query")
+    @piece_blp.response(200, PieceSearchResultSchema(many=True))
+    def get(self, args):
+        """Search pieces by name, author, lyricist and arranger, best matches first
+
+        Every word of q has to match the start of a word, accents are
+        ignored: "dvor sym" finds "Symphony No. 9" by "Antonín Dvořák"."""
+        limit = min(args.get("limit") or current_app.config["PAGE_SIZE"], current_app.config["MAX_PAGE_SIZE"])
+        results = search_pieces(args["q"], limit, *current_app.config["SEARCH_HIGHLIGHT"])
+        pieces = {piece.id: piece for piece in
+            Piece.query.options(*PIECE_LOADING).filter(Piece.id.in_([result.rowid for result in results]))}
+        return [{"piece": pieces[result.rowid], "score": -result.rank, "snippet": result.snippet} for result in results]
+
+@piece_blp.route("/import", endpoint="import")
+class PiecesImportApi(MethodView):
+
+    @piece_blp.arguments(PieceImportQuerySchema, location="query")
+    @piece_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if a concurrent insert took the ids of a chunk")
+    @piece_blp.response(200, ImportReportSchema)
+    def post(self, args):
+        """Import a catalog of pieces, sent as the body in CSV (text/csv) or NDJSON (application/x-ndjson)
+
+        A CSV catalog has a header row naming the columns like the fields of
+        a new piece, ids of group_ids and instrument_ids are separated by ";".
+        NDJSON has a new piece per line. The body is read as it comes and
+        imported IMPORT_CHUNK_SIZE rows at a time, rows which can not be
+        imported are skipped and reported with their line."""
+        format = args.get("format") or ("csv" if request.mimetype == "text/csv" else "ndjson")
+        stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="" if format == "csv" else None)
+        try:
+            return import_catalog(read_catalog(stream, format), PieceCreateSchema()).to_dict()
+        except IntegrityError:
+            db.session.rollback()
+            # Chunks before the failed one are committed
+            return abort(409, message="Conflict with a concurrent insert")
+
 @piece_blp.route("/<id>", endpoint="byid")
 class PiecesApiById(MethodView):
 
@@ -101,7 +142,7 @@ class PiecesApiById(MethodView):
         # param id in query string can overide id specified in original url
         # But only the first result would be returned
         id = args.pop("id", False) or id
-        return Piece.query.filter_by(id=id, **args).first()
+        return Piece.query.options(*PIECE_LOADING).filter_by(id=id, **args).first()
 
     @piece_blp.response(403, ErrorSchema)
     def post(self, id):
@@ -120,15 +161,22 @@ class PiecesApiById(MethodView):
     def delete(self, id):
         """Delete a whole piece"""
         # id = args.pop("id", False) or id
-        piece = Piece.query.filter_by(id=id).first()
-        if piece:
-            for instrumentation in piece.instrumentations:
-                for file in instrumentation.files:
-                    db.session.delete(file)
-                db.session.delete(instrumentation)
-            db.session.delete(piece)
-            db.session.commit()
-            delete_piece(piece)
+        # Restorable until purged by a job
+        if delete_pieces([id]):
             return None
         else:
             return abort(404)
+
+@piece_blp.route("/<id>/archive", endpoint="archive")
+class PiecesArchiveApi(MethodView):
+
+    @piece_blp.response(200)
+    @piece_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
+    def get(self, id):
+        """Download all files of a piece as a zip archive"""
+        piece = Piece.query.filter_by(id=id).first()
+        if piece == None:
+            return abort(404)
+        entries = get_piece_entries(piece)
+        return Response(stream_archive(entries, get_storage()), mimetype="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{secure_filename(piece.name)}.zip"'})
@@ -3,10 +3,12 @@
     All schemas for the interface
 """
 
+import json, base64, binascii
 from flask_marshmallow import Marshmallow
 from flask_marshmallow.sqla import SQLAlchemyAutoSchema
 from flask_smorest.fields import Upload
-from marshmallow import fields, Schema
+from marshmallow import fields, validate, validates_schema, Schema, ValidationError
+from sqlalchemy.orm import selectinload, joinedload
 
 from ..database import (
     Group,
@@ -17,11 +19,36 @@ from ..database import (
     Piece,
     Instrumentation,
     File,
-    Transpose
+    Transpose,
+    Job,
+    UploadSession,
+    Trash,
+    get_hashid_codec
 )
 
 ma = Marshmallow()
 
+class Cursor(fields.Field):
+    """Opaque position in a list, the sort key of the last row of the previous page"""
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value == None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            value = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+        except (binascii.Error, ValueError):
+            raise ValidationError("Not a valid cursor")
+        if not isinstance(value, int):
+            raise ValidationError("Not a valid cursor")
+        return value
+
+class PageQuerySchema(Schema):
+    limit = fields.Integer(validate=validate.Range(min=1))
+    cursor = Cursor()
+    count = fields.Boolean(load_default=False)
+
 class GroupSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = Group
@@ -83,6 +110,27 @@ class EventPieceCreateSchema(Schema):
         "required": "Order is required"
     })
 
+class EventPieceOperationSchema(Schema):
+    op = fields.String(required=True, validate=validate.OneOf(["insert", "move", "remove"]), error_messages={
+        "required": "Op is required"
+    })
+    # Entry of the event moved or removed
+    id = fields.Integer()
+    # Piece inserted
+    piece_id = fields.Integer()
+    # Entries to place the inserted or moved entry after or before, last if neither
+    after = fields.Integer()
+    before = fields.Integer()
+
+    @validates_schema
+    def validate_operation(self, data, **kwargs):
+        if data["op"] == "insert" and "piece_id" not in data:
+            raise ValidationError("Piece_id is required to insert", "piece_id")
+        if data["op"] != "insert" and "id" not in data:
+            raise ValidationError(f"Id is required to {data['op']}", "id")
+        if "after" in data and "before" in data:
+            raise ValidationError("Only one of after and before can be given", "before")
+
 class EventSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = Event
@@ -93,6 +141,10 @@ class EventSchema(SQLAlchemyAutoSchema):
     id = ma.auto_field(required=True)
     events_pieces = fields.List(fields.Nested(EventPieceSchema(exclude=("event_id",))), data_key="pieces")
 
+# Loading plans of the schemas: every relationship a schema serializes is
+# loaded along with the rows, so a list costs the same queries at any length
+EVENT_LOADING = (selectinload(Event.events_pieces),)
+
 class EventQuerySchema(Schema):
     id = fields.Integer()
     name = fields.String()
@@ -142,6 +194,12 @@ class PieceSchema(SQLAlchemyAutoSchema):
     id = ma.auto_field(required=True)
     instrumentations = fields.List(fields.Nested(InstrumentationSchema))
 
+# The piece of an instrumentation is found in the identity map without a query
+PIECE_LOADING = (
+    selectinload(Piece.instrumentations).selectinload(Instrumentation.files),
+    selectinload(Piece.instrumentations).joinedload(Instrumentation.instrument)
+)
+
 class PieceQuerySchema(Schema):
     id = fields.Integer()
     name = fields.String()
@@ -153,6 +211,18 @@ class PieceQuerySchema(Schema):
     copyright_expire_date = fields.Date()
     created_time = fields.DateTime()
 
+class PieceSearchQuerySchema(Schema):
+    q = fields.String(required=True, validate=validate.Length(min=1), error_messages={
+        "required": "A query is required"
+    })
+    limit = fields.Integer(validate=validate.Range(min=1))
+
+class PieceSearchResultSchema(Schema):
+    piece = fields.Nested(PieceSchema)
+    # Higher is better, the negated bm25 rank
+    score = fields.Float()
+    snippet = fields.String()
+
 class PieceCreateSchema(Schema):
     name = fields.String(required=True, error_messages={
         "required": "Name is required"
@@ -166,6 +236,19 @@ class PieceCreateSchema(Schema):
     group_ids = fields.List(fields.Integer(), required=True)
     instrumentations = fields.List(fields.Nested(InstrumentationCreateSchema))
 
+class PieceImportQuerySchema(Schema):
+    # Guessed from the content type if not given
+    format = fields.String(validate=validate.OneOf(["csv", "ndjson"]))
+
+class ImportErrorSchema(Schema):
+    line = fields.Integer()
+    messages = fields.Dict()
+
+class ImportReportSchema(Schema):
+    rows = fields.Integer()
+    imported = fields.Integer()
+    errors = fields.List(fields.Nested(ImportErrorSchema))
+
 class PieceUpdateSchema(Schema):
     id = fields.Integer(required=True, error_messages={
         "required": "Id is required"
@@ -208,10 +291,33 @@ class FileSchema(SQLAlchemyAutoSchema):
         load_instance = True
         include_fk = True
         include_relationships = False
+        exclude = ("blob_id",)
 
     id = ma.auto_field(required=True)
+    hash_id = fields.Function(lambda obj: get_hashid_codec().encode(obj.id))
     transpose = fields.Nested(TransposeSchema(exclude=("file",)))
 
+FILE_LOADING = (joinedload(File.transpose).joinedload(Transpose.instrument),)
+
+class ExportInstrumentationSchema(SQLAlchemyAutoSchema):
+    class Meta:
+        model = Instrumentation
+        include_fk = True
+        include_relationships = False
+        exclude = ("piece_id",)
+
+    files = fields.List(fields.Nested(FileSchema))
+
+class ExportPieceSchema(PieceSchema):
+    instrumentations = fields.List(fields.Nested(ExportInstrumentationSchema))
+    events = fields.List(fields.Nested(EventPieceSchema(exclude=("piece_id",))), attribute="events_pieces")
+
+# Only loaders which load a batch at a time, the export is read with yield_per
+EXPORT_PIECE_LOADING = (
+    selectinload(Piece.instrumentations).selectinload(Instrumentation.files).joinedload(File.transpose).joinedload(Transpose.instrument),
+    selectinload(Piece.events_pieces)
+)
+
 class FileQuerySchema(Schema):
     hash_id = fields.String()
     format = fields.String()
@@ -219,6 +325,9 @@ class FileQuerySchema(Schema):
     name = fields.String()
     type = fields.Integer()
 
+class ThumbnailQuerySchema(Schema):
+    kind = fields.String(load_default="thumbnail", validate=validate.OneOf(["thumbnail", "preview"]))
+
 class FileSingleCreateSchema(Schema):
     instrumentation_ids = fields.List(fields.Integer(), required=True, error_messages={
         "required": "An array of instrumentation ids should be provided"
@@ -254,3 +363,41 @@ class FileDeleteSchema(Schema):
     hash_id = fields.String(required=True, error_messages={
         "required": "id is required when deleting data"
     })
+
+class UploadSessionSchema(SQLAlchemyAutoSchema):
+    class Meta:
+        model = UploadSession
+        exclude = ("id", "file_id")
+
+    data = fields.Function(lambda obj: json.loads(obj.data))
+    hash_id = fields.Function(lambda obj: get_hashid_codec().encode(obj.file_id) if obj.file_id != None else None)
+
+class UploadSessionCreateSchema(FileSingleCreateSchema):
+    filename = fields.String(required=True, validate=validate.Regexp(r"^[^.]+\..+"), error_messages={
+        "required": "Filename with the format of the file is required"
+    })
+    size = fields.Integer(required=True, validate=validate.Range(min=0), error_messages={
+        "required": "Size of the whole file is required"
+    })
+
+class TrashSchema(SQLAlchemyAutoSchema):
+    class Meta:
+        model = Trash
+        exclude = ("rows", "folder")
+
+    hash_id = fields.Function(lambda obj: get_hashid_codec().encode(obj.item_id) if obj.kind == "file" else None)
+
+class TrashQuerySchema(Schema):
+    kind = fields.String(validate=validate.OneOf(["piece", "file"]))
+
+class JobSchema(SQLAlchemyAutoSchema):
+    class Meta:
+        model = Job
+        exclude = ("locked_until",)
+
+    payload = fields.Function(lambda obj: json.loads(obj.payload))
+    result = fields.Function(lambda obj: json.loads(obj.result) if obj.result != None else None)
+
+class JobQuerySchema(Schema):
+    name = fields.String()
+    status = fields.String(validate=validate.OneOf(["pending", "running", "done", "failed"]))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+    Api for the Trash of deleted pieces and files
+"""
+
+from flask.views import MethodView
+from flask_smorest import Blueprint, abort
+from flask_smorest.error_handler import ErrorSchema
+
+from .pagination import paginate
+from .schemas import PageQuerySchema, TrashSchema, TrashQuerySchema
+from ..database import db, Trash
+from ..utils import RestoreConflict, restore_trash, enqueue_job, wake_jobs
+
+trash_blp = Blueprint("trashApi", __name__,
+    url_prefix="/api/trash", description="Api for restoring deleted pieces and files")
+
+def get_trash(id: int) -> Trash:
+    """Return the trash with the id, abort with 404 if there is none"""
+    trash = Trash.query.filter_by(id=id).first()
+    if trash == None:
+        return abort(404)
+    return trash
+
+@trash_blp.route('/', endpoint="all")
+class TrashApi(MethodView):
+
+    @trash_blp.arguments(TrashQuerySchema, location="query")
+    @trash_blp.arguments(PageQuerySchema, location="query")
+    @trash_blp.response(200, TrashSchema(many=True))
+    def get(self, args, page_args):
+        """Get all deleted pieces and files which can still be restored, a page at a time
+
+        Follow X-Next-Cursor, or the next link, until there is none"""
+        return paginate(Trash.query.filter_by(**args), Trash.id, page_args)
+
+@trash_blp.route("/<int:id>", endpoint="byid")
+class TrashApiById(MethodView):
+
+    @trash_blp.response(200, TrashSchema)
+    @trash_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
+    def get(self, id):
+        """Get a deleted piece or file"""
+        return get_trash(id)
+
+    @trash_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
+    @trash_blp.response(202)
+    def delete(self, id):
+        """Purge the deleted piece or file now instead of after TRASH_RETENTION"""
+        trash = get_trash(id)
+        enqueue_job("purge_trash", id=trash.id)
+        db.session.commit()
+        wake_jobs()
+
+@trash_blp.route("/<int:id>/restore", endpoint="restore")
+class TrashRestoreApi(MethodView):
+
+    @trash_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the id provided is not valid")
+    @trash_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if a piece or file with the same name was created since")
+    @trash_blp.response(204)
+    def post(self, id):
+        """Restore the deleted piece or file with its files"""
+        trash = get_trash(id)
+        try:
+            restore_trash(trash)
+        except RestoreConflict as e:
+            db.session.rollback()
+            return abort(409, message=str(e))
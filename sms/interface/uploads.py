@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    Api for resumable Uploads
+"""
+
+import os, json, uuid
+from datetime import datetime
+from flask import current_app, request
+from flask.views import MethodView
+from flask_smorest import Blueprint, abort
+from flask_smorest.error_handler import ErrorSchema
+from werkzeug.datastructures import FileStorage
+
+from .schemas import UploadSessionSchema, UploadSessionCreateSchema, FileSchema
+from .files import build_files, store_files
+from ..database import db, File, Instrumentation, UploadSession
+from ..utils import HashingFile, create_staging, write_chunk, remove_staging, get_stagingpath, wake_jobs
+
+upload_blp = Blueprint("uploadsApi", __name__,
+    url_prefix="/api/uploads", description="Api for resumable uploads of large files")
+
+def get_session(token: str) -> UploadSession:
+    """Return the upload session with the token, abort with 404 if there is none"""
+    session = UploadSession.query.filter_by(token=token).first()
+    if session == None:
+        return abort(404)
+    return session
+
+@upload_blp.route("/", endpoint="all")
+class UploadsApi(MethodView):
+
+    @upload_blp.arguments(UploadSessionCreateSchema, location="json")
+    @upload_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if an instrumentation id is not valid")
+    @upload_blp.response(201, UploadSessionSchema)
+    def post(self, args):
+        """Start a resumable upload
+
+        Chunks are then put in order, from the offset given by received, and
+        the upload is finalized once all of them are received"""
+        filename = args.pop("filename")
+        size = args.pop("size")
+        for instrumentation_id in set(args["instrumentation_ids"]):
+            if Instrumentation.query.get(instrumentation_id) == None:
+                return abort(404, message=f"Instrumentation {instrumentation_id} not found")
+        session = UploadSession(token=uuid.uuid4().hex, filename=filename, format=filename.split(".")[1],
+            data=json.dumps(args, sort_keys=True), size=size, chunk_size=current_app.config["UPLOAD_CHUNK_SIZE"], received=0)
+        db.session.add(session)
+        create_staging(session)
+        db.session.commit()
+        wake_jobs()
+        return session
+
+@upload_blp.route("/<token>", endpoint="bytoken")
+class UploadsApiByToken(MethodView):
+
+    @upload_blp.response(200, UploadSessionSchema)
+    @upload_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the token provided is not valid")
+    def get(self, token):
+        """Get the progress of the upload, resume from the received offset"""
+        return get_session(token)
+
+    @upload_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the token provided is not valid")
+    @upload_blp.response(204)
+    def delete(self, token):
+        """Cancel the upload, the file created by a finalized one is kept"""
+        session = get_session(token)
+        db.session.delete(session)
+        db.session.commit()
+        remove_staging(token)
+
+@upload_blp.route("/<token>/chunks/<int:number>", endpoint="chunk")
+class UploadsChunkApi(MethodView):
+
+    @upload_blp.response(200, UploadSessionSchema)
+    @upload_blp.alt_response(400, ErrorSchema, description="Return 400 Bad Request if the chunk is out of the file or does not have the size of a chunk")
+    @upload_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the token provided is not valid")
+    @upload_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if an earlier chunk is missing or the upload is finalized")
+    def put(self, token, number):
+        """Put the chunk with the number, the raw body is the content from number * chunk_size on
+
+        Every chunk but the last has chunk_size bytes. A chunk can be put again"""
+        session = get_session(token)
+        if session.status == "done":
+            return abort(409, message="Upload already finalized")
+        offset = number * session.chunk_size
+        if offset >= session.size:
+            return abort(400, message=f"Chunk {number} is out of the file")
+        if offset > session.received:
+            return abort(409, message=f"Chunk {number} is ahead, resume from offset {session.received}")
+        try:
+            end = offset + write_chunk(session, number, request.stream)
+        except ValueError as e:
+            return abort(400, message=str(e))
+        except FileNotFoundError:
+            return abort(404, message="Upload expired")
+        # Chunks put concurrently only ever move the offset forward
+        UploadSession.query.filter(UploadSession.id == session.id, UploadSession.received < end).update({
+            "received": end,
+            "updated_time": datetime.now()
+        }, synchronize_session=False)
+        db.session.commit()
+        return UploadSession.query.filter_by(id=session.id).first()
+
+@upload_blp.route("/<token>/finalize", endpoint="finalize")
+class UploadsFinalizeApi(MethodView):
+
+    @upload_blp.response(201, FileSchema(exclude=("id",)))
+    @upload_blp.alt_response(404, ErrorSchema, description="Return 404 Not Found if the token or an instrumentation id is not valid")
+    @upload_blp.alt_response(409, ErrorSchema, description="Return 409 Conflict if chunks are missing or the file is a duplicate")
+    @upload_blp.alt_response(410, ErrorSchema, description="Return 410 Gone if the staged content was lost, the upload has to start over")
+    def post(self, token):
+        """Create the file from the received chunks
+
+        The same checks as for a multipart upload are done. Finalizing an
+        upload again returns the file it created"""
+        session = get_session(token)
+        if session.status == "done":
+            if session.file == None:
+                return abort(404, message="File of the upload was deleted")
+            return session.file
+        if session.received < session.size:
+            return abort(409, message=f"Only {session.received} of {session.size} bytes received")
+        path = get_stagingpath(token)
+        if not os.path.exists(path):
+            return abort(410, message="Staged content is missing")
+
+        file_instances = build_files([json.loads(session.data)], [session.format])
+        # Committed along with the file
+        session.status = "done"
+        session.file = file_instances[0]
+        session.updated_time = datetime.now()
+        staged = HashingFile(current_app.config["BLOBS_DIR"], path=path)
+        try:
+            files = store_files(file_instances, [FileStorage(stream=staged, filename=session.filename)])
+        finally:
+            staged.close()
+        # Left behind if the content was stored already
+        remove_staging(token)
+        return files[0]
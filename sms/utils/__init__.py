@@ -7,9 +7,31 @@ from .file_handler import (
     check_file,
     check_piece,
     get_filename,
+    get_piecepath,
+    get_filepath,
     create_piece,
     save_file,
+    save_files,
+    link_files,
+    discard_files,
     delete_file,
     delete_piece,
-    rename_piece
+    rename_piece,
+    has_files_mirror,
+    trash_piece_folder,
+    restore_piece_folder
 )
+from .storage import StorageBackend, StoredObject, StorageReader, FileSystemBackend, S3Backend, init_storage, get_storage
+from .compression import get_encoding, compress_file, decode_file, decode_chunks
+from .resumable import get_stagingpath, create_staging, write_chunk, remove_staging
+from .trash import RestoreConflict, add_blob_refs, trash_pieces, trash_files, restore_trash, purge_trash
+from .bulk_delete import delete_pieces, delete_events, delete_files
+from .scrubber import ScrubReport, check_blob, scrub_storage
+from .jobs import JOB_HANDLERS, JobQueue, Throttle, job, enqueue_job, run_next_job, run_jobs, init_job_queue, get_job_queue, wake_jobs
+from .upload import HashingFile, UploadRequest, spool
+from .blob_store import get_blobpath, get_blobkey, store_blob, link_blob, release_blob_refs, purge_blobs, discard_blobs
+from .download import send_stored_file, send_thumbnail
+from .archive import get_piece_entries, stream_archive
+from .file_index import DirectoryIndex, get_shard, scan_pieces, shard_files, init_file_index, get_file_index
+from .thumbnail import Thumbnailer, ThumbnailCache, can_render, get_thumbnailpath, init_thumbnailer, get_thumbnailer, schedule_thumbnails
+from .catalog import CATALOG_FORMATS, ImportReport, read_catalog, import_catalog
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    Streaming zip archives of stored files
+"""
+
+import time, zipfile, logging
+from typing import Iterable, Iterator, List, Optional, Tuple
+from werkzeug.utils import secure_filename
+
+from ..database import Piece
+from .file_handler import get_filename
+from .blob_store import get_blobkey
+from .storage import StorageBackend
+from .compression import decode_chunks
+
+logger = logging.getLogger(__name__)
+
+# Formats which are already compressed, deflating them only costs cpu
+STORED_FORMATS = {"pdf", "png", "jpg", "jpeg", "gif", "tif", "tiff", "zip", "mxl", "mp3", "ogg", "mp4"}
+
+class _Sink(object):
+    """Unseekable file-like object collecting what ZipFile writes into it"""
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        """Return and clear everything written since the last call"""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def get_piece_entries(piece: Piece, folder: str = None) -> List[Tuple[str, str, int, Optional[str]]]:
+    """Return (name in archive, storage key, size, encoding) of every file of the piece
+
+    :param folder: folder of the files in the archive, defaults to the piece name"""
+    folder = folder or secure_filename(piece.name)
+    entries = {}
+    for instrumentation in piece.instrumentations:
+        for file in instrumentation.files:
+            if file.blob != None:
+                entries[file.id] = (f"{folder}/{get_filename(file)}", get_blobkey(file.blob.sha256), file.blob.size, file.blob.encoding)
+    return list(entries.values())
+
+def stream_archive(entries: Iterable[Tuple[str, str, int, Optional[str]]], storage: StorageBackend) -> Iterator[bytes]:
+    """Generate a zip archive of the entries chunk by chunk
+
+    Nothing but the chunk being copied is held in memory, sizes and crc are
+    written in data descriptors after each file so the output never needs
+    to be seeked. Files with a format in STORED_FORMATS are stored as is.
+
+    :param entries: (name in archive, storage key, size, encoding) of the files to put in the archive,
+        compressed contents are decoded on the way
+    :param storage: backend holding the files, the archive is generated outside of the app context"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode="w") as archive:
+        for arcname, key, size, encoding in entries:
+            stat = storage.stat(key)
+            if stat == None:
+                logger.warning(f"Skip missing file {key} in archive")
+                continue
+            info = zipfile.ZipInfo(arcname, date_time=time.localtime(stat.mtime)[:6])
+            info.file_size = size
+            if arcname.rsplit(".", 1)[-1].lower() in STORED_FORMATS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            chunks = storage.get_stream(key)
+            if encoding != None:
+                chunks = decode_chunks(chunks, encoding)
+            with archive.open(info, mode="w", force_zip64=size > zipfile.ZIP64_LIMIT) as dest:
+                yield sink.pop()
+                for chunk in chunks:
+                    dest.write(chunk)
+                    data = sink.pop()
+                    if data:
+                        yield data
+            yield sink.pop()
+    yield sink.pop()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    Content addressed blob store, every distinct content is stored once in the storage backend
+"""
+
+import os, glob, shutil, logging
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Iterator, Optional, Tuple
+from flask import current_app
+from sqlalchemy import bindparam, event
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from ..database import db, Blob
+from .upload import HashingFile
+from .jobs import Throttle, job
+from .storage import get_storage
+from .compression import get_encoding, compress_file, worth_compressing
+
+logger = logging.getLogger(__name__)
+
+def get_blobkey(sha256: str) -> str:
+    """Return the key of the blob with the given sha256 hex digest in the storage backend"""
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+def get_blobpath(sha256: str) -> str:
+    """Return the local path of the blob with the given sha256 hex digest
+
+    It only holds the content with the file system backend, what is derived
+    from the blob, like thumbnails, is stored next to it with any backend"""
+    return os.path.join(current_app.config["BLOBS_DIR"], sha256[:2], sha256[2:4], sha256)
+
+@contextmanager
+def _short_write() -> Iterator[Tuple[Connection, bool]]:
+    """Yield a connection to the writer and whether what is written there is committed right away
+
+    A session which writes already holds the only writer connection, what
+    it writes is committed with the session. Otherwise the writer is only
+    held for the statements of the block"""
+    if db.session.info.get("writing"):
+        connection = db.session.connection()
+        with connection.begin_nested():
+            yield connection, False
+    else:
+        with db.engine.begin() as connection:
+            yield connection, True
+
+def _keep_ref(blob_id: int, committed: bool) -> None:
+    # References committed on their own are released by release_blob_refs if the upload fails
+    if committed:
+        refs = db.session.info.setdefault("blob_refs", Counter())
+        refs[blob_id] += 1
+
+def _take_blob(sha256: str) -> Optional[Row]:
+    """Take a reference to the blob with the sha256, return its row or None if it is not stored
+
+    The conditional UPDATE goes to the writer, once it matched purge_blobs
+    can not delete the blob anymore. A blob purge_blobs deleted in the
+    meantime is not matched"""
+    blobs = Blob.__table__
+    with _short_write() as (connection, committed):
+        if connection.execute(blobs.update().values(ref_count=blobs.c.ref_count + 1)
+                .where(blobs.c.sha256 == sha256, blobs.c.ref_count >= 0)).rowcount != 1:
+            return None
+        row = connection.execute(blobs.select().where(blobs.c.sha256 == sha256)).one()
+    _keep_ref(row.id, committed)
+    return row
+
+def _insert_blob(sha256: str, size: int, encoding: str) -> Optional[Row]:
+    """Insert a blob holding a reference, return its row or None if a concurrent upload inserted it first"""
+    blobs = Blob.__table__
+    try:
+        with _short_write() as (connection, committed):
+            connection.execute(blobs.insert().values(sha256=sha256, size=size, encoding=encoding,
+                ref_count=1, created_time=datetime.now()))
+            row = connection.execute(blobs.select().where(blobs.c.sha256 == sha256)).one()
+    except IntegrityError:
+        return None
+    _keep_ref(row.id, committed)
+    return row
+
+def release_blob_refs() -> None:
+    """Release the references store_blob committed for the session, after its upload failed
+
+    The blobs are left to purge_blobs"""
+    refs = db.session.info.pop("blob_refs", None)
+    if refs:
+        blobs = Blob.__table__
+        with db.engine.begin() as connection:
+            connection.execute(blobs.update().where(blobs.c.id == bindparam("blob_id")).values(ref_count=blobs.c.ref_count - bindparam("refs")),
+                [{"blob_id": blob_id, "refs": count} for blob_id, count in refs.items()])
+
+def _forget_refs(session, *args) -> None:
+    session.info.pop("blob_refs", None)
+
+# Once the files are committed the references are theirs
+event.listen(Session, "after_commit", _forget_refs)
+
+def _put_content(spooled: HashingFile, sha256: str, encoding: Optional[str], restore: bool) -> Optional[str]:
+    """Put the content of spooled into the storage backend, return the encoding it is stored with
+
+    :param restore: the content of a known blob is restored, it keeps its encoding"""
+    storage = get_storage()
+    if encoding != None:
+        spooled.flush()
+        compressed = compress_file(spooled.name, encoding, current_app.config["COMPRESSION_LEVEL"])
+        try:
+            if restore or worth_compressing(spooled.size, os.path.getsize(compressed)):
+                storage.put_file(get_blobkey(sha256), compressed)
+                return encoding
+        finally:
+            if os.path.exists(compressed):
+                os.remove(compressed)
+    spooled.commit_into(storage, get_blobkey(sha256))
+    return None
+
+def store_blob(spooled: HashingFile, format: str = None) -> Blob:
+    """Return the Blob holding the content of spooled, with a reference taken for the caller
+
+    The spooled file is only committed into the store if the content is not
+    stored yet, otherwise it is discarded and the existing Blob is returned.
+    New contents of files of the COMPRESSED_FORMATS are stored compressed if
+    it is worth it.
+    The content is written without holding the writer, the reference is
+    then taken with a short write of its own. Call release_blob_refs if the
+    File pointing at the blob is not committed in the end, see discard_files.
+
+    :param format: format of the file the content was uploaded as"""
+    sha256 = spooled.hexdigest()
+    known = Blob.query.filter_by(sha256=sha256).first()
+    row = None
+    # Once the reference is taken the content can not be purged anymore
+    if known != None and get_storage().stat(get_blobkey(sha256)) != None:
+        row = _take_blob(sha256)
+    if row == None:
+        if known != None:
+            logger.warning(f"Blob {sha256} is missing from the store, restore it from upload")
+        encoding = _put_content(spooled, sha256, known.encoding if known != None else get_encoding(format), known != None)
+        # Purged meanwhile, or inserted by a concurrent upload of the same content
+        row = (known != None and _take_blob(sha256)) or _insert_blob(sha256, spooled.size, encoding) or _take_blob(sha256)
+        if row == None:
+            raise RuntimeError(f"Blob {sha256} was purged while being stored")
+    blob = Blob(**row._mapping)
+    make_transient_to_detached(blob)
+    return db.session.merge(blob, load=False)
+
+def link_blob(blob: Blob, path: str) -> None:
+    """Make the content of blob available at path
+
+    A hard link is used so that no extra disk space and no extra write is
+    needed, the content is copied if the file system does not support it.
+    Only done with a local storage backend, see has_files_mirror. Files of
+    compressed blobs hold the compressed content.
+    The reference is taken by store_blob"""
+    source = get_storage().local_path(get_blobkey(blob.sha256))
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+@job("purge_blobs")
+def purge_blobs() -> int:
+    """Remove blobs which are not referenced by any file anymore
+
+    Should be called after the deletion of files has been committed, or
+    enqueued as the purge_blobs job along with it. At most TRASH_PURGE_RATE
+    blobs are removed per second.
+    Return the number of purged blobs"""
+    purged = 0
+    throttle = Throttle(current_app.config["TRASH_PURGE_RATE"])
+    for id, sha256 in db.session.query(Blob.id, Blob.sha256).filter(Blob.ref_count <= 0).all():
+        # Only unlink if no reference has been taken in the meantime. The
+        # content goes before the commit, until then store_blob waits for
+        # the writer and can not take a reference to the blob being removed
+        if Blob.query.filter(Blob.id == id, Blob.ref_count <= 0).delete(synchronize_session=False):
+            path = get_blobpath(sha256)
+            # Along with what was derived from it, like thumbnails
+            for derived in glob.glob(path + ".*"):
+                try:
+                    os.remove(derived)
+                except OSError:
+                    pass
+            get_storage().delete(get_blobkey(sha256))
+            db.session.commit()
+            try:
+                # Drop the fan out folders once they are empty
+                os.rmdir(os.path.dirname(path))
+                os.rmdir(os.path.dirname(os.path.dirname(path)))
+            except OSError:
+                pass
+            purged += 1
+            throttle.consume(1)
+    return purged
+
+def discard_blobs(sha256s: Iterable[str]) -> None:
+    """Remove the stored content of blobs which have no Blob row
+
+    Used to clean up after a rolled back upload"""
+    sha256s = set(sha256s)
+    if not sha256s:
+        return
+    kept = {sha256 for sha256, in db.session.query(Blob.sha256).filter(Blob.sha256.in_(sha256s))}
+    for sha256 in sha256s - kept:
+        get_storage().delete(get_blobkey(sha256))
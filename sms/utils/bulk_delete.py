@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    Set based deletion of pieces, events and files, a statement per table whatever the number of rows
+"""
+
+import os, logging
+from typing import List
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload, joinedload
+from werkzeug.utils import secure_filename
+
+from ..database import db, Piece, Event, EventPiece, Instrumentation, File, Transpose, Trash
+from ..database.model import groups_pieces, groups_events, instrumentations_files
+from .file_handler import get_filepath, has_files_mirror, trash_piece_folder
+from .file_index import get_file_index
+from .trash import add_blob_refs, trash_pieces, trash_files
+from .jobs import wake_jobs
+
+logger = logging.getLogger(__name__)
+
+def _delete(table, condition) -> None:
+    db.session.execute(table.delete().where(condition))
+
+def _delete_files(file_ids: List[int]) -> None:
+    """Delete the files with their transposes and instrumentation links, and release their blobs
+
+    Bulk deletes skip the after_delete hook of File, so the references are
+    released here"""
+    files = File.__table__
+    add_blob_refs({blob_id: -count for blob_id, count in db.session.execute(select(files.c.blob_id, func.count())
+        .where(files.c.id.in_(file_ids), files.c.blob_id != None).group_by(files.c.blob_id))})
+    _delete(Transpose.__table__, Transpose.__table__.c.file_id.in_(file_ids))
+    _delete(instrumentations_files, instrumentations_files.c.file_id.in_(file_ids))
+    _delete(files, files.c.id.in_(file_ids))
+
+def delete_pieces(ids: List[int]) -> bool:
+    """Move the pieces into the trash and delete them with their places in events, instrumentations and files
+
+    The pieces are looked up with a single query, every table is cleared
+    with a single DELETE and everything is committed at once. The piece
+    folders are moved into TRASH_DIR after the commit.
+    Return False, with nothing deleted, if one of the pieces does not exist"""
+    ids = set(ids)
+    pieces = Piece.query.filter(Piece.id.in_(ids)).all()
+    if len(pieces) != len(ids):
+        return False
+    trashes = trash_pieces(pieces)
+    folders = [(trash.id, trash.name, trash.folder) for trash in trashes if trash.folder != None]
+    instrumentation_ids = select(Instrumentation.id).where(Instrumentation.piece_id.in_(ids)).scalar_subquery()
+    file_ids = [id for id, in db.session.execute(select(instrumentations_files.c.file_id).distinct()
+        .where(instrumentations_files.c.instrumentation_id.in_(instrumentation_ids)))]
+    _delete_files(file_ids)
+    _delete(instrumentations_files, instrumentations_files.c.instrumentation_id.in_(instrumentation_ids))
+    _delete(EventPiece.__table__, EventPiece.__table__.c.piece_id.in_(ids))
+    _delete(groups_pieces, groups_pieces.c.piece_id.in_(ids))
+    _delete(Instrumentation.__table__, Instrumentation.__table__.c.piece_id.in_(ids))
+    _delete(Piece.__table__, Piece.__table__.c.id.in_(ids))
+    db.session.commit()
+    # Removed right away instead, the trash can only restore the rows
+    removed = [id for id, name, folder in folders if trash_piece_folder(name, folder) == None]
+    if removed:
+        Trash.query.filter(Trash.id.in_(removed)).update({"folder": None}, synchronize_session=False)
+        db.session.commit()
+    wake_jobs()
+    return True
+
+def delete_events(ids: List[int]) -> bool:
+    """Delete the events with their setlists and group links, committed at once
+
+    Return False, with nothing deleted, if one of the events does not exist"""
+    ids = set(ids)
+    if db.session.query(func.count(Event.id)).filter(Event.id.in_(ids)).scalar() != len(ids):
+        return False
+    _delete(EventPiece.__table__, EventPiece.__table__.c.event_id.in_(ids))
+    _delete(groups_events, groups_events.c.event_id.in_(ids))
+    _delete(Event.__table__, Event.__table__.c.id.in_(ids))
+    db.session.commit()
+    return True
+
+def delete_files(ids: List[int]) -> bool:
+    """Move the files into the trash and delete them with their transposes and instrumentation links
+
+    The files are looked up with a single query, every table is cleared
+    with a single DELETE and everything is committed at once. The files are
+    removed from FILES_DIR after the commit, their blobs are kept by the trash.
+    Return False, with nothing deleted, if one of the files does not exist"""
+    ids = set(ids)
+    files = File.query.options(selectinload(File.instrumentations).joinedload(Instrumentation.piece)).filter(File.id.in_(ids)).all()
+    if len(files) != len(ids):
+        return False
+    trash_files(files)
+    paths = []
+    if has_files_mirror():
+        paths = [(secure_filename(file.instrumentations[0].piece.name), get_filepath(file)) for file in files if file.instrumentations]
+    _delete_files(list(ids))
+    db.session.commit()
+    index = get_file_index() if paths else None
+    for piece, path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            logger.warning(f"File {path} of a deleted file is missing")
+        index.remove_file(piece, os.path.basename(path))
+    wake_jobs()
+    return True
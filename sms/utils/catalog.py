@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    Bulk import of catalogs of pieces from CSV or NDJSON
+"""
+
+import os, csv, json, logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+from flask import current_app
+from marshmallow import Schema, ValidationError
+from werkzeug.utils import secure_filename
+
+from ..database import db, Piece, Group, Instrument, Instrumentation
+from ..database.model import groups_pieces
+from .file_handler import has_files_mirror
+from .file_index import get_file_index, get_shard
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FORMATS = ("csv", "ndjson")
+# Columns of pieces filled from the rows, others are left to the database
+PIECE_COLUMNS = ("name", "author", "lyricist", "arranger", "opus", "type", "copyright_expire_date")
+# Separator of the ids in the group_ids and instrument_ids columns of a CSV catalog
+ID_SEPARATOR = ";"
+
+class ImportReport(object):
+    """Progress and outcome of an import, errors are (line of the row, error messages)"""
+    def __init__(self) -> None:
+        self.rows = 0
+        self.imported = 0
+        self.errors: List[Tuple[int, Dict]] = []
+
+    def to_dict(self) -> Dict:
+        return {
+            "rows": self.rows,
+            "imported": self.imported,
+            "errors": [{"line": line, "messages": messages} for line, messages in self.errors]
+        }
+
+def _split_ids(value: str) -> List[str]:
+    return [id.strip() for id in value.split(ID_SEPARATOR) if id.strip()]
+
+def read_csv(stream: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """Generate (line, row) of a CSV catalog with a header row
+
+    Columns are named like the fields of PieceCreateSchema, empty cells are
+    left out. group_ids and instrument_ids hold ids separated by ID_SEPARATOR"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        data = {key: value for key, value in row.items() if key != None and value not in (None, "")}
+        if "group_ids" in row:
+            data["group_ids"] = _split_ids(row["group_ids"] or "")
+        if "instrument_ids" in data:
+            data["instrumentations"] = [{"instrument_id": id} for id in _split_ids(data.pop("instrument_ids"))]
+        yield reader.line_num, data
+
+def read_ndjson(stream: TextIO) -> Iterator[Tuple[int, Dict]]:
+    """Generate (line, row) of an NDJSON catalog, a PieceCreateSchema object per line
+
+    A line which is not a json object is generated as None"""
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = None
+        yield line, data if isinstance(data, dict) else None
+
+def read_catalog(stream: TextIO, format: str) -> Iterator[Tuple[int, Dict]]:
+    """Generate (line, row) of a catalog in one of CATALOG_FORMATS"""
+    return read_csv(stream) if format == "csv" else read_ndjson(stream)
+
+def _validate(chunk: List[Tuple[int, Dict]], schema: Schema, group_ids: set, instrument_ids: set,
+        names: set, report: ImportReport) -> List[Dict]:
+    """Return the loaded rows of the chunk which can be imported, report the others
+
+    :param names: secure names of the pieces imported so far, the new ones are added"""
+    rows = [row if row != None else {} for _, row in chunk]
+    try:
+        loaded = schema.load(rows, many=True)
+        errors = {}
+    except ValidationError as error:
+        loaded, errors = error.valid_data, error.messages
+    for i, (_, row) in enumerate(chunk):
+        if row == None:
+            errors[i] = {"_schema": ["Not a json object"]}
+    taken = {name for name, in db.session.query(Piece.name).filter(Piece.name.in_(
+        [data["name"] for data in loaded if "name" in data]))}
+    file_index = get_file_index() if has_files_mirror() else None
+    valid = []
+    for i, ((line, _), data) in enumerate(zip(chunk, loaded)):
+        messages = errors.get(i, {})
+        unknown = [id for id in data.get("group_ids", []) if id not in group_ids]
+        if unknown:
+            messages.setdefault("group_ids", []).append(f"Unknown groups {unknown}")
+        unknown = [instrumentation["instrument_id"] for instrumentation in data.get("instrumentations", [])
+            if instrumentation["instrument_id"] not in instrument_ids]
+        if unknown:
+            messages.setdefault("instrumentations", []).append(f"Unknown instruments {unknown}")
+        if not messages:
+            name = secure_filename(data["name"])
+            if data["name"] in taken or name in names or (file_index != None and file_index.has_piece(name)):
+                messages["name"] = [f"A piece named {data['name']} exists"]
+            else:
+                names.add(name)
+        if messages:
+            report.errors.append((line, messages))
+        else:
+            valid.append(data)
+    return valid
+
+def _insert(rows: List[Dict]) -> None:
+    """Insert the pieces, then their group links and instrumentations, a single executemany per table
+
+    Pieces are inserted one by one on the connection of the session, the
+    database assigns their ids"""
+    now = datetime.now()
+    connection, insert = db.session.connection(), Piece.__table__.insert()
+    links, instrumentations = [], []
+    for data in rows:
+        piece = {column: data.get(column) for column in PIECE_COLUMNS}
+        piece.update(type=data.get("type", 0), created_time=now)
+        id, = connection.execute(insert, piece).inserted_primary_key
+        links.extend({"group_id": group_id, "piece_id": id} for group_id in dict.fromkeys(data["group_ids"]))
+        instrumentations.extend({"piece_id": id, "instrument_id": instrumentation["instrument_id"]}
+            for instrumentation in data.get("instrumentations", []))
+    if links:
+        db.session.execute(groups_pieces.insert(), links)
+    if instrumentations:
+        db.session.execute(Instrumentation.__table__.insert(), instrumentations)
+
+def _create_folders(names: List[str], workers: int) -> None:
+    """Create the folders of the pieces in parallel
+
+    :param names: secure names of the pieces"""
+    root = current_app.config["FILES_DIR"]
+    paths = [os.path.join(root, get_shard(name)) for name in names]
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(lambda path: os.makedirs(path, exist_ok=True), paths))
+    index = get_file_index()
+    for name in names:
+        index.add_piece(name)
+
+def import_catalog(rows: Iterable[Tuple[int, Dict]], schema: Schema, chunk_size: int = None, workers: int = None,
+        progress: Optional[Callable[[ImportReport], None]] = None) -> ImportReport:
+    """Import the pieces of a catalog, a transaction per chunk of rows
+
+    Rows are validated chunk by chunk with the schema, then checked against
+    the groups and instruments, which are read once, and the names of
+    existing pieces. Invalid rows are reported and skipped, the others of
+    the chunk are inserted and committed together, then the folders of the
+    new pieces are created by a pool of workers.
+
+    :param rows: (line, row) of the catalog, see read_catalog
+    :param schema: schema loading a row, like PieceCreateSchema
+    :param chunk_size: rows per transaction, defaults to IMPORT_CHUNK_SIZE
+    :param workers: threads creating the folders, defaults to IMPORT_WORKERS
+    :param progress: called with the report after each chunk
+    """
+    config = current_app.config
+    chunk_size = chunk_size or config["IMPORT_CHUNK_SIZE"]
+    workers = workers or config["IMPORT_WORKERS"]
+    group_ids = {id for id, in db.session.query(Group.id)}
+    instrument_ids = {id for id, in db.session.query(Instrument.id)}
+    names = set()
+    report = ImportReport()
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        report.rows += len(chunk)
+        valid = _validate(chunk, schema, group_ids, instrument_ids, names, report)
+        if valid:
+            _insert(valid)
+            db.session.commit()
+            if has_files_mirror():
+                _create_folders([secure_filename(data["name"]) for data in valid], workers)
+            report.imported += len(valid)
+        logger.info(f"Import catalog: {report.rows} rows read, {report.imported} pieces imported, {len(report.errors)} errors")
+        if progress != None:
+            progress(report)
+    return report
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    Transparent compression of stored blobs, picked by the format of the file
+"""
+
+import os, gzip, zlib, shutil, tempfile
+from typing import IO, Iterable, Iterator, Optional
+from flask import current_app
+
+from .upload import CHUNK_SIZE
+
+# Content codings blobs can be stored with, named as in Content-Encoding
+ENCODINGS = {"gzip"}
+# Blobs are stored as is unless compressing saves at least this share of the size
+MIN_SAVING = 0.1
+
+def get_encoding(format: str) -> Optional[str]:
+    """Return the encoding new blobs of files of the format are stored with, None to store them as is"""
+    if format != None and format.lower() in current_app.config["COMPRESSED_FORMATS"]:
+        return "gzip"
+    return None
+
+def compress_file(path: str, encoding: str, level: int) -> str:
+    """Compress the file at path into a temporary file next to it, return its path
+
+    The output only depends on the content, so the same content is always
+    stored with the same bytes"""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}")
+    fd, temp = tempfile.mkstemp(prefix=".compress-", dir=os.path.dirname(path))
+    try:
+        with open(path, "rb") as src, os.fdopen(fd, "wb") as f:
+            with gzip.GzipFile(filename="", mode="wb", compresslevel=level, fileobj=f, mtime=0) as dest:
+                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(temp)
+        raise
+    return temp
+
+def worth_compressing(size: int, compressed_size: int) -> bool:
+    """Return whether a content of size is stored compressed to compressed_size"""
+    return compressed_size <= size * (1 - MIN_SAVING)
+
+class _DecodedFile(gzip.GzipFile):
+    """Gzip file closing the file it reads from along with itself"""
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        super().__init__(fileobj=fileobj, mode="rb")
+        self._source = fileobj
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._source.close()
+
+def decode_file(fileobj: IO[bytes], encoding: str) -> IO[bytes]:
+    """Return a seekable file of the decoded content of fileobj, closing it closes fileobj"""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}")
+    return _DecodedFile(fileobj)
+
+def decode_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """Decode a stream of encoded chunks chunk by chunk"""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}")
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise EOFError("Compressed stream ended before the end of the content")
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+    Sending stored files to clients
+"""
+
+import os, mimetypes
+from typing import Optional
+from urllib.parse import quote
+from flask import Response, current_app, request
+from werkzeug.utils import send_file
+from werkzeug.wsgi import FileWrapper
+
+from ..database import File
+from .file_handler import get_filename, get_filepath, has_files_mirror
+from .blob_store import get_blobkey
+from .storage import get_storage
+from .compression import decode_file
+from .thumbnail import get_thumbnailer
+
+def send_stored_file(file: File) -> Response:
+    """Send the content of the file
+
+    The ETag is the sha256 of the content, so it is strong and stays valid
+    for as long as the content does. Conditional (If-None-Match,
+    If-Modified-Since) and Range requests are answered here unless
+    SENDFILE_MODE hands the transfer over to the front proxy:
+
+    - "x-sendfile": X-Sendfile header with the absolute path of the file
+    - "x-accel-redirect": X-Accel-Redirect header with the path of the file
+      inside FILES_DIR, prefixed by X_ACCEL_REDIRECT_PREFIX
+
+    Files of a storage backend which is not local are streamed from it,
+    Range requests are passed on to the backend. So are compressed files,
+    see _send_from_storage.
+
+    Raise FileNotFoundError if the content is missing"""
+    if not has_files_mirror() or (file.blob != None and file.blob.encoding != None):
+        return _send_from_storage(file)
+    path = os.path.abspath(get_filepath(file))
+    etag = file.blob.sha256 if file.blob else True
+    mode = current_app.config["SENDFILE_MODE"]
+    if not mode:
+        return send_file(path, request.environ, etag=etag, conditional=True,
+            response_class=current_app.response_class)
+
+    # The proxy does the byte pushing and Range handling, only the
+    # conditional part is answered here
+    response = send_file(path, request.environ, etag=etag, conditional=False,
+        use_x_sendfile=True, response_class=current_app.response_class)
+    if mode == "x-accel-redirect":
+        del response.headers["X-Sendfile"]
+        location = os.path.relpath(path, os.path.abspath(current_app.config["FILES_DIR"]))
+        response.headers["X-Accel-Redirect"] = current_app.config["X_ACCEL_REDIRECT_PREFIX"].rstrip("/") + "/" + quote(location.replace(os.sep, "/"))
+    return response.make_conditional(request.environ)
+
+def _send_from_storage(file: File) -> Response:
+    """Stream the content of the file from the storage backend
+
+    Compressed blobs are sent as stored, with their Content-Encoding, to
+    clients accepting it and decoded on the fly for the others. Both
+    representations have their own ETag and ranges apply to the bytes sent."""
+    blob = file.blob
+    storage = get_storage()
+    key = get_blobkey(blob.sha256)
+    stat = storage.stat(key)
+    if stat == None:
+        raise FileNotFoundError(key)
+    mimetype = mimetypes.guess_type(get_filename(file))[0] or "application/octet-stream"
+    encoded = blob.encoding != None and request.accept_encodings[blob.encoding] > 0
+    source = storage.open(key)
+    if blob.encoding == None or encoded:
+        size = stat.size
+    else:
+        source = decode_file(source, blob.encoding)
+        size = blob.size
+    response = current_app.response_class(FileWrapper(source), mimetype=mimetype, direct_passthrough=True)
+    response.headers.set("Content-Disposition", "inline", filename=get_filename(file))
+    if blob.encoding != None:
+        response.vary.add("Accept-Encoding")
+    if encoded:
+        response.content_encoding = blob.encoding
+    response.content_length = size
+    response.last_modified = stat.mtime
+    response.cache_control.no_cache = True
+    response.set_etag(f"{blob.sha256}-{blob.encoding}" if encoded else blob.sha256)
+    return response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+
+def send_thumbnail(file: File, kind: str) -> Optional[Response]:
+    """Send the thumbnail or preview of the file
+
+    Return None if the file can not be rendered. A rendering missing from
+    the cache is rendered in the background and a 202 is sent meanwhile"""
+    thumbnailer = get_thumbnailer()
+    if file.blob == None or not thumbnailer.can_render(file.blob.sha256, file.format):
+        return None
+    path = thumbnailer.get(file.blob.sha256, file.format, kind)
+    if path == None:
+        # Unless it failed to render right away
+        if not thumbnailer.can_render(file.blob.sha256, file.format):
+            return None
+        return current_app.response_class(status=202, headers={"Retry-After": "1"})
+    return send_file(os.path.abspath(path), request.environ, mimetype="image/png",
+        etag=f"{file.blob.sha256}-{kind}", conditional=True, response_class=current_app.response_class)
@@ -3,86 +3,249 @@
     Handlers for file input and output
 """
 
-import os, shutil
+import os, shutil, uuid
 from flask import current_app
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
-from ..database import File, Piece
+from typing import List, Optional
+
+from ..database import db, get_hashid_codec, File, Piece, Instrumentation
+from .upload import spool
+from .blob_store import store_blob, link_blob, discard_blobs, release_blob_refs
+from .storage import get_storage
+from .file_index import get_file_index, get_shard, remove_empty_shards
+from .jobs import Throttle, job, enqueue_job, wake_jobs
+
+def has_files_mirror() -> bool:
+    """Return whether FILES_DIR mirrors the stored files by piece
+
+    Only possible with a local storage backend. Without it, app nodes share
+    nothing but the database and the backend, so duplicates are checked in
+    the database"""
+    return get_storage().local
 
 def check_piece(piece: Piece) -> bool:
     """Check whether a piece name has a duplicate
     
     Return True if no duplicate is found, return False if there's at least one duplicate"""
-    with current_app.app_context():
-        try:
-            root, dirs, files = next(os.walk(current_app.config["FILES_DIR"], topdown=True))
-            for dir in dirs:
-                if secure_filename(piece.name) == dir:
-                    return False
-            return True
-        except (IndexError, StopIteration):
-            return True
+    if not has_files_mirror():
+        query = Piece.query.filter(Piece.name == piece.name)
+        if piece.id != None:
+            query = query.filter(Piece.id != piece.id)
+        with db.session.no_autoflush:
+            return query.first() == None
+    return not get_file_index().has_piece(secure_filename(piece.name))
 
 def check_file(info: File) -> bool:
     """Check whether a file name has a duplicate
     
     Return True if no duplicate is found, return False if there's at least one duplicate"""
-    with current_app.app_context():
-        try:
-            root, dirs, files = next(os.walk(os.path.join(current_app.config["FILES_DIR"], secure_filename(info.instrumentations[0].piece.name)), topdown=True))
-            for file in files:
-                if strip_name(get_filename(info)) == strip_name(file):
-                    return False
-            return True
-        except (IndexError, StopIteration):
-            return True
+    try:
+        piece = info.instrumentations[0].piece
+    except IndexError:
+        return True
+    duplicate = lambda file: file is not info and (file.name, file.type, file.format) == (info.name, info.type, info.format)
+    # Files of the same upload are neither flushed nor linked yet
+    if any(isinstance(new, File) and duplicate(new) and any(i.piece is piece for i in new.instrumentations) for new in db.session.new):
+        return False
+    if not has_files_mirror():
+        query = File.query.join(File.instrumentations).filter(Instrumentation.piece_id == piece.id,
+            File.name == info.name, File.type == info.type, File.format == info.format)
+        if info.id != None:
+            query = query.filter(File.id != info.id)
+        with db.session.no_autoflush:
+            return query.first() == None
+    return get_file_index().find_file(secure_filename(piece.name), get_stripped_filename(info)) is None
 
 def get_filename(file: File) -> str:
     """Return the secure filename of the file"""
-    return file.name + "_" + str(file.type) + "_" + file.hash_id + "." + file.format
+    return file.name + "_" + str(file.type) + "_" + get_hashid_codec().encode(file.id) + "." + file.format
+
+def get_stripped_filename(file: File) -> str:
+    """Return the filename of the file without the hash id part, see strip_name, known before the file has an id"""
+    return file.name + "_" + str(file.type) + "." + file.format
+
+def get_piecepath(name: str) -> str:
+    """Return the path of the folder of the piece with the name in the file system
+
+    Folders are sharded, see get_shard, unless not migrated from the flat layout yet"""
+    piece = secure_filename(name)
+    return os.path.join(current_app.config["FILES_DIR"], get_file_index().locate(piece) or get_shard(piece))
+
+def get_filepath(file: File) -> str:
+    """Return the path of the file in the file system"""
+    return os.path.join(get_piecepath(file.instrumentations[0].piece.name), get_filename(file))
 
 def create_piece(piece: Piece) -> bool:
     """Create a piece folder according to the Piece instance"""
+    if not has_files_mirror():
+        return check_piece(piece)
     if check_piece(piece):
-        with current_app.app_context():
-            os.mkdir(os.path.join(current_app.config["FILES_DIR"], secure_filename(piece.name)))
+        os.makedirs(os.path.join(current_app.config["FILES_DIR"], get_shard(secure_filename(piece.name))))
+        get_file_index().add_piece(secure_filename(piece.name))
         return True
     else:
         return False
 
 def save_file(info: File, file: FileStorage) -> bool:
     """Save File according to the File instance
+
+    The upload is spooled into BLOBS_DIR (already done while receiving it if
+    the request was parsed by UploadRequest) and stored by its content, the
+    file itself is a link to the blob. Nothing is flushed, so a new File can
+    be inserted together with its blob. Its name holds the hash id of the
+    file, so a new File is linked by link_files once it is flushed.
     
     Return False if duplicate check failed, otherwise True"""
-    if check_file(info):
-        file.save(os.path.join(current_app.config["FILES_DIR"], info.instrumentations[0].piece.name, get_filename(info)))
-        return True
-    else:
-        return False
+    with db.session.no_autoflush:
+        if not check_file(info):
+            return False
+        with spool(file.stream, current_app.config["BLOBS_DIR"]) as spooled:
+            blob = store_blob(spooled, info.format)
+        info.blob = blob
+    if info.id != None:
+        link_files([info])
+    return True
+
+def link_files(infos: List[File]) -> None:
+    """Link the files of flushed File instances to their blobs, if FILES_DIR mirrors them"""
+    if not has_files_mirror():
+        return
+    for info in infos:
+        link_blob(info.blob, get_filepath(info))
+        get_file_index().add_file(secure_filename(info.instrumentations[0].piece.name), get_filename(info))
+
+def save_files(infos: List[File], files: List[FileStorage]) -> bool:
+    """Save the files of several new File instances, all or nothing
+
+    Nothing takes an id, flush and then link_files. If anything fails the
+    session is rolled back and everything already written is removed
+    again, see discard_files.
+
+    Return False if the duplicate check of any file failed, otherwise True"""
+    saved = []
+    try:
+        for info, file in zip(infos, files):
+            if not save_file(info, file):
+                break
+            saved.append(info)
+        else:
+            return True
+    except Exception:
+        discard_files(saved)
+        raise
+    discard_files(saved)
+    return False
+
+def discard_files(infos: List[File]) -> None:
+    """Roll back the session and remove the saved files of the File instances
+
+    The references taken to their blobs are released, blobs left without
+    any are purged by the purge_blobs job"""
+    mirror = has_files_mirror()
+    # Files without an id were not linked yet
+    saved = [(secure_filename(info.instrumentations[0].piece.name), get_filepath(info) if mirror and info.id != None else None,
+        info.blob.sha256) for info in infos]
+    db.session.rollback()
+    for piece, path, sha256 in saved:
+        if path == None:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        get_file_index().remove_file(piece, os.path.basename(path))
+    discard_blobs(sha256 for piece, path, sha256 in saved)
+    release_blob_refs()
+    enqueue_job("purge_blobs", unique=True)
+    db.session.commit()
+    wake_jobs()
+
+def trash_piece_folder(name: str, trash: str = None) -> Optional[str]:
+    """Move the folder of the piece with the name into TRASH_DIR with a single rename
+
+    :param trash: name of the folder in TRASH_DIR, a new one by default
+    Return the name of the folder in TRASH_DIR, None if there is no folder
+    or if it had to be removed right away"""
+    if not has_files_mirror() or check_piece(Piece(name=name)):
+        return None
+    path = get_piecepath(name)
+    trash = trash or uuid.uuid4().hex
+    try:
+        os.rename(path, os.path.join(current_app.config["TRASH_DIR"], trash))
+    except OSError:
+        # TRASH_DIR is on another file system
+        shutil.rmtree(path)
+        trash = None
+    remove_empty_shards(current_app.config["FILES_DIR"], os.path.relpath(path, current_app.config["FILES_DIR"]))
+    get_file_index().remove_piece(secure_filename(name))
+    return trash
+
+def restore_piece_folder(name: str, trash: str) -> None:
+    """Move a piece folder moved into TRASH_DIR back to the shard of the piece name"""
+    piece = secure_filename(name)
+    path = os.path.join(current_app.config["FILES_DIR"], get_shard(piece))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.rename(os.path.join(current_app.config["TRASH_DIR"], trash), path)
+    # Files are listed again on the next lookup
+    get_file_index().remove_piece(piece)
+    get_file_index().locate(piece)
 
 def delete_piece(piece: Piece):
-    """Delete the whole piece folder accoding to the Piece instance"""
+    """Delete the whole piece folder accoding to the Piece instance
+
+    The folder is moved into TRASH_DIR right away and removed by the
+    remove_tree job, enqueued in the session: commit, then wake_jobs"""
+    if not has_files_mirror():
+        return True
     if not check_piece(piece):
-        shutil.rmtree(os.path.join(current_app.config["FILES_DIR"], piece.name))
+        trash = trash_piece_folder(piece.name)
+        if trash != None:
+            enqueue_job("remove_tree", trash=trash)
         return True
     else:
         return False
 
+@job("remove_tree")
+def remove_tree(trash: str, throttle: Throttle = None) -> None:
+    """Remove a folder moved into TRASH_DIR
+
+    :param throttle: limit of the files removed per second"""
+    path = os.path.join(current_app.config["TRASH_DIR"], trash)
+    # Already removed by an earlier attempt
+    if not os.path.exists(path):
+        return
+    if throttle == None:
+        shutil.rmtree(path)
+        return
+    for directory, folders, names in os.walk(path, topdown=False):
+        for name in names:
+            os.remove(os.path.join(directory, name))
+            throttle.consume(1)
+        os.rmdir(directory)
+
 def delete_file(file: File):
-    """Delet file accoding to the File instance"""
+    """Delet file accoding to the File instance
+
+    The blob is released when the deletion of the File is flushed, call
+    purge_blobs after committing to reclaim unreferenced blobs"""
+    if not has_files_mirror():
+        return True
     if not check_file(file):
-        os.remove(os.path.join(current_app.config["FILES_DIR"],
-            file.instrumentations[0].piece.name, get_filename(file)))
+        os.remove(get_filepath(file))
+        get_file_index().remove_file(secure_filename(file.instrumentations[0].piece.name), get_filename(file))
         return True
     else:
         return False
 
 def rename_piece(original_name: str, new_name: str):
-    """Rename the piece folder name"""
-    os.rename(os.path.join(current_app.config["FILES_DIR"], secure_filename(original_name)), os.path.join(current_app.config["FILES_DIR"], secure_filename(new_name)))
-
-def strip_name(name: str):
-    """strip the hash id part of the filename"""
-    format = name.split(".")[1]
-    return "_".join(name.split("_")[:-1])+"."+format
+    """Rename the piece folder name, it is moved to the shard of the new name"""
+    if not has_files_mirror():
+        return
+    path = get_piecepath(original_name)
+    new_path = os.path.join(current_app.config["FILES_DIR"], get_shard(secure_filename(new_name)))
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    os.rename(path, new_path)
+    remove_empty_shards(current_app.config["FILES_DIR"], os.path.relpath(path, current_app.config["FILES_DIR"]))
+    get_file_index().rename_piece(secure_filename(original_name), secure_filename(new_name))
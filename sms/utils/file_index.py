@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+    In-process index of the piece folders and their files, and their sharded layout
+"""
+
+import os, hashlib, threading, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional
+from flask import Flask, current_app
+
+logger = logging.getLogger(__name__)
+
+HEX_DIGITS = set("0123456789abcdef")
+
+def get_shard(piece: str) -> str:
+    """Return the folder of the piece relative to FILES_DIR
+
+    Piece folders are spread over two levels of 256 folders each, picked by
+    the sha256 of the secure piece name, so that no folder grows too large.
+
+    :param piece: secure name of the piece"""
+    digest = hashlib.sha256(piece.encode()).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], piece)
+
+def _is_shard(path: str) -> bool:
+    """Return whether path is a fan out folder, only made of fan out folders
+
+    A piece folder of the flat layout can have a two hex digit name too, but
+    it holds files"""
+    name = os.path.basename(path)
+    if len(name) != 2 or not set(name) <= HEX_DIGITS:
+        return False
+    with os.scandir(path) as entries:
+        return all(entry.is_dir() and len(entry.name) == 2 and set(entry.name) <= HEX_DIGITS for entry in entries)
+
+def scan_pieces(root: str) -> Iterator[str]:
+    """Yield the folders of all pieces relative to root, in both layouts"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if not _is_shard(entry.path):
+                # Flat layout, not migrated yet
+                yield entry.name
+                continue
+            with os.scandir(entry.path) as shards:
+                for shard in list(shards):
+                    with os.scandir(shard.path) as pieces:
+                        for piece in pieces:
+                            if piece.is_dir():
+                                yield os.path.join(entry.name, shard.name, piece.name)
+
+class DirectoryIndex(object):
+    """Index of the piece folders in FILES_DIR and the stripped names of their files
+
+    Built once from the disk, then kept up to date by the file handlers so
+    that duplicate checks do not need to list folders. A hit is confirmed
+    with a single stat before it is trusted, stale entries left behind by
+    changes made outside of the handlers are dropped on the way. A piece
+    folder moved between the flat and the sharded layout, by shard_files in
+    another process, is found again at its other location.
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._lock = threading.RLock()
+        # piece -> folder relative to root
+        self._pieces: Dict[str, str] = {}
+        # piece -> {stripped file name: file name}
+        self._files: Dict[str, Dict[str, str]] = {}
+
+    def refresh(self) -> None:
+        """Re-check the whole index against the disk"""
+        # Files are loaded the first time the folder is looked up
+        pieces = {os.path.basename(path): path for path in scan_pieces(self.root)}
+        with self._lock:
+            self._pieces = pieces
+            self._files = {}
+
+    def locate(self, piece: str) -> Optional[str]:
+        """Return the folder of the piece relative to root, None if there is none
+
+        Besides the indexed folder, both layouts are checked, so a folder
+        created or moved by another process is found too"""
+        with self._lock:
+            path = self._pieces.get(piece)
+            for candidate in (path, get_shard(piece), piece):
+                if candidate != None and os.path.isdir(os.path.join(self.root, candidate)):
+                    if candidate != path:
+                        self._pieces[piece] = candidate
+                        self._files.pop(piece, None)
+                    return candidate
+            self._pieces.pop(piece, None)
+            self._files.pop(piece, None)
+            return None
+
+    def _piece_files(self, piece: str) -> Dict[str, str]:
+        files = self._files.get(piece)
+        if files == None:
+            files = {}
+            path = self._pieces.get(piece)
+            try:
+                with os.scandir(os.path.join(self.root, path or get_shard(piece))) as entries:
+                    for entry in entries:
+                        if entry.is_file() and "." in entry.name:
+                            files[strip_name(entry.name)] = entry.name
+            except FileNotFoundError:
+                pass
+            self._files[piece] = files
+        return files
+
+    def has_piece(self, piece: str) -> bool:
+        """Return whether the piece folder exists"""
+        return self.locate(piece) != None
+
+    def find_file(self, piece: str, stripped: str) -> Optional[str]:
+        """Return the name of the file in the piece folder with the stripped name, None if there is none"""
+        with self._lock:
+            path = self.locate(piece)
+            if path == None:
+                return None
+            files = self._piece_files(piece)
+            name = files.get(stripped)
+            if name == None or os.path.isfile(os.path.join(self.root, path, name)):
+                return name
+            del files[stripped]
+            return None
+
+    def add_piece(self, piece: str) -> str:
+        """Add a new piece, return its folder relative to root"""
+        with self._lock:
+            self._pieces[piece] = get_shard(piece)
+            self._files[piece] = {}
+            return self._pieces[piece]
+
+    def remove_piece(self, piece: str) -> None:
+        with self._lock:
+            self._pieces.pop(piece, None)
+            self._files.pop(piece, None)
+
+    def rename_piece(self, piece: str, new_piece: str) -> str:
+        """Rename a piece, return its new folder relative to root"""
+        with self._lock:
+            self._pieces.pop(piece, None)
+            self._pieces[new_piece] = get_shard(new_piece)
+            files = self._files.pop(piece, None)
+            if files != None:
+                self._files[new_piece] = files
+            return self._pieces[new_piece]
+
+    def add_file(self, piece: str, name: str) -> None:
+        with self._lock:
+            self._piece_files(piece)[strip_name(name)] = name
+
+    def remove_file(self, piece: str, name: str) -> None:
+        with self._lock:
+            self._piece_files(piece).pop(strip_name(name), None)
+
+def remove_empty_shards(root: str, path: str) -> None:
+    """Remove the fan out folders of a removed piece folder once they are empty
+
+    :param path: folder of the piece relative to root"""
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(root, parent))
+        except OSError:
+            return
+        parent = os.path.dirname(parent)
+
+def _shard_piece(root: str, path: str) -> None:
+    target = os.path.join(root, get_shard(path))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        # Atomic, a concurrent download finds the folder at one place or the other
+        os.rename(os.path.join(root, path), target)
+    except OSError:
+        # Left behind by an interrupted migration, move what is left file by file
+        for name in os.listdir(os.path.join(root, path)):
+            os.replace(os.path.join(root, path, name), os.path.join(target, name))
+        os.rmdir(os.path.join(root, path))
+
+def shard_files(root: str, workers: int = 4) -> int:
+    """Move the piece folders of the flat layout in root to the sharded layout
+
+    Can be run while the app is serving, piece folders are moved one by one
+    with a rename and the index of the app looks them up at both places.
+    Return the number of moved piece folders"""
+    flat = [path for path in scan_pieces(root) if os.sep not in path]
+    with ThreadPoolExecutor(workers) as executor:
+        for path, _ in zip(flat, executor.map(lambda path: _shard_piece(root, path), flat)):
+            logger.info(f"Moved piece folder {path} to {get_shard(path)}")
+    return len(flat)
+
+def init_file_index(app: Flask) -> DirectoryIndex:
+    """Build the index of the FILES_DIR of the app"""
+    index = DirectoryIndex(app.config["FILES_DIR"])
+    index.refresh()
+    app.extensions["file_index"] = index
+    return index
+
+def get_file_index() -> DirectoryIndex:
+    """Return the index of the current app"""
+    return current_app.extensions["file_index"]
+
+def strip_name(name: str):
+    """strip the hash id part of the filename"""
+    # Formats may hold underscores too, the hash id is the last part before the first dot
+    name, format = name.split(".", 1)
+    return name.rsplit("_", 1)[0]+"."+format
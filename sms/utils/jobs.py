@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    Durable job queue, slow side effects are stored as jobs and run by a pool of workers
+"""
+
+import json, time, threading, logging, traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+from flask import Flask, current_app
+
+from ..database import db, Job
+
+logger = logging.getLogger(__name__)
+
+# name -> handler, called with the payload as keyword arguments
+JOB_HANDLERS: Dict[str, Callable] = {}
+
+def job(name: str) -> Callable:
+    """Register the decorated function as the handler of the jobs with the name
+
+    Handlers run in an app context and may be run more than once, they must
+    be idempotent. What they return is stored json encoded as the result"""
+    def decorator(handler: Callable) -> Callable:
+        JOB_HANDLERS[name] = handler
+        return handler
+    return decorator
+
+def enqueue_job(name: str, unique: bool = False, max_attempts: int = None, delay: float = 0, **payload) -> Job:
+    """Add a job to the session, it is stored with the next commit
+
+    Call wake_jobs after committing so that it is started right away.
+
+    :param unique: reuse a pending job with the same name and payload if there is one
+    :param max_attempts: defaults to JOB_MAX_ATTEMPTS
+    :param delay: seconds before the job can be started"""
+    if name not in JOB_HANDLERS:
+        raise KeyError(f"No handler for job {name}")
+    payload = json.dumps(payload, sort_keys=True)
+    if unique:
+        pending = next((new for new in db.session.new if isinstance(new, Job) and new.name == name and new.payload == payload), None)
+        if pending == None:
+            with db.session.no_autoflush:
+                pending = Job.query.filter_by(name=name, payload=payload, status="pending").first()
+        if pending != None:
+            return pending
+    new_job = Job(name=name, payload=payload, status="pending", attempts=0,
+        max_attempts=max_attempts or current_app.config["JOB_MAX_ATTEMPTS"], run_after=datetime.now() + timedelta(seconds=delay))
+    db.session.add(new_job)
+    return new_job
+
+def _claimable(now: datetime):
+    """Filter of the jobs which can be started now"""
+    return db.or_(
+        db.and_(Job.status == "pending", Job.run_after <= now),
+        # The worker running it died
+        db.and_(Job.status == "running", Job.locked_until < now)
+    )
+
+def run_next_job() -> bool:
+    """Claim and run the next due job
+
+    Return False if there was no job to run"""
+    now = datetime.now()
+    while True:
+        id = db.session.query(Job.id).filter(_claimable(now)).order_by(Job.run_after, Job.id).limit(1).scalar()
+        if id == None:
+            return False
+        # Another worker may have claimed it in between
+        claimed = Job.query.filter(Job.id == id, _claimable(now)).update({
+            "status": "running",
+            "attempts": Job.attempts + 1,
+            "locked_until": now + timedelta(seconds=current_app.config["JOB_TIMEOUT"])
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            break
+    claimed_job = Job.query.get(id)
+    if claimed_job.attempts > claimed_job.max_attempts:
+        # Interrupted too many times
+        _fail(claimed_job, claimed_job.error or "Interrupted")
+        return True
+    try:
+        result = JOB_HANDLERS[claimed_job.name](**json.loads(claimed_job.payload))
+    except Exception:
+        db.session.rollback()
+        logger.exception(f"Job {claimed_job.id} {claimed_job.name} failed")
+        _fail(Job.query.get(id), traceback.format_exc())
+        return True
+    claimed_job.status = "done"
+    claimed_job.error = None
+    claimed_job.result = None if result == None else json.dumps(result, sort_keys=True)
+    claimed_job.locked_until = None
+    claimed_job.finished_time = datetime.now()
+    db.session.commit()
+    return True
+
+def _fail(failed_job: Job, error: str) -> None:
+    """Retry the job later with an exponential back off, or fail it for good"""
+    failed_job.error = error
+    failed_job.locked_until = None
+    if failed_job.attempts < failed_job.max_attempts:
+        failed_job.status = "pending"
+        failed_job.run_after = datetime.now() + timedelta(seconds=current_app.config["JOB_RETRY_DELAY"] * 2 ** (failed_job.attempts - 1))
+    else:
+        failed_job.status = "failed"
+        failed_job.finished_time = datetime.now()
+    db.session.commit()
+
+def run_jobs() -> int:
+    """Run all due jobs, return the number of jobs run"""
+    count = 0
+    while run_next_job():
+        count += 1
+    return count
+
+class Throttle(object):
+    """Limit the rate of work done by background jobs, over several threads together
+
+    :param rate: units (bytes, files...) per second, 0 or None for no limit"""
+    def __init__(self, rate: Optional[float]) -> None:
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size: int) -> None:
+        """Account for size units just done, sleep as long as doing them should have taken"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + size / self.rate
+            wait = self._next - now
+        time.sleep(wait)
+
+class JobQueue(object):
+    """Pool of worker threads running the jobs of the app
+
+    Workers poll the jobs table every poll_interval seconds and are woken
+    up right away by wake. With 0 workers, wake runs the due jobs in the
+    calling thread instead.
+    """
+    def __init__(self, app: Flask, workers: int, poll_interval: float) -> None:
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self) -> None:
+        self._stopped.clear()
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self) -> None:
+        """Wait until the workers are stopped"""
+        self._stopped.wait()
+
+    def wake(self) -> None:
+        if self.workers:
+            self._wakeup.set()
+        else:
+            run_jobs()
+
+    def _work(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                with self.app.app_context():
+                    run_jobs()
+            except Exception:
+                logger.exception("Job worker failed")
+            self._wakeup.wait(self.poll_interval)
+
+def init_job_queue(app: Flask) -> JobQueue:
+    """Create the job queue of the app, workers are started with JobQueue.start
+
+    create_app starts JOB_WORKERS of them unless testing, so every process
+    serving the app runs jobs, whatever server it runs in"""
+    queue = JobQueue(app, app.config["JOB_WORKERS"], app.config["JOB_POLL_INTERVAL"])
+    app.extensions["job_queue"] = queue
+    return queue
+
+def get_job_queue() -> JobQueue:
+    """Return the job queue of the current app"""
+    return current_app.extensions["job_queue"]
+
+def wake_jobs() -> None:
+    """Start the jobs committed by the current request"""
+    get_job_queue().wake()
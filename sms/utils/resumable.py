@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    Resumable uploads, the content is staged chunk by chunk until the upload is finalized
+"""
+
+import os, logging
+from datetime import datetime, timedelta
+from flask import current_app
+
+from ..database import db, UploadSession
+from .upload import CHUNK_SIZE
+from .jobs import job, enqueue_job
+
+logger = logging.getLogger(__name__)
+
+def get_stagingpath(token: str) -> str:
+    """Return the path of the staging file of the upload session
+
+    Staged inside BLOBS_DIR so that finalizing it is a rename"""
+    return os.path.join(current_app.config["BLOBS_DIR"], ".uploads", token)
+
+def create_staging(session: UploadSession) -> None:
+    """Create the empty staging file of a new upload session
+
+    Its expiry is enqueued in the session: commit, then wake_jobs"""
+    path = get_stagingpath(session.token)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    enqueue_job("expire_upload", delay=current_app.config["UPLOAD_EXPIRY"], token=session.token)
+
+def write_chunk(session: UploadSession, number: int, stream) -> int:
+    """Write the chunk with the number at its offset in the staging file
+
+    A chunk may be written again, so a retried chunk does no harm. Return
+    the number of written bytes, raise ValueError if the stream does not
+    hold exactly the chunk"""
+    offset = number * session.chunk_size
+    length = min(session.chunk_size, session.size - offset)
+    written = 0
+    with open(get_stagingpath(session.token), "r+b") as f:
+        f.seek(offset)
+        while written < length:
+            chunk = stream.read(min(CHUNK_SIZE, length - written))
+            if not chunk:
+                raise ValueError(f"Chunk {number} should be {length} bytes, got {written}")
+            f.write(chunk)
+            written += len(chunk)
+        if stream.read(1):
+            raise ValueError(f"Chunk {number} should be {length} bytes, got more")
+        # The chunk is only acknowledged once it is on disk
+        f.flush()
+        os.fsync(f.fileno())
+    return written
+
+def remove_staging(token: str) -> None:
+    try:
+        os.remove(get_stagingpath(token))
+    except FileNotFoundError:
+        pass
+
+@job("expire_upload")
+def expire_upload(token: str) -> None:
+    """Remove the upload session and its staging file if no chunk came for UPLOAD_EXPIRY
+
+    Put off again while chunks keep coming. Finalized sessions are kept as
+    long, so that a client which lost the response can still get the file"""
+    session = UploadSession.query.filter_by(token=token).first()
+    if session == None:
+        remove_staging(token)
+        return
+    expiry = timedelta(seconds=current_app.config["UPLOAD_EXPIRY"])
+    if session.updated_time + expiry > datetime.now():
+        enqueue_job("expire_upload", delay=(session.updated_time + expiry - datetime.now()).total_seconds(), token=token)
+    else:
+        if session.status != "done":
+            logger.info(f"Upload session {token} expired after receiving {session.received} of {session.size} bytes")
+        db.session.delete(session)
+        remove_staging(token)
+    db.session.commit()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    Integrity scrubber, reconciles the stored contents and FILES_DIR with the database
+"""
+
+import os, time, hashlib, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from flask import current_app
+from sqlalchemy.orm import selectinload, joinedload
+from werkzeug.utils import secure_filename
+
+from ..database import db, get_hashid_codec, Blob, File, Piece, Instrumentation
+from .blob_store import get_blobkey
+from .storage import StorageBackend, get_storage
+from .compression import decode_chunks
+from .file_handler import get_filename, get_filepath, has_files_mirror
+from .file_index import scan_pieces
+from .jobs import Throttle, job, enqueue_job
+
+logger = logging.getLogger(__name__)
+
+# Rows checked per query
+BATCH_SIZE = 500
+HEX_DIGITS = set("0123456789abcdef")
+
+class ScrubReport(object):
+    """Findings of a scrub, sha256 of blobs, hash ids of files and paths relative to FILES_DIR"""
+    KINDS = ("missing_blobs", "corrupt_blobs", "orphaned_blobs", "missing_files", "orphaned_files", "orphaned_pieces")
+
+    def __init__(self) -> None:
+        for kind in self.KINDS:
+            setattr(self, kind, [])
+        self.checked_blobs = 0
+        self.checked_bytes = 0
+
+    @property
+    def ok(self) -> bool:
+        return not any(getattr(self, kind) for kind in self.KINDS)
+
+    def to_dict(self) -> Dict:
+        report = {kind: sorted(getattr(self, kind)) for kind in self.KINDS}
+        report["checked_blobs"] = self.checked_blobs
+        report["checked_bytes"] = self.checked_bytes
+        return report
+
+def check_blob(storage: StorageBackend, sha256: str, size: int, encoding: Optional[str], throttle: Throttle) -> str:
+    """Stream the content of the blob through sha256, return "ok", "missing" or "corrupt"
+
+    Compressed blobs are checked against the checksum of their decoded content"""
+    digest = hashlib.sha256()
+    decoded_size = 0
+    def read():
+        for chunk in storage.get_stream(get_blobkey(sha256)):
+            throttle.consume(len(chunk))
+            yield chunk
+    try:
+        chunks = read() if encoding == None else decode_chunks(read(), encoding)
+        for chunk in chunks:
+            digest.update(chunk)
+            decoded_size += len(chunk)
+    except FileNotFoundError:
+        return "missing"
+    except (EOFError, OSError, ValueError):
+        # Truncated or garbled compressed stream
+        return "corrupt"
+    if digest.hexdigest() != sha256 or decoded_size != size:
+        return "corrupt"
+    return "ok"
+
+def _scrub_blobs(report: ScrubReport, storage: StorageBackend, executor: ThreadPoolExecutor, throttle: Throttle) -> None:
+    last = 0
+    while True:
+        blobs = db.session.query(Blob.id, Blob.sha256, Blob.size, Blob.encoding).filter(Blob.id > last).order_by(Blob.id).limit(BATCH_SIZE).all()
+        if not blobs:
+            return
+        last = blobs[-1].id
+        results = executor.map(lambda blob: check_blob(storage, blob.sha256, blob.size, blob.encoding, throttle), blobs)
+        for blob, result in zip(blobs, results):
+            report.checked_blobs += 1
+            if result == "missing":
+                report.missing_blobs.append(blob.sha256)
+            elif result == "corrupt":
+                report.corrupt_blobs.append(blob.sha256)
+            else:
+                report.checked_bytes += blob.size
+
+def _scrub_orphaned_blobs(report: ScrubReport, storage: StorageBackend, started: float) -> None:
+    def check(keys: List[str]) -> None:
+        sha256s = {key.rsplit("/", 1)[-1]: key for key in keys}
+        known = {sha256 for sha256, in db.session.query(Blob.sha256).filter(Blob.sha256.in_(sha256s))}
+        for sha256, key in sha256s.items():
+            if sha256 in known:
+                continue
+            stat = storage.stat(key)
+            # Stored by an upload which is not committed yet
+            if stat != None and stat.mtime < started:
+                report.orphaned_blobs.append(sha256)
+    keys = []
+    for key in storage.keys():
+        name = key.rsplit("/", 1)[-1]
+        # Renderings and other files derived from blobs are stored next to them
+        if len(name) != 64 or not set(name) <= HEX_DIGITS:
+            continue
+        keys.append(key)
+        if len(keys) == BATCH_SIZE:
+            check(keys)
+            keys = []
+    if keys:
+        check(keys)
+
+def _scrub_files(report: ScrubReport) -> None:
+    """Check that every file is in FILES_DIR"""
+    last = 0
+    while True:
+        files = File.query.options(selectinload(File.instrumentations).joinedload(Instrumentation.piece)) \
+            .filter(File.id > last).order_by(File.id).limit(BATCH_SIZE).all()
+        if not files:
+            return
+        last = files[-1].id
+        for file in files:
+            if file.instrumentations and not os.path.isfile(get_filepath(file)):
+                report.missing_files.append(get_hashid_codec().encode(file.id))
+
+def _scrub_orphaned_files(report: ScrubReport, root: str) -> None:
+    """Check that every piece folder and file in FILES_DIR belongs to a piece and a file"""
+    pieces = {secure_filename(name) for name, in db.session.query(Piece.name)}
+    codec = get_hashid_codec()
+    for path in scan_pieces(root):
+        piece = os.path.basename(path)
+        if piece not in pieces:
+            report.orphaned_pieces.append(path)
+            continue
+        names = {}
+        for name in os.listdir(os.path.join(root, path)):
+            # File names end with the hash id of the file, see get_filename
+            id = codec.decode(name.rsplit(".", 1)[0].rsplit("_", 1)[-1]) if "." in name else None
+            names[name] = id
+        ids = [id for id in names.values() if id != None]
+        files = {}
+        for i in range(0, len(ids), BATCH_SIZE):
+            for file in File.query.options(selectinload(File.instrumentations).joinedload(Instrumentation.piece)) \
+                    .filter(File.id.in_(ids[i:i + BATCH_SIZE])):
+                files[file.id] = file
+        for name, id in names.items():
+            file = files.get(id)
+            if file == None or get_filename(file) != name \
+                    or piece not in {secure_filename(instrumentation.piece.name) for instrumentation in file.instrumentations}:
+                report.orphaned_files.append(os.path.join(path, name))
+
+def scrub_storage(workers: int = 4, rate: float = None) -> ScrubReport:
+    """Check the store against the database and report what does not match
+
+    - missing and corrupt blobs: every Blob is streamed through sha256 by a
+      pool of workers, reading at most rate bytes per second together
+    - orphaned blobs: stored contents without a Blob
+    - missing files: files which are not in FILES_DIR
+    - orphaned files and pieces: files and piece folders in FILES_DIR without
+      a File or Piece, like the ones left behind by a failed rename
+
+    FILES_DIR is only checked if it is kept, see has_files_mirror. Nothing
+    is repaired, the database is read in batches of BATCH_SIZE rows"""
+    started = time.time()
+    report = ScrubReport()
+    storage = get_storage()
+    throttle = Throttle(rate)
+    with ThreadPoolExecutor(workers, thread_name_prefix="scrub") as executor:
+        _scrub_blobs(report, storage, executor, throttle)
+    _scrub_orphaned_blobs(report, storage, started)
+    if has_files_mirror():
+        _scrub_files(report)
+        _scrub_orphaned_files(report, current_app.config["FILES_DIR"])
+    return report
+
+@job("scrub_storage")
+def scrub_job() -> Dict:
+    """Scrub the store, the report is the result of the job
+
+    The next scrub is enqueued SCRUB_INTERVAL seconds later"""
+    config = current_app.config
+    report = scrub_storage(config["SCRUB_WORKERS"], config["SCRUB_RATE"])
+    if not report.ok:
+        logger.warning("Scrub found problems: " + ", ".join(f"{len(getattr(report, kind))} {kind}" for kind in report.KINDS if getattr(report, kind)))
+    if config["SCRUB_INTERVAL"]:
+        enqueue_job("scrub_storage", unique=True, delay=config["SCRUB_INTERVAL"])
+        db.session.commit()
+    return report.to_dict()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+    Storage backends holding the contents of blobs, on the local file system or in an S3 compatible object store
+"""
+
+import os, shutil, tempfile, logging
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import IO, Iterator, Optional
+from flask import Flask, current_app
+
+from .upload import CHUNK_SIZE
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+StoredObject = namedtuple("StoredObject", ["size", "mtime"])
+
+class StorageBackend(object):
+    """Interface of the storage backends
+
+    Keys are "/" separated paths. Ranges are python style, end excluded.
+    """
+    # Whether objects are files which can be linked, opened and sent by path
+    local = False
+
+    def put_stream(self, key: str, stream) -> None:
+        """Store everything read from the binary stream under key"""
+        raise NotImplementedError
+
+    def put_file(self, key: str, path: str) -> None:
+        """Move the local file at path into the store under key"""
+        with open(path, "rb") as f:
+            self.put_stream(key, f)
+        os.remove(path)
+
+    def get_stream(self, key: str, start: int = 0, end: int = None) -> Iterator[bytes]:
+        """Generate the content of the object, or of the range start to end of it, chunk by chunk
+
+        Raise FileNotFoundError if there is no object under key"""
+        raise NotImplementedError
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        """Return the size and modification time of the object, None if there is none"""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """Delete the object, if there is one"""
+        raise NotImplementedError
+
+    def rename_prefix(self, prefix: str, new_prefix: str) -> int:
+        """Move every object under the folder prefix to new_prefix, return the number of moved objects"""
+        raise NotImplementedError
+
+    def keys(self) -> Iterator[str]:
+        """Yield the keys of all objects, in no particular order"""
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Return the path of the object in the local file system, None if it is not stored there"""
+        return None
+
+    def open(self, key: str) -> IO[bytes]:
+        """Return a seekable binary file reading the object
+
+        Raise FileNotFoundError if there is no object under key"""
+        path = self.local_path(key)
+        if path != None:
+            return open(path, "rb")
+        stat = self.stat(key)
+        if stat == None:
+            raise FileNotFoundError(key)
+        return StorageReader(self, key, stat.size)
+
+    @contextmanager
+    def open_local(self, key: str, directory: str) -> Iterator[str]:
+        """Provide a local file with the content of the object
+
+        Objects which are not local are downloaded into a temporary file in
+        directory, removed afterwards"""
+        path = self.local_path(key)
+        if path != None:
+            yield path
+            return
+        fd, path = tempfile.mkstemp(prefix=".download-", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self.get_stream(key):
+                    f.write(chunk)
+            yield path
+        finally:
+            os.remove(path)
+
+class FileSystemBackend(StorageBackend):
+    """Objects are files below root, fan out folders are removed with their last object"""
+    local = True
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_stream(self, key: str, stream) -> None:
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(prefix=".upload-", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(stream, f, CHUNK_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def put_file(self, key: str, path: str) -> None:
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    def get_stream(self, key: str, start: int = 0, end: int = None) -> Iterator[bytes]:
+        with open(self.local_path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if end == None else end - start
+            while remaining == None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining == None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining != None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        try:
+            stat = os.stat(self.local_path(key))
+        except FileNotFoundError:
+            return None
+        return StoredObject(stat.st_size, stat.st_mtime)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            return
+        self._remove_empty_folders(os.path.dirname(key))
+
+    def rename_prefix(self, prefix: str, new_prefix: str) -> int:
+        source = self.local_path(prefix.strip("/"))
+        if not os.path.isdir(source):
+            return 0
+        count = sum(len(files) for _, _, files in os.walk(source))
+        target = self.local_path(new_prefix.strip("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(source, target)
+        self._remove_empty_folders(os.path.dirname(prefix.strip("/")))
+        return count
+
+    def keys(self) -> Iterator[str]:
+        for directory, folders, names in os.walk(self.root):
+            # Hidden entries are temporary files and staged uploads
+            folders[:] = [folder for folder in folders if not folder.startswith(".")]
+            folder = os.path.relpath(directory, self.root)
+            for name in names:
+                if not name.startswith("."):
+                    yield name if folder == "." else "/".join([*folder.split(os.sep), name])
+
+    def _remove_empty_folders(self, folder: str) -> None:
+        while folder:
+            try:
+                os.rmdir(self.local_path(folder))
+            except OSError:
+                return
+            folder = os.path.dirname(folder)
+
+class S3Backend(StorageBackend):
+    """Objects are stored in a bucket of an S3 compatible object store
+
+    Streams larger than part_size are uploaded in parts, so that neither the
+    upload nor a retry of it needs the whole content in memory.
+
+    :param client: boto3 S3 client, or anything with the same interface
+    :param prefix: prefix of all keys in the bucket
+    """
+    def __init__(self, client, bucket: str, prefix: str = "", part_size: int = 8 * 1024 * 1024) -> None:
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        # S3 refuses parts smaller than 5 MiB but the last one
+        self.part_size = part_size
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    @staticmethod
+    def _read_part(stream, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = stream.read(min(CHUNK_SIZE, size - len(data)))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def put_stream(self, key: str, stream) -> None:
+        data = self._read_part(stream, self.part_size)
+        if len(data) < self.part_size:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+            return
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self._key(key))["UploadId"]
+        try:
+            parts = []
+            while data:
+                response = self.client.upload_part(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                    PartNumber=len(parts) + 1, Body=data)
+                parts.append({"PartNumber": len(parts) + 1, "ETag": response["ETag"]})
+                data = self._read_part(stream, self.part_size)
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                MultipartUpload={"Parts": parts})
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id)
+            raise
+
+    def get_stream(self, key: str, start: int = 0, end: int = None) -> Iterator[bytes]:
+        args = {}
+        if start or end != None:
+            args["Range"] = f"bytes={start}-{'' if end == None else end - 1}"
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self._key(key), **args)["Body"]
+        except Exception as e:
+            if self._not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+        try:
+            while True:
+                chunk = body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception as e:
+            if self._not_found(e):
+                return None
+            raise
+        return StoredObject(response["ContentLength"], response["LastModified"].timestamp())
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def rename_prefix(self, prefix: str, new_prefix: str) -> int:
+        # Object stores have no folders, every object is copied then deleted
+        prefix = self._key(prefix.rstrip("/") + "/")
+        new_prefix = self._key(new_prefix.rstrip("/") + "/")
+        count = 0
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            keys = [item["Key"] for item in page.get("Contents", [])]
+            for key in keys:
+                self.client.copy_object(Bucket=self.bucket, Key=new_prefix + key[len(prefix):],
+                    CopySource={"Bucket": self.bucket, "Key": key})
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in keys]})
+            count += len(keys)
+        return count
+
+    def keys(self) -> Iterator[str]:
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):]
+
+    @staticmethod
+    def _not_found(error: Exception) -> bool:
+        code = getattr(error, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+class StorageReader(object):
+    """Seekable read-only file over an object of a storage backend
+
+    The object is fetched from the position of the first read on, so a
+    Range request only transfers the requested part"""
+    def __init__(self, storage: StorageBackend, key: str, size: int) -> None:
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self._position = 0
+        self._chunks = None
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset != self._position:
+            self.close()
+            self._position = offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if self._chunks == None:
+            self._chunks = self.storage.get_stream(self.key, self._position)
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, b"")
+            if not chunk:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def close(self) -> None:
+        if self._chunks != None:
+            self._chunks.close()
+        self._chunks = None
+        self._buffer = b""
+
+def init_storage(app: Flask) -> StorageBackend:
+    """Create the storage backend of the blobs of the app, picked by STORAGE_BACKEND"""
+    if app.config["STORAGE_BACKEND"] == "s3":
+        if boto3 == None:
+            raise RuntimeError("boto3 is needed by the s3 storage backend")
+        client = boto3.client("s3", endpoint_url=app.config["S3_ENDPOINT_URL"])
+        storage = S3Backend(client, app.config["S3_BUCKET"], app.config["S3_PREFIX"], app.config["S3_PART_SIZE"])
+    else:
+        storage = FileSystemBackend(app.config["BLOBS_DIR"])
+    app.extensions["storage"] = storage
+    return storage
+
+def get_storage() -> StorageBackend:
+    """Return the storage backend of the current app"""
+    return current_app.extensions["storage"]
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+    Thumbnails and previews of stored files, rendered in the background
+"""
+
+import os, threading, logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+from flask import Flask, current_app
+
+from ..database import File
+from .blob_store import get_blobpath, get_blobkey
+from .storage import StorageBackend, get_storage
+from .jobs import job, enqueue_job
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+logger = logging.getLogger(__name__)
+
+# Bounding box of each kind of rendering
+THUMBNAIL_SIZES = {"thumbnail": (256, 256), "preview": (1024, 1024)}
+IMAGE_FORMATS = {"png", "jpg", "jpeg", "gif", "tif", "tiff", "bmp", "webp"}
+PDF_FORMATS = {"pdf"}
+
+def get_thumbnailpath(sha256: str, kind: str) -> str:
+    """Return the path of the rendering of the blob, stored next to the blob
+
+    Renderings stay in BLOBS_DIR whatever the storage backend, they can be
+    rendered again at any time"""
+    return f"{get_blobpath(sha256)}.{kind}.png"
+
+def can_render(format: str) -> bool:
+    """Return whether files of the format can be rendered with the installed libraries"""
+    format = format.lower()
+    if format in PDF_FORMATS:
+        return pymupdf != None
+    if format in IMAGE_FORMATS:
+        return Image != None
+    return False
+
+def render(source: str, format: str, kind: str, path: str) -> None:
+    """Render the first page of source into a png at path, fitting in the box of kind"""
+    width, height = THUMBNAIL_SIZES[kind]
+    temp = f"{path}.{threading.get_ident()}.tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        if format.lower() in PDF_FORMATS:
+            with pymupdf.open(source, filetype="pdf") as document:
+                page = document[0]
+                zoom = min(width / page.rect.width, height / page.rect.height)
+                pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+                pixmap.save(temp, output="png")
+        else:
+            with Image.open(source) as image:
+                # Let jpeg decode at a reduced scale right away
+                image.draft("RGB", (width, height))
+                image.thumbnail((width, height))
+                if image.mode not in ("RGB", "RGBA", "L", "LA"):
+                    image = image.convert("RGBA")
+                image.save(temp, "PNG", optimize=True)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+class ThumbnailCache(object):
+    """Size bounded LRU of the renderings on disk
+
+    Renderings can always be rendered again from their blob, so the least
+    recently served ones are removed once the total size exceeds max_size.
+    The renderings already on disk are only accounted for once listed by
+    load, until then only the ones added since can be evicted.
+    """
+    def __init__(self, root: str, max_size: int) -> None:
+        self.root = root
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # path -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+
+    def load(self) -> None:
+        """List the renderings on disk, least recently used first
+
+        root is walked without the lock, meant to run in the background
+        while renderings are served and added"""
+        found = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".png"):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, path, stat.st_size))
+        with self._lock:
+            entries = OrderedDict((path, size) for _, path, size in sorted(found))
+            # Renderings added or used while listing are the most recent ones
+            for path, size in self._entries.items():
+                entries.pop(path, None)
+                entries[path] = size
+            self._entries = entries
+            self._size = sum(entries.values())
+            evicted = self._evict()
+        self._remove(evicted)
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._size
+
+    def _evict(self) -> List[str]:
+        """Drop the least recently used renderings beyond max_size, with the lock held
+
+        Return their paths, remove them once the lock is released"""
+        evicted = []
+        while self._size > self.max_size and len(self._entries) > 1:
+            old, old_size = self._entries.popitem(last=False)
+            self._size -= old_size
+            evicted.append(old)
+        return evicted
+
+    def _remove(self, paths: List[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def touch(self, path: str) -> None:
+        """Mark the rendering as just used"""
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+        try:
+            # Keeps the order across restarts
+            os.utime(path)
+        except OSError:
+            pass
+
+    def add(self, path: str) -> None:
+        """Account for a new rendering and evict the least recently used ones"""
+        size = os.path.getsize(path)
+        with self._lock:
+            self._size += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            evicted = self._evict()
+        self._remove(evicted)
+
+class Thumbnailer(object):
+    """Pool of workers rendering thumbnails and previews of blobs requested before they were rendered
+
+    With 0 workers renderings are done in the calling thread, like they
+    always are for the render_thumbnails job. Blobs which failed to render
+    are not rendered again for requests until the app restarts.
+    """
+    def __init__(self, root: str, workers: int, max_size: int) -> None:
+        self.root = root
+        self.cache = ThumbnailCache(root, max_size)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="thumbnail") if workers else None
+        self._lock = threading.Lock()
+        # sha256 -> rendering in progress
+        self._pending: Dict[str, Future] = {}
+        self._failed = set()
+
+    def _render(self, sha256: str, storage: StorageBackend, format: str, paths: Dict[str, str]) -> None:
+        try:
+            missing = {kind: path for kind, path in paths.items() if not os.path.exists(path)}
+            if missing:
+                # Blobs of a remote backend are downloaded once for all kinds
+                with storage.open_local(get_blobkey(sha256), self.root) as source:
+                    for kind, path in missing.items():
+                        render(source, format, kind, path)
+                        self.cache.add(path)
+        except Exception:
+            logger.exception(f"Failed to render blob {sha256}")
+            with self._lock:
+                self._failed.add(sha256)
+            raise
+        else:
+            with self._lock:
+                self._failed.discard(sha256)
+        finally:
+            with self._lock:
+                self._pending.pop(sha256, None)
+
+    def submit(self, sha256: str, format: str, inline: bool = False) -> Optional[Future]:
+        """Render every kind of rendering of the blob, None if the format can not be rendered
+
+        :param inline: render in the calling thread instead of the workers
+        """
+        if not can_render(format):
+            return None
+        paths = {kind: get_thumbnailpath(sha256, kind) for kind in THUMBNAIL_SIZES}
+        inline = inline or self._executor == None
+        with self._lock:
+            future = self._pending.get(sha256)
+            if future != None:
+                return future
+            if inline:
+                future = Future()
+            else:
+                future = self._executor.submit(self._render, sha256, get_storage(), format, paths)
+            self._pending[sha256] = future
+        if inline:
+            try:
+                self._render(sha256, get_storage(), format, paths)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+        return future
+
+    def can_render(self, sha256: str, format: str) -> bool:
+        """Return whether the blob can be rendered, see can_render"""
+        with self._lock:
+            failed = sha256 in self._failed
+        return not failed and can_render(format)
+
+    def get(self, sha256: str, format: str, kind: str) -> Optional[str]:
+        """Return the path of the rendering, None if it is not rendered yet
+
+        A missing rendering is submitted to the workers without waiting for
+        it, ask again later. With 0 workers it is rendered right away"""
+        path = get_thumbnailpath(sha256, kind)
+        if os.path.exists(path):
+            self.cache.touch(path)
+            return path
+        self.submit(sha256, format)
+        return path if os.path.exists(path) else None
+
+    def shutdown(self) -> None:
+        if self._executor != None:
+            self._executor.shutdown(wait=True)
+
+def init_thumbnailer(app: Flask) -> Thumbnailer:
+    """Start the thumbnail workers of the app
+
+    The renderings already on disk are listed in the background"""
+    thumbnailer = Thumbnailer(app.config["BLOBS_DIR"], app.config["THUMBNAIL_WORKERS"], app.config["THUMBNAIL_CACHE_SIZE"])
+    threading.Thread(target=thumbnailer.cache.load, name="thumbnail-cache", daemon=True).start()
+    app.extensions["thumbnailer"] = thumbnailer
+    return thumbnailer
+
+def get_thumbnailer() -> Thumbnailer:
+    """Return the thumbnailer of the current app"""
+    return current_app.extensions["thumbnailer"]
+
+@job("render_thumbnails")
+def render_thumbnails(sha256: str, format: str) -> None:
+    """Render every kind of rendering of the blob, in the thread of the job worker"""
+    future = get_thumbnailer().submit(sha256, format, inline=True)
+    if future != None:
+        # Only waits if a request is rendering the blob already
+        future.result()
+
+def schedule_thumbnails(files: Iterable[File]) -> None:
+    """Enqueue the rendering of the thumbnails of newly saved files
+
+    Jobs are stored with the files, call wake_jobs after committing"""
+    for file in files:
+        if file.blob != None and can_render(file.format):
+            enqueue_job("render_thumbnails", unique=True, sha256=file.blob.sha256, format=file.format.lower())
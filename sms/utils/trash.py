@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+    Trash of deleted pieces and files, restorable until purged in the background
+"""
+
+import json, uuid, logging
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from flask import current_app
+from sqlalchemy import Table, Column, bindparam
+from werkzeug.utils import secure_filename
+
+from ..database import db, File, Piece, EventPiece, Instrumentation, Transpose, Blob, Trash, Event
+from ..database.model import groups_pieces, instrumentations_files
+from .blob_store import link_blob
+from .file_handler import check_piece, check_file, get_filename, get_filepath, has_files_mirror, \
+    restore_piece_folder, remove_tree
+from .file_index import get_file_index
+from .jobs import Throttle, job, enqueue_job
+
+logger = logging.getLogger(__name__)
+
+def _serializable(row) -> Dict:
+    return {key: value.isoformat() if isinstance(value, date) else value for key, value in row.items()}
+
+def _dump_rows_by(table: Table, column: Column, keys: Iterable) -> Dict[Any, List[Dict]]:
+    """Return the rows of the table with a value of the column in keys, json serializable, by that value
+
+    All the rows are read with a single query"""
+    rows = {}
+    keys = list(keys)
+    if keys:
+        for row in db.session.execute(table.select().where(column.in_(keys))).mappings():
+            rows.setdefault(row[column.name], []).append(_serializable(row))
+    return rows
+
+def _load_rows(dump: Dict) -> None:
+    """Insert rows dumped by _dump_rows_by again"""
+    table = db.metadata.tables[dump["table"]]
+    rows = []
+    for row in dump["rows"]:
+        row = dict(row)
+        for column in table.columns:
+            if row.get(column.name) != None and column.type.python_type in (date, datetime):
+                row[column.name] = column.type.python_type.fromisoformat(row[column.name])
+        rows.append(row)
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+def _blob_ids(dumps: List[Dict]) -> List[int]:
+    return [row["blob_id"] for dump in dumps if dump["table"] == "files" for row in dump["rows"] if row["blob_id"] != None]
+
+def add_blob_refs(refs: Dict[int, int]) -> None:
+    """Add references to the blobs with a single executemany
+
+    :param refs: blob id to the number of references added, negative to release them"""
+    if refs:
+        table = Blob.__table__
+        db.session.execute(table.update().where(table.c.id == bindparam("blob_id")).values(ref_count=table.c.ref_count + bindparam("refs")),
+            [{"blob_id": blob_id, "refs": count} for blob_id, count in refs.items()])
+
+def _add_trashes(items: List[Tuple[str, int, str, List[Dict], Optional[str]]]) -> List[Trash]:
+    """Add the trashes of the dumped rows to the session, along with the jobs purging them
+
+    The blobs of the files are referenced by the trashes, so they are kept
+    until they are purged
+
+    :param items: (kind, item_id, name, dumps, folder) of the trashes"""
+    retention = current_app.config["TRASH_RETENTION"]
+    purge_after = datetime.now() + timedelta(seconds=retention)
+    trashes = [Trash(kind=kind, item_id=item_id, name=name, rows=json.dumps(dumps), folder=folder, purge_after=purge_after)
+        for kind, item_id, name, dumps, folder in items]
+    db.session.add_all(trashes)
+    add_blob_refs(Counter(blob_id for item in items for blob_id in _blob_ids(item[3])))
+    db.session.flush()
+    for trash in trashes:
+        enqueue_job("purge_trash", delay=retention, id=trash.id)
+    return trashes
+
+def trash_pieces(pieces: List[Piece]) -> List[Trash]:
+    """Dump the pieces into the trash with their group links, places in events, instrumentations, files and transposes
+
+    Every table is read with a single query for all the pieces. Call it
+    before deleting the rows. The name of the folder of each piece in
+    TRASH_DIR is picked, the folder is moved there by trash_piece_folder
+    once the deletion is committed. Commit, then wake_jobs"""
+    piece_ids = [piece.id for piece in pieces]
+    instrumentations = _dump_rows_by(Instrumentation.__table__, Instrumentation.__table__.c.piece_id, piece_ids)
+    instrumentation_ids = [row["id"] for rows in instrumentations.values() for row in rows]
+    links = _dump_rows_by(instrumentations_files, instrumentations_files.c.instrumentation_id, instrumentation_ids)
+    file_ids = {row["file_id"] for rows in links.values() for row in rows}
+    files = _dump_rows_by(File.__table__, File.__table__.c.id, file_ids)
+    transposes = _dump_rows_by(Transpose.__table__, Transpose.__table__.c.file_id, file_ids)
+    file_links = _dump_rows_by(instrumentations_files, instrumentations_files.c.file_id, file_ids)
+    tables = [
+        (Piece.__table__, _dump_rows_by(Piece.__table__, Piece.__table__.c.id, piece_ids)),
+        (groups_pieces, _dump_rows_by(groups_pieces, groups_pieces.c.piece_id, piece_ids)),
+        (EventPiece.__table__, _dump_rows_by(EventPiece.__table__, EventPiece.__table__.c.piece_id, piece_ids))
+    ]
+    file_index = get_file_index() if has_files_mirror() else None
+    items = []
+    for piece in pieces:
+        instrumentation_ids = [row["id"] for row in instrumentations.get(piece.id, [])]
+        file_ids = list(dict.fromkeys(row["file_id"] for id in instrumentation_ids for row in links.get(id, [])))
+        dumps = [{"table": table.name, "rows": rows.get(piece.id, [])} for table, rows in tables] + [
+            {"table": Instrumentation.__tablename__, "rows": instrumentations.get(piece.id, [])},
+            {"table": File.__tablename__, "rows": [row for id in file_ids for row in files.get(id, [])]},
+            {"table": Transpose.__tablename__, "rows": [row for id in file_ids for row in transposes.get(id, [])]},
+            {"table": instrumentations_files.name, "rows": [row for id in file_ids for row in file_links.get(id, [])]}
+        ]
+        folder = uuid.uuid4().hex if file_index != None and file_index.has_piece(secure_filename(piece.name)) else None
+        items.append(("piece", piece.id, piece.name, dumps, folder))
+    return _add_trashes(items)
+
+def trash_files(files: List[File]) -> List[Trash]:
+    """Dump the files into the trash with their transposes and instrumentation links
+
+    Call it before deleting the rows, see trash_pieces. The files
+    themselves are removed from FILES_DIR once the deletion is committed,
+    the blobs are kept by the trashes"""
+    file_ids = [file.id for file in files]
+    tables = [
+        (File.__table__, _dump_rows_by(File.__table__, File.__table__.c.id, file_ids)),
+        (Transpose.__table__, _dump_rows_by(Transpose.__table__, Transpose.__table__.c.file_id, file_ids)),
+        (instrumentations_files, _dump_rows_by(instrumentations_files, instrumentations_files.c.file_id, file_ids))
+    ]
+    return _add_trashes([("file", file.id, file.name, [{"table": table.name, "rows": rows.get(file.id, [])} for table, rows in tables], None)
+        for file in files])
+
+class RestoreConflict(Exception):
+    """The trash can not be restored, what it holds was replaced in the meantime"""
+
+def restore_trash(trash: Trash) -> None:
+    """Insert the rows of the trash again and move the files back
+
+    The references of the trash to the blobs go to the restored files.
+    Raise RestoreConflict if a piece or file with the same name or id was
+    created since, roll back then. Otherwise the rows are committed before
+    the files are moved, a failed commit leaves them in the trash"""
+    dumps = json.loads(trash.rows)
+    if trash.kind == "piece":
+        if not check_piece(Piece(name=trash.name)):
+            raise RestoreConflict(f"A piece named {trash.name} exists")
+    else:
+        instrumentation_ids = {row["instrumentation_id"] for dump in dumps if dump["table"] == instrumentations_files.name for row in dump["rows"]}
+        if Instrumentation.query.filter(Instrumentation.id.in_(instrumentation_ids)).count() != len(instrumentation_ids):
+            raise RestoreConflict("The piece of the file was deleted")
+    for dump in dumps:
+        table = db.metadata.tables[dump["table"]]
+        key = list(table.primary_key.columns)
+        if table is EventPiece.__table__:
+            # Places in events deleted since are dropped, the others are entries with new ids
+            events = {id for id, in db.session.query(Event.id).filter(Event.id.in_({row["event_id"] for row in dump["rows"]}))}
+            dump = {"table": dump["table"], "rows": [{name: value for name, value in row.items() if name != "id"}
+                for row in dump["rows"] if row["event_id"] in events]}
+        elif len(key) == 1 and dump["rows"] and \
+                db.session.execute(table.select().where(key[0].in_([row[key[0].name] for row in dump["rows"]]))).first() != None:
+            raise RestoreConflict(f"Ids of {table.name} were taken again")
+        _load_rows(dump)
+    kind, name, folder = trash.kind, trash.name, trash.folder
+    if kind == "file":
+        file = File.query.filter_by(id=trash.item_id).first()
+        if not check_file(file):
+            raise RestoreConflict(f"A file named {get_filename(file)} exists")
+        blob, path, piece, filename = file.blob, get_filepath(file), secure_filename(file.instrumentations[0].piece.name), get_filename(file)
+    db.session.delete(trash)
+    db.session.commit()
+    if kind == "piece":
+        if folder != None:
+            restore_piece_folder(name, folder)
+    elif has_files_mirror():
+        link_blob(blob, path)
+        get_file_index().add_file(piece, filename)
+    logger.info(f"Restore {kind} {name} from the trash")
+
+@job("purge_trash")
+def purge_trash(id: int) -> None:
+    """Remove the folder of the trash and release its blobs, at TRASH_PURGE_RATE files per second
+
+    Nothing is done if the trash was restored"""
+    trash = Trash.query.filter_by(id=id).first()
+    if trash == None:
+        return
+    if trash.folder != None:
+        remove_tree(trash.folder, Throttle(current_app.config["TRASH_PURGE_RATE"]))
+    add_blob_refs({blob_id: -count for blob_id, count in Counter(_blob_ids(json.loads(trash.rows))).items()})
+    db.session.delete(trash)
+    enqueue_job("purge_blobs", unique=True)
+    db.session.commit()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    Streaming upload helpers, uploaded parts are spooled to disk while they arrive
+"""
+
+import os, hashlib, tempfile
+from flask import Request, current_app
+
+CHUNK_SIZE = 1024 * 1024
+
+class HashingFile(object):
+    """Temporary file inside the storage folder which hashes everything written into it
+
+    The file is created next to its final destination so that committing it
+    is a single atomic rename instead of a second copy of the data.
+
+    :param path: take over the existing file at path instead, its content is
+        hashed once and it is not removed by close
+    """
+    def __init__(self, directory: str, path: str = None) -> None:
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+        self.temporary = path == None
+        if self.temporary:
+            fd, self.name = tempfile.mkstemp(prefix=".upload-", dir=directory)
+            self._file = os.fdopen(fd, "w+b")
+            return
+        self.name = path
+        self._file = open(path, "r+b")
+        while True:
+            chunk = self._file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self._hash.update(chunk)
+            self.size += len(chunk)
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        """Return the sha256 of everything written so far"""
+        return self._hash.hexdigest()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def commit(self, path: str) -> None:
+        """Flush the data to disk and atomically move the file to path"""
+        self._sync()
+        os.replace(self.name, path)
+        self.committed = True
+
+    def commit_into(self, storage, key: str) -> None:
+        """Flush the data to disk and move the file into the storage backend under key"""
+        self._sync()
+        storage.put_file(key, self.name)
+        self.committed = True
+
+    def close(self) -> None:
+        """Close the file, the temporary file is removed if it was never committed"""
+        if not self._file.closed:
+            self._file.close()
+        if self.temporary and not self.committed:
+            try:
+                os.remove(self.name)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+class UploadRequest(Request):
+    """Request class writing every uploaded file part straight into the blob store folder"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(current_app.config["BLOBS_DIR"])
+
+def spool(stream, directory: str) -> HashingFile:
+    """Return a HashingFile holding the content of stream
+
+    Streams that were already spooled by UploadRequest are returned as is,
+    anything else is copied chunk by chunk."""
+    if isinstance(stream, HashingFile):
+        return stream
+    spooled = HashingFile(directory)
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spooled.write(chunk)
+    except Exception:
+        spooled.close()
+        raise
+    return spooled
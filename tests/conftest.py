@@ -3,7 +3,9 @@
     Pytest config file
 """
 
-import pytest, os
+import pytest, os, sqlalchemy
+from contextlib import contextmanager
+from typing import Any, NamedTuple
 from sms import create_app
 from sms.database import db as original_db
 
@@ -25,8 +27,41 @@ def db(app, request):
             original_db.session.rollback()
             original_db.drop_all()
             original_db.session.close()
-            os.remove(os.path.join("sms", app.config['DB_FILE']))
+            original_db.get_engine(app).dispose()
+            if original_db.get_reader_engine(app) != None:
+                original_db.get_reader_engine(app).dispose()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(os.path.join("sms", app.config['DB_FILE'] + suffix)):
+                    os.remove(os.path.join("sms", app.config['DB_FILE'] + suffix))
 
     request.addfinalizer(fin)
     return original_db
 
+
+class Executed(NamedTuple):
+    """A statement sent to the database"""
+    statement: str
+    parameters: Any
+    executemany: bool
+
+    @property
+    def verb(self) -> str:
+        """SELECT, INSERT, UPDATE..."""
+        return self.statement.split()[0].upper()
+
+@pytest.fixture
+def count_statements():
+    """Fixture recording the statements sent to any engine, readers included, within a with block
+
+    with count_statements() as statements: ..., statements is a list of Executed"""
+    @contextmanager
+    def count():
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(Executed(statement, parameters, executemany))
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(sqlalchemy.engine.Engine, "before_cursor_execute", before_cursor_execute)
+    return count
@@ -3,7 +3,7 @@
     Database test suite
 """
 
-import pytest
+import pytest, sqlalchemy
 from flask import Flask
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
@@ -19,7 +19,9 @@ from sms.database import (
     Piece,
     Instrumentation,
     File,
-    Transpose
+    Transpose,
+    HashidCodec,
+    upgrade_everything
 )
 
 class TestModel:
@@ -124,6 +126,18 @@ class TestModel:
         assert test_file.type == 0
         assert test_file.hash_id == Hashids(app.config["SECRET_KEY"]).encode(test_file.id)
 
+    def test_hashid_codec(self, app:Flask) -> None:
+        codec = HashidCodec(app.config["SECRET_KEY"])
+        hashid = Hashids(app.config["SECRET_KEY"])
+        # Encoding is compatible with the stored hash ids
+        assert codec.encode(1) == hashid.encode(1)
+        assert codec.decode(hashid.encode(1)) == 1
+        assert codec.decode(hashid.encode(123456)) == 123456
+        # Invalid, multi id and non canonical hash ids are rejected
+        assert codec.decode("hash_id") == None
+        assert codec.decode(hashid.encode(1, 2)) == None
+        assert codec.decode("") == None
+
     def test_relationships(self, db:SQLAlchemy) -> None:
         dt = datetime.now()
         event_args = {
@@ -182,5 +196,58 @@ class TestModel:
         assert test_instrumentation.files[0] == file
         db.session.rollback()
 
+    def test_engine_profile(self, db:SQLAlchemy, app:Flask) -> None:
+        writer = db.get_engine(app)
+        reader = db.get_reader_engine(app)
+        assert reader != None and reader is not writer
+        with writer.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        with reader.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA query_only").scalar() == 1
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                connection.execute(Group.__table__.insert(), {"name": "test"})
+        # Reads go to the readers until the session writes
+        assert db.session.get_bind(clause=sqlalchemy.select(Group)) is reader
+        db.session.add(Group(name="test"))
+        db.session.flush()
+        assert db.session.get_bind(clause=sqlalchemy.select(Group)) is writer
+        assert Group.query.filter_by(name="test").one().id == 1
+        db.session.rollback()
+        assert db.session.get_bind(clause=sqlalchemy.select(Group)) is reader
+        assert Group.query.filter_by(name="test").first() == None
+
+    def test_upgrade_indexes(self, db:SQLAlchemy, app:Flask) -> None:
+        # A database created before the indexes
+        for name in ("ix_pieces_name", "ix_eventPiece_event_id", "ix_blobs_unreferenced"):
+            db.session.execute(f'DROP INDEX "{name}"')
+        # And one with an index dropped since
+        db.session.execute('CREATE INDEX "ix_files_hash_id" ON files (hash_id)')
+        db.session.commit()
+        upgrade_everything(db)
+        inspector = sqlalchemy.inspect(db.engine)
+        for table, name in (("pieces", "ix_pieces_name"), ("eventPiece", "ix_eventPiece_event_id"), ("blobs", "ix_blobs_unreferenced")):
+            assert name in {index["name"] for index in inspector.get_indexes(table)}
+        assert "ix_files_hash_id" not in {index["name"] for index in inspector.get_indexes("files")}
+
+    def test_upgrade_autoincrement(self, db:SQLAlchemy, app:Flask) -> None:
+        # A files table created before its ids were AUTOINCREMENT
+        sql = db.session.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'files'").scalar()
+        db.session.execute("DROP TABLE files")
+        db.session.execute(sql.replace("AUTOINCREMENT", ""))
+        db.session.execute("INSERT INTO files (id, hash_id, name, type) VALUES (1, '', 'test1', 0), (2, '', 'test2', 0)")
+        db.session.commit()
+        upgrade_everything(db)
+        inspector = sqlalchemy.inspect(db.engine)
+        assert "ix_files_blob_id" in {index["name"] for index in inspector.get_indexes("files")}
+        assert [file.name for file in File.query.order_by(File.id)] == ["test1", "test2"]
+        # The id of the deleted last file is not taken again
+        File.query.filter_by(id=2).delete()
+        db.session.add(File(name="test3", type=0))
+        db.session.commit()
+        assert File.query.filter_by(name="test3").one().id == 3
+        File.query.delete()
+        db.session.commit()
+
 if __name__ == "__main__":
     pytest.main()
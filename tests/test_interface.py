@@ -4,14 +4,17 @@
 """
 
 from io import BytesIO
-import pytest, json, os, shutil, re
-from datetime import datetime
+import pytest, json, os, shutil, re, gzip, hashlib, zipfile, time, threading, sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from _pytest.fixtures import SubRequest
 from flask import Flask, url_for
 from flask.testing import FlaskClient
 from flask_sqlalchemy import SQLAlchemy
+from hashids import Hashids
 
 from sms.database import (
+    place_event_piece,
     Group,
     Part,
     Instrument,
@@ -20,8 +23,14 @@ from sms.database import (
     Piece,
     Instrumentation,
     File,
-    Transpose
+    Transpose,
+    Job,
+    UploadSession,
+    Trash,
+    Blob
 )
+from sms.utils.upload import CHUNK_SIZE
+from sms.utils import S3Backend, scrub_storage, get_stagingpath, get_blobpath, get_shard, shard_files, JOB_HANDLERS, job, enqueue_job, run_jobs, save_files, get_thumbnailer
 
 class TestInfo:
     @pytest.fixture(scope="function", autouse=True)
@@ -44,6 +53,23 @@ class TestInfo:
         assert "test" in str(json.loads(response.data)["parts"])
         assert "test" in str(json.loads(response.data)["instruments"])
 
+    def test_etag(self, client:FlaskClient, db:SQLAlchemy, count_statements):
+        response = client.get(url_for("infoApi.all"))
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert client.get(url_for("infoApi.all"), headers={"If-None-Match": etag}).status_code == 304
+        # Served from the cache, without loading the pieces and events of the groups either way
+        with count_statements() as statements:
+            response = client.get(url_for("infoApi.all"))
+            assert response.status_code == 200 and response.headers["ETag"] == etag
+            assert len(statements) == 1
+            db.session.add(Instrument(name="new", part_id=1))
+            db.session.flush()
+            response = client.get(url_for("infoApi.all"), headers={"If-None-Match": etag})
+        assert not [executed for executed in statements if re.search(r"\b(pieces|events)\b", executed.statement)]
+        assert response.status_code == 200 and response.headers["ETag"] != etag
+        assert "new" in [instrument["name"] for instrument in json.loads(response.data)["instruments"]]
+
 class TestEvent:
     @pytest.fixture(scope="function", autouse=True)
     def prepare_db(self, db:SQLAlchemy, request:SubRequest):
@@ -131,6 +157,49 @@ class TestEvent:
         assert response.status_code == 204
         assert response.data.decode() == ""
 
+    def test_patch_pieces(self, client:FlaskClient, db:SQLAlchemy, monkeypatch:pytest.MonkeyPatch, count_statements):
+        db.session.add_all([Piece(name="test2"), Piece(name="test3")])
+        db.session.commit()
+        def patch(operations, id=1):
+            response = client.patch(url_for("eventsApi.pieces", id=id), json=operations)
+            return response.status_code, json.loads(response.data)
+        def setlist(event):
+            return [(entry["id"], entry["piece_id"]) for entry in event["pieces"]]
+        status, event = patch([{"op": "insert", "piece_id": 2}, {"op": "insert", "piece_id": 3, "after": 1}])
+        assert status == 200
+        assert setlist(event) == [(1, 1), (3, 3), (2, 2)]
+        # A move only writes the moved entry
+        with count_statements() as statements:
+            status, event = patch([{"op": "move", "id": 2, "before": 1}])
+        assert status == 200
+        assert setlist(event) == [(2, 2), (1, 1), (3, 3)]
+        assert [executed.verb for executed in statements if executed.verb != "SELECT"] == ["UPDATE"]
+        status, event = patch([{"op": "remove", "id": 1}, {"op": "move", "id": 2}])
+        assert setlist(event) == [(3, 3), (2, 2)]
+        # Orders without room between them are spread apart first
+        response = client.post(url_for("eventsApi.all"), json={"name": "test2", "pieces": [{"id": 1, "order": 1}, {"id": 2, "order": 2}]})
+        assert response.status_code == 201
+        status, event = patch([{"op": "insert", "piece_id": 3, "after": 4}], id=2)
+        assert setlist(event) == [(4, 1), (6, 3), (5, 2)]
+        assert [entry["order"] for entry in event["pieces"]] == [1024, 1536, 2048]
+        assert patch([{"op": "move", "id": 1}])[0] == 404
+        assert patch([{"op": "insert", "piece_id": 9}])[0] == 404
+        assert patch([{"op": "move", "id": 2, "after": 3, "before": 3}])[0] == 422
+        assert patch([{"op": "insert"}])[0] == 422
+        assert patch([{"op": "remove"}], id=3)[0] == 422
+        assert patch([], id=3)[0] == 404
+        # Another librarian places an entry at the same order in the meantime
+        place = place_event_piece
+        def concurrent_place(entry, after=None, before=None):
+            place(entry, after, before)
+            with db.get_engine().begin() as connection:
+                connection.execute(EventPiece.__table__.insert(), {"event_id": 1, "piece_id": 1, "order": entry.order})
+        monkeypatch.setattr("sms.interface.events.place_event_piece", concurrent_place)
+        status, error = patch([{"op": "insert", "piece_id": 1, "after": 3}])
+        assert status == 409
+        monkeypatch.undo()
+        assert len(json.loads(client.get(url_for("eventsApi.byid", id=1)).data)["pieces"]) == 3
+
 dt = datetime.now()
 
 class TestPiece:
@@ -153,7 +222,7 @@ class TestPiece:
             db.session.commit()
         request.addfinalizer(fin)
 
-    def test_post_delete(self, client:FlaskClient):
+    def test_post_delete(self, client:FlaskClient, app:Flask, db:SQLAlchemy, monkeypatch:pytest.MonkeyPatch):
         # Test post
         data = {
             "name": "test",
@@ -185,9 +254,42 @@ class TestPiece:
         }
         response = client.delete(url_for('piecesApi.all'), json=[data])
         assert response.status_code == 204
+        # The folder is kept in the trash until it is purged
+        assert not os.listdir(app.config["FILES_DIR"])
+        assert len(os.listdir(app.config["TRASH_DIR"])) == 1
         response = client.get(url_for("piecesApi.all"))
         assert response.status_code == 200
         assert str(json.loads(response.data)) == "[]"
+        response = client.get(url_for("trashApi.all"), query_string={"limit": 1})
+        assert response.status_code == 200
+        assert "X-Next-Cursor" not in response.headers
+        trash = json.loads(response.data)
+        assert [(item["kind"], item["item_id"], item["name"]) for item in trash] == [("piece", 1, "test")]
+        # The folder is only moved back once the rows are committed
+        def commit():
+            raise sqlalchemy.exc.OperationalError("COMMIT", {}, None)
+        with monkeypatch.context() as m:
+            m.setattr(db.session, "commit", commit)
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                client.post(url_for("trashApi.restore", id=trash[0]["id"]))
+        db.session.rollback()
+        assert len(os.listdir(app.config["TRASH_DIR"])) == 1
+        response = client.post(url_for("trashApi.restore", id=trash[0]["id"]))
+        assert response.status_code == 204
+        assert not os.listdir(app.config["TRASH_DIR"])
+        assert os.listdir(app.config["FILES_DIR"])
+        response = client.get(url_for("piecesApi.byid", id=1))
+        assert response.status_code == 200
+        assert json.loads(response.data)["instrumentations"][0]["instrument"] == 1
+        assert client.post(url_for("trashApi.restore", id=trash[0]["id"])).status_code == 404
+        response = client.delete(url_for('piecesApi.all'), json=[data])
+        assert response.status_code == 204
+        # Purged right away instead of after TRASH_RETENTION
+        trash = json.loads(client.get(url_for("trashApi.all")).data)
+        response = client.delete(url_for("trashApi.byid", id=trash[0]["id"]))
+        assert response.status_code == 202
+        assert not os.listdir(app.config["TRASH_DIR"])
+        assert json.loads(client.get(url_for("trashApi.all")).data) == []
         data = {
             "name": "test",
             "author": "test_author",
@@ -207,6 +309,84 @@ class TestPiece:
         assert response.status_code == 204
         assert response.data.decode() == ""
 
+    def test_search(self, client:FlaskClient):
+        pieces = [
+            ("Symphony No. 9", "Antonín Dvořák", None),
+            ("Slavonic Dances", "Antonín Dvořák", None),
+            ("Dvorak Medley", "Someone Else", "Dvořák fan")
+        ]
+        for name, author, arranger in pieces:
+            data = {"name": name, "author": author, "group_ids": []}
+            if arranger:
+                data["arranger"] = arranger
+            response = client.post(url_for('piecesApi.all'), json=data)
+            assert response.status_code == 201
+        response = client.get(url_for("piecesApi.search"), query_string={"q": "dvor"})
+        assert response.status_code == 200
+        results = json.loads(response.data)
+        # A match in the name ranks first
+        assert results[0]["piece"]["name"] == "Dvorak Medley"
+        assert sorted(result["piece"]["name"] for result in results) == sorted(name for name, _, _ in pieces)
+        assert results[0]["score"] >= results[1]["score"]
+        assert "<mark>Dvorak</mark>" in results[0]["snippet"]
+        response = client.get(url_for("piecesApi.search"), query_string={"q": "antonin SYM"})
+        results = json.loads(response.data)
+        assert [result["piece"]["name"] for result in results] == ["Symphony No. 9"]
+        assert results[0]["piece"]["author"] == "Antonín Dvořák"
+        response = client.get(url_for("piecesApi.search"), query_string={"q": "dvor", "limit": 1})
+        assert [result["piece"]["name"] for result in json.loads(response.data)] == ["Dvorak Medley"]
+        # Kept in sync with updates and deletes
+        response = client.put(url_for('piecesApi.all'), json={"id": 1, "name": "New World", "author": "Antonín Dvořák", "group_ids": []})
+        assert response.status_code == 204
+        assert json.loads(client.get(url_for("piecesApi.search"), query_string={"q": "symphony"}).data) == []
+        response = client.get(url_for("piecesApi.search"), query_string={"q": "new wor"})
+        assert [result["piece"]["id"] for result in json.loads(response.data)] == [1]
+        assert client.delete(url_for("piecesApi.byid", id=2)).status_code == 204
+        assert len(json.loads(client.get(url_for("piecesApi.search"), query_string={"q": "dvořák"}).data)) == 2
+        # FTS5 syntax is not passed through
+        assert json.loads(client.get(url_for("piecesApi.search"), query_string={"q": '" OR *'}).data) == []
+        assert client.get(url_for("piecesApi.search")).status_code == 422
+
+    def test_import(self, client:FlaskClient, app:Flask, db:SQLAlchemy):
+        catalog = "\n".join([
+            "name,author,opus,copyright_expire_date,group_ids,instrument_ids",
+            "Symphony No. 1,Brahms,68,2030-01-01,1;2,1",
+            "Symphony No. 2,Brahms,73,,1,",
+            "Unknown,Nobody,,,3,1",
+            "Symphony No. 1,Again,,,,",
+            "Bad opus,Nobody,x,,,"
+        ])
+        response = client.post(url_for("piecesApi.import"), data=catalog, content_type="text/csv")
+        assert response.status_code == 200
+        report = json.loads(response.data)
+        assert (report["rows"], report["imported"]) == (5, 2)
+        assert [(error["line"], list(error["messages"])) for error in report["errors"]] == [(4, ["group_ids"]), (5, ["name"]), (6, ["opus"])]
+        piece = json.loads(client.get(url_for("piecesApi.byid", id=1)).data)
+        assert (piece["name"], piece["opus"], piece["copyright_expire_date"], piece["type"]) == ("Symphony No. 1", 68, "2030-01-01", 0)
+        assert [instrumentation["instrument"] for instrumentation in piece["instrumentations"]] == [1]
+        assert [group.id for group in Piece.query.get(1).groups] == [1, 2]
+        assert len(Piece.query.get(2).instrumentations) == 0
+        assert len(os.listdir(app.config["FILES_DIR"])) >= 1
+        # The new pieces are searchable
+        assert len(json.loads(client.get(url_for("piecesApi.search"), query_string={"q": "brahms"}).data)) == 2
+        catalog = "\n".join([
+            json.dumps({"name": "Requiem", "group_ids": [2], "instrumentations": [{"instrument_id": 1}]}),
+            "",
+            "not json",
+            json.dumps({"name": "Requiem", "group_ids": []})
+        ])
+        response = client.post(url_for("piecesApi.import"), data=catalog, content_type="application/x-ndjson")
+        report = json.loads(response.data)
+        assert (report["rows"], report["imported"]) == (3, 1)
+        assert [error["line"] for error in report["errors"]] == [3, 4]
+        assert Piece.query.filter_by(name="Requiem").one().groups[0].id == 2
+        result = app.test_cli_runner().invoke(args=["pieces", "import", "-", "--format", "ndjson"],
+            input=json.dumps({"name": "Ein deutsches Requiem", "group_ids": [1]}))
+        assert result.exit_code == 0
+        assert "Imported 1 of 1 pieces" in result.output
+        response = client.delete(url_for("piecesApi.all"), json=[{"id": id} for id in range(1, 5)])
+        assert response.status_code == 204
+
     def test_get_put(self, client:FlaskClient):
         data = {
             "name": "test",
@@ -278,10 +458,14 @@ class TestFile:
         db.session.commit()
         os.mkdir(os.path.join(app.config["FILES_DIR"], "test"))
         def fin():
+            db.session.rollback()
             db.drop_all()
             db.create_all()
             db.session.commit()
-            shutil.rmtree(os.path.join(app.config["FILES_DIR"], "test"))
+            # Blobs of deleted files are kept by the trash
+            for directory in ("FILES_DIR", "BLOBS_DIR", "TRASH_DIR"):
+                for name in os.listdir(app.config[directory]):
+                    shutil.rmtree(os.path.join(app.config[directory], name))
         request.addfinalizer(fin)
 
     def test_post_delete(self, client:FlaskClient):
@@ -388,5 +572,865 @@ class TestFile:
         response = client.put(url_for("filesApi.byid", hash_id="hash_id"))
         assert response.status_code == 403
 
+    def test_bulk_post(self, client:FlaskClient, db:SQLAlchemy, app:Flask, monkeypatch:pytest.MonkeyPatch, count_statements):
+        def upload(names):
+            data = {
+                "data": json.dumps([{
+                    "instrumentation_ids": [1, 2],
+                    "name": name,
+                    "type": 0,
+                    "transpose": {
+                        "instrument_id": 2
+                    }
+                } for name in names]),
+                "files[]": [(BytesIO(name.encode()), 'temp.test') for name in names]
+            }
+            return client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+
+        commits = []
+        def commit(conn):
+            commits.append(conn)
+        sqlalchemy.event.listen(db.engine, "commit", commit)
+        try:
+            with count_statements() as statements:
+                response = upload([f"test{i}" for i in range(10)])
+        finally:
+            sqlalchemy.event.remove(db.engine, "commit", commit)
+        assert response.status_code == 201
+        assert [file["name"] for file in json.loads(response.data)] == [f"test{i}" for i in range(10)]
+        # A short write per new blob, then all rows at once
+        assert len(commits) == 11
+        # Ids are assigned by SQLite, the hash ids are stored afterwards with one UPDATE
+        assert [executed.executemany for executed in statements if executed.statement.startswith("UPDATE files")] == [True]
+        assert len([executed for executed in statements if executed.statement.startswith("INSERT INTO files")]) == 10
+        assert [executed.executemany for executed in statements if executed.statement.startswith('INSERT INTO "instrumentationsFiles"')] == [True]
+        for file in File.query.all():
+            assert file.hash_id == Hashids(app.config["SECRET_KEY"]).encode(file.id)
+            assert len(file.instrumentations) == 2
+
+        # A failing file rolls back the whole request
+        response = upload(["test10", "test11", "test0"])
+        assert response.status_code == 409
+        assert File.query.count() == 10
+        assert Transpose.query.count() == 10
+        assert sorted(os.listdir(os.path.join(app.config["FILES_DIR"], "test"))) == sorted(f"{file.name}_0_{file.hash_id}.test" for file in File.query.all())
+        assert not os.path.exists(get_blobpath(hashlib.sha256(b"test10").hexdigest()))
+        response = upload(["test10", "test11"])
+        assert response.status_code == 201
+        assert File.query.count() == 12
+
+        # A file inserted while the contents are stored does not conflict with the upload
+        def concurrent_save(infos, files):
+            saved = save_files(infos, files)
+            db.session.execute(File.__table__.insert().values(hash_id="", name="concurrent", type=0))
+            return saved
+        monkeypatch.setattr("sms.interface.files.save_files", concurrent_save)
+        response = upload(["test12"])
+        assert response.status_code == 201
+        File.query.filter_by(name="concurrent").delete()
+        db.session.commit()
+
+        for file in File.query.all():
+            response = client.delete(url_for("filesApi.byid", hash_id=file.hash_id))
+            assert response.status_code == 204
+
+    def test_archive(self, client:FlaskClient, db:SQLAlchemy):
+        contents = {"test1": (b"%PDF" * 100, "pdf"), "test2": (b"<score-partwise/>" * 100, "musicxml")}
+        for name, (content, format) in contents.items():
+            data = {
+                "data": f'''[{{
+                    "instrumentation_ids": [1],
+                    "name": "{name}",
+                    "type": 0
+                }}]''',
+                "files[]": [(BytesIO(content), f'temp.{format}')]
+            }
+            response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+            assert response.status_code == 201
+        hash_ids = {file["name"]: file["hash_id"] for file in json.loads(client.get(url_for("filesApi.all")).data)}
+
+        response = client.get(url_for("piecesApi.archive", id=1))
+        assert response.status_code == 200
+        assert response.mimetype == "application/zip"
+        assert response.headers["Content-Disposition"] == 'attachment; filename="test.zip"'
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            assert archive.testzip() == None
+            for name, (content, format) in contents.items():
+                info = archive.getinfo(f"test/{name}_0_{hash_ids[name]}.{format}")
+                assert info.compress_type == (zipfile.ZIP_STORED if format == "pdf" else zipfile.ZIP_DEFLATED)
+                assert archive.read(info) == content
+
+        event = Event(name="concert")
+        event.events_pieces.append(EventPiece(order=1, piece_id=1))
+        db.session.add(event)
+        db.session.commit()
+        response = client.get(url_for("eventsApi.archive", id=event.id))
+        assert response.status_code == 200
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            assert sorted(archive.namelist()) == [f"01_test/{name}_0_{hash_ids[name]}.{format}" for name, (content, format) in contents.items()]
+
+        response = client.get(url_for("piecesApi.archive", id=2))
+        assert response.status_code == 404
+        response = client.get(url_for("eventsApi.archive", id=event.id + 1))
+        assert response.status_code == 404
+        for hash_id in hash_ids.values():
+            response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 204
+
+    def test_download(self, client:FlaskClient, app:Flask):
+        content = b"0123456789" * 100
+        data = {
+            "data": '''[{
+                "instrumentation_ids": [1],
+                "name": "test",
+                "type": 0
+            }]''',
+            "files[]": [(BytesIO(content), 'temp.test')]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_id = json.loads(response.data)[0]["hash_id"]
+        etag = hashlib.sha256(content).hexdigest()
+
+        # Strong ETag and conditional requests
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id))
+        assert response.status_code == 200
+        assert response.get_etag() == (etag, False)
+        assert response.data == content
+        last_modified = response.headers["Last-Modified"]
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id), headers={"If-None-Match": f'"{etag}"'})
+        assert response.status_code == 304
+        assert response.data == b""
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id), headers={"If-Modified-Since": last_modified})
+        assert response.status_code == 304
+
+        # Range requests
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id), headers={"Range": "bytes=10-19"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 10-19/{len(content)}"
+        assert response.data == content[10:20]
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id), headers={"Range": "bytes=10-19", "If-Range": '"outdated"'})
+        assert response.status_code == 200
+        assert response.data == content
+        response = None
+
+        # Offload to the front proxy
+        app.config["SENDFILE_MODE"] = "x-accel-redirect"
+        try:
+            response = client.get(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 200
+            assert response.data == b""
+            assert response.headers["X-Accel-Redirect"] == f"/protected/files/test/test_0_{hash_id}.test"
+            assert "X-Sendfile" not in response.headers
+            response = client.get(url_for("filesApi.byid", hash_id=hash_id), headers={"If-None-Match": f'"{etag}"'})
+            assert response.status_code == 304
+            app.config["SENDFILE_MODE"] = "x-sendfile"
+            response = client.get(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.headers["X-Sendfile"] == os.path.abspath(os.path.join(app.config["FILES_DIR"], "test", f"test_0_{hash_id}.test"))
+        finally:
+            app.config["SENDFILE_MODE"] = None
+
+        # The piece folder, created in the flat layout, is moved while serving
+        assert shard_files(app.config["FILES_DIR"]) == 1
+        assert not os.path.exists(os.path.join(app.config["FILES_DIR"], "test"))
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id))
+        assert response.status_code == 200
+        assert response.data == content
+        response = None
+
+        response = client.get(url_for("filesApi.byid", hash_id="not_a_hash_id"))
+        assert response.status_code == 404
+        response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+        assert response.status_code == 204
+        assert not os.listdir(os.path.join(app.config["FILES_DIR"], get_shard("test")))
+
+    def test_thumbnail(self, client:FlaskClient, app:Flask, monkeypatch:pytest.MonkeyPatch):
+        Image = pytest.importorskip("PIL.Image")
+        pymupdf = pytest.importorskip("pymupdf")
+        image = BytesIO()
+        Image.new("RGB", (2000, 1000), "white").save(image, "PNG")
+        document = pymupdf.open()
+        document.new_page(width=595, height=842)
+        pdf = BytesIO(document.tobytes())
+        data = {
+            "data": json.dumps([{"instrumentation_ids": [1], "name": name, "type": 0} for name in ("image", "score", "text")]),
+            "files[]": [(BytesIO(image.getvalue()), 'temp.png'), (pdf, 'temp.pdf'), (BytesIO(b"test"), 'temp.txt')]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_ids = {file["name"]: file["hash_id"] for file in json.loads(response.data)}
+
+        # Rendered after the upload, next to the blob
+        for file in File.query.filter(File.format != "txt"):
+            assert os.path.exists(get_blobpath(file.blob.sha256) + ".thumbnail.png")
+            assert os.path.exists(get_blobpath(file.blob.sha256) + ".preview.png")
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["image"]))
+        assert response.status_code == 200
+        assert response.mimetype == "image/png"
+        assert Image.open(BytesIO(response.data)).size == (256, 128)
+        etag = response.get_etag()[0]
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["image"]), headers={"If-None-Match": f'"{etag}"'})
+        assert response.status_code == 304
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["score"]), query_string={"kind": "preview"})
+        assert response.status_code == 200
+        assert max(Image.open(BytesIO(response.data)).size) == 1024
+        # Rendered again once removed
+        os.remove(get_blobpath(File.query.filter_by(name="score").one().blob.sha256) + ".thumbnail.png")
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["score"]))
+        assert response.status_code == 200
+        assert max(Image.open(BytesIO(response.data)).size) == 256
+        # With workers, requests do not wait for the rendering
+        executor, rendering = ThreadPoolExecutor(1), threading.Event()
+        executor.submit(rendering.wait)
+        monkeypatch.setattr(get_thumbnailer(), "_executor", executor)
+        os.remove(get_blobpath(File.query.filter_by(name="score").one().blob.sha256) + ".thumbnail.png")
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["score"]))
+        assert response.status_code == 202
+        rendering.set()
+        executor.shutdown(wait=True)
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["score"]))
+        assert response.status_code == 200
+        response = None
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["text"]))
+        assert response.status_code == 404
+        response = client.get(url_for("filesApi.thumbnail", hash_id=hash_ids["image"]), query_string={"kind": "poster"})
+        assert response.status_code == 422
+
+        sha256s = [file.blob.sha256 for file in File.query.all()]
+        for hash_id in hash_ids.values():
+            response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 204
+        for trash in Trash.query.all():
+            response = client.delete(url_for("trashApi.byid", id=trash.id))
+            assert response.status_code == 202
+        for sha256 in sha256s:
+            assert not os.path.exists(get_blobpath(sha256) + ".thumbnail.png")
+
+    def test_unstored_hash_id(self, client:FlaskClient, app:Flask):
+        """Hash ids are decoded to the id, so they work without being stored"""
+        data = {
+            "data": '''[{
+                "instrumentation_ids": [1],
+                "name": "test",
+                "type": 0
+            }]''',
+            "files[]": [(BytesIO(b"test"), 'temp.test')]
+        }
+        app.config["STORE_HASH_ID"] = False
+        try:
+            response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+            assert response.status_code == 201
+            hash_id = json.loads(response.data)[0]["hash_id"]
+            file = File.query.one()
+            assert file.hash_id == ""
+            assert hash_id == Hashids(app.config["SECRET_KEY"]).encode(file.id)
+            response = client.get(url_for("filesApi.all"), query_string={"hash_id": hash_id})
+            assert [file["hash_id"] for file in json.loads(response.data)] == [hash_id]
+            response = client.get(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 200
+            assert response.data == b"test"
+            response = None
+            response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 204
+        finally:
+            app.config["STORE_HASH_ID"] = True
+
+    def test_list_queries(self, client:FlaskClient, db:SQLAlchemy, count_statements):
+        """Lists cost the same number of queries whatever their length"""
+        def upload(start, count):
+            data = {
+                "data": json.dumps([{
+                    "instrumentation_ids": [1, 2],
+                    "name": f"test{i}",
+                    "type": 0,
+                    "transpose": {"instrument_id": 2}
+                } for i in range(start, start + count)]),
+                "files[]": [(BytesIO(f"test{i}".encode()), f"temp{i}.test") for i in range(start, start + count)]
+            }
+            response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+            assert response.status_code == 201
+        def count_queries(url):
+            # Reads go through the read-only pool, counted too
+            with count_statements() as statements:
+                db.session.expunge_all()
+                response = client.get(url)
+                assert response.status_code == 200
+            return len(statements), json.loads(response.data)
+        upload(0, 1)
+        files_queries, files = count_queries(url_for("filesApi.all"))
+        pieces_queries, pieces = count_queries(url_for("piecesApi.all"))
+        assert len(files) == 1 and len(pieces[0]["instrumentations"][0]["files"]) == 1
+        upload(1, 5)
+        queries, files = count_queries(url_for("filesApi.all"))
+        assert len(files) == 6 and files[-1]["transpose"]["instrument"] == "test2"
+        assert queries == files_queries
+        queries, pieces = count_queries(url_for("piecesApi.all"))
+        assert [len(instrumentation["files"]) for instrumentation in pieces[0]["instrumentations"]] == [6, 6]
+        assert queries == pieces_queries
+
+    def test_export(self, client:FlaskClient, app:Flask, db:SQLAlchemy):
+        """The whole catalog is streamed as NDJSON"""
+        data = {
+            "data": json.dumps([{
+                "instrumentation_ids": [1, 2],
+                "name": "score",
+                "type": 0,
+                "transpose": {"instrument_id": 2}
+            }]),
+            "files[]": [(BytesIO(b"score"), "temp.test")]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_id = json.loads(response.data)[0]["hash_id"]
+        for name in ("test2", "test3"):
+            assert client.post(url_for("piecesApi.all"), json={"name": name, "group_ids": []}).status_code == 201
+        response = client.post(url_for("eventsApi.all"), json={"name": "concert", "pieces": [{"id": 1, "order": 1}]})
+        assert response.status_code == 201
+        db.session.expunge_all()
+        batch_size = app.config["EXPORT_BATCH_SIZE"]
+        app.config["EXPORT_BATCH_SIZE"] = 2
+        try:
+            response = client.get(url_for("exportApi.all"))
+            assert response.status_code == 200
+            assert response.is_streamed and response.mimetype == "application/x-ndjson"
+            lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        finally:
+            app.config["EXPORT_BATCH_SIZE"] = batch_size
+        assert [list(line)[0] for line in lines] == ["piece", "piece", "piece", "event"]
+        piece = lines[0]["piece"]
+        assert [piece["name"] for piece in (line["piece"] for line in lines[:3])] == ["test", "test2", "test3"]
+        assert [instrumentation["instrument_id"] for instrumentation in piece["instrumentations"]] == [1, 2]
+        file = piece["instrumentations"][0]["files"][0]
+        assert (file["hash_id"], file["name"], file["transpose"]["instrument"]) == (hash_id, "score", "test2")
+        assert [(event["event_id"], event["order"]) for event in piece["events"]] == [(1, 1)]
+        assert lines[1]["piece"]["instrumentations"] == [] and lines[1]["piece"]["events"] == []
+        assert lines[3]["event"]["name"] == "concert" and lines[3]["event"]["pieces"][0]["piece_id"] == 1
+        assert client.delete(url_for("eventsApi.byid", id=1)).status_code == 204
+
+    def test_pagination(self, client:FlaskClient):
+        """Lists are followed page by page with the next cursor"""
+        names = [f"test{i}" for i in range(5)]
+        data = {
+            "data": json.dumps([{
+                "instrumentation_ids": [1],
+                "name": name,
+                "type": 0
+            } for name in names]),
+            "files[]": [(BytesIO(name.encode()), 'temp.test') for name in names]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        response = client.get(url_for("filesApi.all"), query_string={"limit": 2, "count": "true"})
+        assert response.status_code == 200
+        assert response.headers["X-Total-Count"] == "5"
+        pages = [[file["name"] for file in json.loads(response.data)]]
+        while "X-Next-Cursor" in response.headers:
+            assert response.headers["Link"].endswith('>; rel="next"')
+            response = client.get(url_for("filesApi.all"), query_string={"limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+            assert response.status_code == 200
+            assert "X-Total-Count" not in response.headers
+            pages.append([file["name"] for file in json.loads(response.data)])
+        assert pages == [names[0:2], names[2:4], names[4:5]]
+        # Filters apply to every page
+        response = client.get(url_for("filesApi.all"), query_string={"limit": 1, "name": "test3", "count": "true"})
+        assert [file["name"] for file in json.loads(response.data)] == ["test3"]
+        assert response.headers["X-Total-Count"] == "1" and "X-Next-Cursor" not in response.headers
+        assert client.get(url_for("filesApi.all"), query_string={"cursor": "garbage"}).status_code == 422
+        assert client.get(url_for("filesApi.all"), query_string={"limit": 0}).status_code == 422
+
+    def test_query_plans(self, client:FlaskClient, db:SQLAlchemy, count_statements):
+        """No query issued by the api scans a whole table to filter it"""
+        with count_statements() as executed:
+            data = {
+                "data": json.dumps([{
+                    "instrumentation_ids": [1, 2],
+                    "name": name,
+                    "type": 0,
+                    "transpose": {"instrument_id": 2}
+                } for name in ("score", "part")]),
+                "files[]": [(BytesIO(name.encode()), 'temp.test') for name in ("score", "part")]
+            }
+            response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+            assert response.status_code == 201
+            hash_id = json.loads(response.data)[0]["hash_id"]
+            response = client.post(url_for("eventsApi.all"), json={"name": "concert", "pieces": [{"id": 1, "order": 1}]})
+            assert response.status_code == 201
+            gets = [
+                (url_for("infoApi.all"), {}),
+                (url_for("piecesApi.all"), {"count": "true"}),
+                (url_for("piecesApi.all"), {"cursor": "MQ", "limit": 1}),
+                *[(url_for("piecesApi.all"), {key: value}) for key, value in {"name": "test", "author": "a", "lyricist": "l", "arranger": "a",
+                    "opus": 1, "type": 0, "copyright_expire_date": "2030-01-01", "created_time": "2030-01-01T00:00:00"}.items()],
+                (url_for("piecesApi.byid", id=1), {}),
+                (url_for("piecesApi.search"), {"q": "test"}),
+                (url_for("filesApi.all"), {"count": "true"}),
+                (url_for("filesApi.all"), {"hash_id": hash_id}),
+                *[(url_for("filesApi.all"), {key: value}) for key, value in {"name": "score", "format": "test", "type": 0}.items()],
+                (url_for("filesApi.byid", hash_id=hash_id), {}),
+                (url_for("eventsApi.all"), {"name": "concert"}),
+                (url_for("eventsApi.byid", id=1), {}),
+                (url_for("jobsApi.all"), {"status": "pending"}),
+                (url_for("jobsApi.all"), {"name": "test"}),
+                (url_for("trashApi.all"), {"kind": "file"})
+            ]
+            for url, query_string in gets:
+                response = client.get(url, query_string=query_string)
+                assert response.status_code == 200, url
+            response = None
+            assert client.delete(url_for("filesApi.byid", hash_id=hash_id)).status_code == 204
+            trash = json.loads(client.get(url_for("trashApi.all")).data)[0]
+            assert client.post(url_for("trashApi.restore", id=trash["id"])).status_code == 204
+            assert client.delete(url_for("eventsApi.byid", id=1)).status_code == 204
+            assert client.delete(url_for("piecesApi.byid", id=1)).status_code == 204
+            trash = json.loads(client.get(url_for("trashApi.all")).data)[0]
+            assert client.delete(url_for("trashApi.byid", id=trash["id"])).status_code == 202
+            run_jobs()
+        statements = [(select.statement, select.parameters) for select in executed if select.verb == "SELECT" and not select.executemany]
+
+        tables = set(db.metadata.tables)
+        # Scanning a partial index only reads the rows it is about
+        partial = {index.name for table in db.metadata.tables.values() for index in table.indexes if index.dialect_options["sqlite"]["where"] is not None}
+        scans = set()
+        with db.engine.connect() as connection:
+            for statement, parameters in statements:
+                # Whole lists are read in pages, only filtered reads have to be searches
+                if not re.search(r"\bWHERE\b", statement):
+                    continue
+                for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+                    detail = row[-1]
+                    words = detail.split()
+                    # Tables joined twice are aliased like transposes_1
+                    if "AUTOMATIC" in detail or (words[0] == "SCAN" and re.sub(r"_\d+$", "", words[1]) in tables and words[-1] not in partial):
+                        scans.add((detail, statement))
+        assert not scans
+
+    def test_trash(self, client:FlaskClient, app:Flask, db:SQLAlchemy):
+        """Deleted files are restored from the trash until it is purged"""
+        data = {
+            "data": '''[{
+                "instrumentation_ids": [1],
+                "name": "test",
+                "type": 0
+            }]''',
+            "files[]": [(BytesIO(b"trash"), 'temp.test')]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_id = json.loads(response.data)[0]["hash_id"]
+        blobpath = get_blobpath(hashlib.sha256(b"trash").hexdigest())
+        response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+        assert response.status_code == 204
+        assert client.get(url_for("filesApi.byid", hash_id=hash_id)).status_code == 404
+        assert os.path.isfile(blobpath)
+        trash = json.loads(client.get(url_for("trashApi.all"), query_string={"kind": "file"}).data)
+        assert [(item["name"], item["hash_id"]) for item in trash] == [("test", hash_id)]
+        response = client.post(url_for("trashApi.restore", id=trash[0]["id"]))
+        assert response.status_code == 204
+        response = client.get(url_for("filesApi.byid", hash_id=hash_id))
+        assert response.status_code == 200
+        assert response.data == b"trash"
+        response = None
+        assert json.loads(client.get(url_for("trashApi.all")).data) == []
+
+        response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+        assert response.status_code == 204
+        # Purged once TRASH_RETENTION is over, the purge of the restored trash does nothing
+        for job in Job.query.filter_by(name="purge_trash", status="pending"):
+            job.run_after = datetime.now()
+        db.session.commit()
+        run_jobs()
+        assert not os.path.exists(blobpath)
+        assert json.loads(client.get(url_for("trashApi.all")).data) == []
+        assert client.post(url_for("trashApi.restore", id=trash[0]["id"] + 1)).status_code == 404
+
+    def test_bulk_delete(self, client:FlaskClient, app:Flask, db:SQLAlchemy, count_statements):
+        """Pieces, events and files are deleted with a statement per table, whatever their number"""
+        names = [f"test{i}" for i in range(4)]
+        data = {
+            "data": json.dumps([{
+                "instrumentation_ids": [1, 2],
+                "name": name,
+                "type": 0,
+                "transpose": {"instrument_id": 2}
+            } for name in names]),
+            "files[]": [(BytesIO(name.encode()), 'temp.test') for name in names]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_ids = [file["hash_id"] for file in json.loads(response.data)]
+        for name in ("piece2", "piece3", "piece4"):
+            assert client.post(url_for("piecesApi.all"), json={"name": name, "group_ids": []}).status_code == 201
+        response = client.post(url_for("eventsApi.all"), json={"name": "concert", "pieces": [{"id": 1, "order": 1}, {"id": 2, "order": 2}]})
+        assert response.status_code == 201
+        def delete_statements(url, ids):
+            with count_statements() as statements:
+                response = client.delete(url, json=ids)
+                assert response.status_code == 204
+            # One trash and one purge job are inserted per item
+            return [executed.verb for executed in statements if executed.verb != "INSERT"]
+        # Nothing is deleted if one of the items is not found
+        assert client.delete(url_for("filesApi.all"), json=[{"hash_id": hash_ids[0]}, {"hash_id": "unknown"}]).status_code == 404
+        assert client.delete(url_for("piecesApi.all"), json=[{"id": 2}, {"id": 9}]).status_code == 404
+        assert client.delete(url_for("eventsApi.all"), json=[{"id": 1}, {"id": 9}]).status_code == 404
+        assert len(json.loads(client.get(url_for("filesApi.all")).data)) == 4
+        one = delete_statements(url_for("filesApi.all"), [{"hash_id": hash_ids[0]}])
+        two = delete_statements(url_for("filesApi.all"), [{"hash_id": hash_id} for hash_id in hash_ids[1:3]])
+        assert one == two
+        assert [file["hash_id"] for file in json.loads(client.get(url_for("filesApi.all")).data)] == hash_ids[3:]
+        assert len(os.listdir(os.path.join(app.config["FILES_DIR"], "test"))) == 1
+        assert Transpose.query.count() == 1
+        one = delete_statements(url_for("piecesApi.all"), [{"id": 3}])
+        two = delete_statements(url_for("piecesApi.all"), [{"id": 2}, {"id": 4}])
+        assert one == two
+        # A piece in an event is taken out of it, and put back in when it is restored
+        assert client.delete(url_for("piecesApi.byid", id=1)).status_code == 204
+        assert json.loads(client.get(url_for("eventsApi.byid", id=1)).data)["pieces"] == []
+        assert Transpose.query.count() == 0 and File.query.count() == 0
+        trash = json.loads(client.get(url_for("trashApi.all"), query_string={"kind": "piece"}).data)
+        assert client.post(url_for("trashApi.restore", id=trash[-1]["id"])).status_code == 204
+        assert [entry["piece_id"] for entry in json.loads(client.get(url_for("eventsApi.byid", id=1)).data)["pieces"]] == [1]
+        assert Transpose.query.count() == 1
+        response = client.get(url_for("filesApi.byid", hash_id=hash_ids[3]))
+        assert response.data == b"test3"
+        response = None
+        # Restorable files keep their blobs
+        assert sorted(blob.ref_count for blob in Blob.query) == [1, 1, 1, 1]
+        assert client.delete(url_for("eventsApi.all"), json=[{"id": 1}]).status_code == 204
+        assert json.loads(client.get(url_for("eventsApi.all")).data) == []
+
+    def test_compression(self, client:FlaskClient, app:Flask, db:SQLAlchemy):
+        """Text formats are stored compressed and sent compressed to clients accepting it"""
+        content = b"<measure><note><pitch>C</pitch></note></measure>" * 1000
+        data = {
+            "data": json.dumps([{"instrumentation_ids": [1], "name": name, "type": 0} for name in ("score", "noise")]),
+            "files[]": [(BytesIO(content), 'temp.xml'), (BytesIO(os.urandom(1000)), 'temp.txt')]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_ids = {file["name"]: file["hash_id"] for file in json.loads(response.data)}
+        score = File.query.filter_by(name="score").one()
+        sha256 = hashlib.sha256(content).hexdigest()
+        assert (score.blob.sha256, score.blob.size, score.blob.encoding) == (sha256, len(content), "gzip")
+        assert os.path.getsize(get_blobpath(sha256)) < len(content) / 10
+        # Not worth compressing
+        assert File.query.filter_by(name="noise").one().blob.encoding == None
+
+        response = client.get(url_for("filesApi.byid", hash_id=hash_ids["score"]), headers={"Accept-Encoding": "gzip, deflate"})
+        assert response.status_code == 200
+        assert response.content_encoding == "gzip"
+        assert "Accept-Encoding" in response.vary
+        assert response.get_etag() == (f"{sha256}-gzip", False)
+        assert gzip.decompress(response.data) == content
+        response = client.get(url_for("filesApi.byid", hash_id=hash_ids["score"]), headers={"Accept-Encoding": "gzip", "If-None-Match": f'"{sha256}-gzip"'})
+        assert response.status_code == 304
+        response = client.get(url_for("filesApi.byid", hash_id=hash_ids["score"]))
+        assert response.status_code == 200
+        assert response.content_encoding == None
+        assert response.get_etag() == (sha256, False)
+        assert response.content_length == len(content)
+        assert response.data == content
+        response = client.get(url_for("filesApi.byid", hash_id=hash_ids["score"]), headers={"Range": "bytes=100-199"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 100-199/{len(content)}"
+        assert response.data == content[100:200]
+        response = client.get(url_for("piecesApi.archive", id=1))
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            assert archive.read(f"test/score_0_{hash_ids['score']}.xml") == content
+        response = None
+
+        for hash_id in hash_ids.values():
+            response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 204
+
+    def test_resumable_upload(self, client:FlaskClient, app:Flask, db:SQLAlchemy):
+        """Large files are uploaded chunk by chunk, and resumed after a failure"""
+        content = os.urandom(2 * CHUNK_SIZE + 100)
+        chunk_size = app.config["UPLOAD_CHUNK_SIZE"]
+        app.config["UPLOAD_CHUNK_SIZE"] = CHUNK_SIZE
+        try:
+            response = client.post(url_for("uploadsApi.all"), json={"instrumentation_ids": [1], "name": "test", "type": 0, "filename": "temp.pdf", "size": len(content)})
+        finally:
+            app.config["UPLOAD_CHUNK_SIZE"] = chunk_size
+        assert response.status_code == 201
+        session = json.loads(response.data)
+        token = session["token"]
+        assert (session["received"], session["chunk_size"], session["status"], session["hash_id"]) == (0, CHUNK_SIZE, "open", None)
+        assert os.path.getsize(get_stagingpath(token)) == 0
+        chunk_url = lambda number: url_for("uploadsApi.chunk", token=token, number=number)
+        chunk = lambda number: content[number * CHUNK_SIZE:(number + 1) * CHUNK_SIZE]
+
+        response = client.put(chunk_url(0), data=chunk(0))
+        assert json.loads(response.data)["received"] == CHUNK_SIZE
+        # Earlier chunks missing, or chunks of the wrong size
+        response = client.put(chunk_url(2), data=chunk(2))
+        assert response.status_code == 409
+        response = client.put(chunk_url(1), data=chunk(1)[:-1])
+        assert response.status_code == 400
+        response = client.put(chunk_url(3), data=b"")
+        assert response.status_code == 400
+        # Resumed from the progress, a chunk put again does no harm
+        response = client.get(url_for("uploadsApi.bytoken", token=token))
+        assert json.loads(response.data)["received"] == CHUNK_SIZE
+        response = client.put(chunk_url(0), data=chunk(0))
+        assert json.loads(response.data)["received"] == CHUNK_SIZE
+        response = client.put(chunk_url(1), data=chunk(1))
+        assert json.loads(response.data)["received"] == 2 * CHUNK_SIZE
+        response = client.post(url_for("uploadsApi.finalize", token=token))
+        assert response.status_code == 409
+        response = client.put(chunk_url(2), data=chunk(2))
+        assert json.loads(response.data)["received"] == len(content)
+
+        response = client.post(url_for("uploadsApi.finalize", token=token))
+        assert response.status_code == 201
+        file = json.loads(response.data)
+        assert (file["name"], file["format"]) == ("test", "pdf")
+        assert not os.path.exists(get_stagingpath(token))
+        response = client.get(url_for("filesApi.byid", hash_id=file["hash_id"]))
+        assert response.data == content
+        response = None
+        # The response of a finalize can be lost
+        response = client.post(url_for("uploadsApi.finalize", token=token))
+        assert json.loads(response.data)["hash_id"] == file["hash_id"]
+        response = client.get(url_for("uploadsApi.bytoken", token=token))
+        assert json.loads(response.data)["status"] == "done"
+        assert json.loads(response.data)["hash_id"] == file["hash_id"]
+        response = client.put(chunk_url(0), data=chunk(0))
+        assert response.status_code == 409
+
+        # Duplicates are refused on finalize, the staged content is kept
+        response = client.post(url_for("uploadsApi.all"), json={"instrumentation_ids": [1], "name": "test", "type": 0, "filename": "temp.pdf", "size": 4})
+        duplicate = json.loads(response.data)["token"]
+        client.put(url_for("uploadsApi.chunk", token=duplicate, number=0), data=b"test")
+        response = client.post(url_for("uploadsApi.finalize", token=duplicate))
+        assert response.status_code == 409
+        assert os.path.exists(get_stagingpath(duplicate))
+        assert UploadSession.query.filter_by(token=duplicate).one().status == "open"
+        response = client.delete(url_for("uploadsApi.bytoken", token=duplicate))
+        assert response.status_code == 204
+        assert not os.path.exists(get_stagingpath(duplicate))
+        response = client.get(url_for("uploadsApi.bytoken", token=duplicate))
+        assert response.status_code == 404
+        response = client.post(url_for("uploadsApi.all"), json={"instrumentation_ids": [3], "name": "test", "type": 0, "filename": "temp.pdf", "size": 4})
+        assert response.status_code == 404
+
+        # Idle sessions expire
+        response = client.post(url_for("uploadsApi.all"), json={"instrumentation_ids": [1], "name": "idle", "type": 0, "filename": "temp.pdf", "size": 4})
+        idle = json.loads(response.data)["token"]
+        UploadSession.query.filter_by(token=idle).update({"updated_time": datetime.now() - timedelta(days=2)})
+        Job.query.filter_by(name="expire_upload").update({"run_after": datetime.now()})
+        db.session.commit()
+        run_jobs()
+        assert UploadSession.query.filter_by(token=idle).first() == None
+        assert not os.path.exists(get_stagingpath(idle))
+        # The finalized one is kept until it expires too
+        assert UploadSession.query.filter_by(token=token).one().status == "done"
+
+        response = client.delete(url_for("filesApi.byid", hash_id=file["hash_id"]))
+        assert response.status_code == 204
+
+    def test_scrub(self, client:FlaskClient, app:Flask, db:SQLAlchemy):
+        """The scrubber reports missing, corrupt and orphaned contents and files"""
+        contents = {"good": (b"<score/>" * 1000, "xml"), "corrupt": (b"corrupt", "test"), "missing": (b"missing", "test"), "moved": (b"moved", "test")}
+        data = {
+            "data": json.dumps([{"instrumentation_ids": [1], "name": name, "type": 0} for name in contents]),
+            "files[]": [(BytesIO(content), f"temp.{format}") for content, format in contents.values()]
+        }
+        response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+        assert response.status_code == 201
+        hash_ids = {file["name"]: file["hash_id"] for file in json.loads(response.data)}
+        sha256s = {name: hashlib.sha256(content).hexdigest() for name, (content, _) in contents.items()}
+        report = scrub_storage(rate=0)
+        assert report.ok
+        assert report.checked_blobs == 4
+        assert report.checked_bytes == sum(len(content) for content, _ in contents.values())
+
+        with open(get_blobpath(sha256s["corrupt"]), "r+b") as f:
+            f.write(b"C")
+        os.remove(get_blobpath(sha256s["missing"]))
+        orphan = hashlib.sha256(b"orphan").hexdigest()
+        os.makedirs(os.path.dirname(get_blobpath(orphan)), exist_ok=True)
+        with open(get_blobpath(orphan), "wb") as f:
+            f.write(b"orphan")
+        os.utime(get_blobpath(orphan), (0, 0))
+        # Left behind by failed renames and deletes
+        piece = os.path.join(app.config["FILES_DIR"], "test")
+        os.rename(os.path.join(piece, f"moved_0_{hash_ids['moved']}.test"), os.path.join(piece, "stray_0_abc.pdf"))
+        os.mkdir(os.path.join(app.config["FILES_DIR"], "old"))
+
+        report = scrub_storage(workers=2, rate=0)
+        assert report.to_dict() == {
+            "missing_blobs": [sha256s["missing"]],
+            "corrupt_blobs": [sha256s["corrupt"]],
+            "orphaned_blobs": [orphan],
+            "missing_files": [hash_ids["moved"]],
+            "orphaned_files": [os.path.join("test", "stray_0_abc.pdf")],
+            "orphaned_pieces": ["old"],
+            "checked_blobs": 4,
+            "checked_bytes": len(contents["good"][0]) + len(contents["moved"][0])
+        }
+
+        result = app.test_cli_runner().invoke(args=["files", "scrub", "--rate", "0"])
+        assert result.exit_code == 1
+        assert "orphaned piece: old" in result.output
+        assert f"corrupt blob: {sha256s['corrupt']}" in result.output
+
+        # Scheduled again after each run
+        enqueue_job("scrub_storage")
+        db.session.commit()
+        run_jobs()
+        scrub = Job.query.filter_by(name="scrub_storage", status="done").one()
+        assert json.loads(scrub.result)["orphaned_blobs"] == [orphan]
+        assert Job.query.filter_by(name="scrub_storage", status="pending").one().run_after > datetime.now() + timedelta(days=6)
+        response = client.get(url_for("jobsApi.byid", id=scrub.id))
+        assert json.loads(response.data)["result"]["missing_files"] == [hash_ids["moved"]]
+
+        os.remove(get_blobpath(orphan))
+        os.rename(os.path.join(piece, "stray_0_abc.pdf"), os.path.join(piece, f"moved_0_{hash_ids['moved']}.test"))
+        for hash_id in hash_ids.values():
+            response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+            assert response.status_code == 204
+
+    def test_s3_storage(self, client:FlaskClient, app:Flask):
+        """Files are stored in and streamed from an S3 backend, without FILES_DIR"""
+        boto3 = pytest.importorskip("boto3")
+        moto = pytest.importorskip("moto")
+        content = os.urandom(3 * CHUNK_SIZE)
+        data = {
+            "data": json.dumps([{"instrumentation_ids": [1], "name": name, "type": 0} for name in ("first", "second")]),
+            "files[]": [(BytesIO(content), 'temp.pdf'), (BytesIO(content), 'temp.pdf')]
+        }
+        local = app.extensions["storage"]
+        with moto.mock_aws():
+            s3 = boto3.client("s3", region_name="us-east-1",
+                aws_access_key_id="test", aws_secret_access_key="test")
+            s3.create_bucket(Bucket="sms")
+            app.extensions["storage"] = S3Backend(s3, "sms")
+            try:
+                response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+                assert response.status_code == 201
+                hash_ids = [file["hash_id"] for file in json.loads(response.data)]
+                sha256 = hashlib.sha256(content).hexdigest()
+                # One object for both files, nothing on the local disk
+                assert [item["Key"] for item in s3.list_objects_v2(Bucket="sms")["Contents"]] == [f"{sha256[:2]}/{sha256[2:4]}/{sha256}"]
+                assert not os.path.exists(get_blobpath(sha256))
+                assert not os.path.exists(os.path.join(app.config["FILES_DIR"], get_shard("test")))
+
+                # Duplicates are found in the database
+                data["data"] = json.dumps([{"instrumentation_ids": [1], "name": "first", "type": 0}])
+                data["files[]"] = [(BytesIO(b"test"), 'temp.pdf')]
+                response = client.post(url_for("filesApi.all"), content_type="multipart/form-data", data=data)
+                assert response.status_code == 409
+
+                response = client.get(url_for("filesApi.byid", hash_id=hash_ids[0]))
+                assert response.status_code == 200
+                assert response.data == content
+                assert response.get_etag() == (sha256, False)
+                response = client.get(url_for("filesApi.byid", hash_id=hash_ids[0]), headers={"Range": f"bytes={CHUNK_SIZE}-{CHUNK_SIZE + 9}"})
+                assert response.status_code == 206
+                assert response.data == content[CHUNK_SIZE:CHUNK_SIZE + 10]
+                response = client.get(url_for("filesApi.byid", hash_id=hash_ids[0]), headers={"If-None-Match": f'"{sha256}"'})
+                assert response.status_code == 304
+                response = client.get(url_for("piecesApi.archive", id=1))
+                with zipfile.ZipFile(BytesIO(response.data)) as archive:
+                    assert [archive.read(name) for name in archive.namelist()] == [content, content]
+                response = None
+
+                for hash_id in hash_ids:
+                    response = client.delete(url_for("filesApi.byid", hash_id=hash_id))
+                    assert response.status_code == 204
+                for trash in Trash.query.all():
+                    client.delete(url_for("trashApi.byid", id=trash.id))
+                assert s3.list_objects_v2(Bucket="sms")["KeyCount"] == 0
+            finally:
+                app.extensions["storage"] = local
+
+class TestJob:
+    @pytest.fixture(scope="function", autouse=True)
+    def prepare_db(self, db:SQLAlchemy, app:Flask, request:SubRequest):
+        Job.query.delete()
+        db.session.commit()
+        retry_delay = app.config["JOB_RETRY_DELAY"]
+        app.config["JOB_RETRY_DELAY"] = 0
+        def fin():
+            app.config["JOB_RETRY_DELAY"] = retry_delay
+            JOB_HANDLERS.pop("test", None)
+            Job.query.delete()
+            db.session.commit()
+        request.addfinalizer(fin)
+
+    def test_retry(self, client:FlaskClient, db:SQLAlchemy):
+        calls = []
+        @job("test")
+        def handler(fail):
+            calls.append(fail)
+            if len(calls) <= fail:
+                raise RuntimeError("test failure")
+
+        enqueue_job("test", fail=1)
+        enqueue_job("test", max_attempts=2, fail=5)
+        # Pending unique jobs are not enqueued twice
+        assert enqueue_job("purge_blobs", unique=True) is enqueue_job("purge_blobs", unique=True)
+        with pytest.raises(KeyError):
+            enqueue_job("unknown")
+        db.session.commit()
+
+        assert run_jobs() == 5
+        assert calls == [1, 5, 1, 5]
+        response = client.get(url_for("jobsApi.all"), query_string={"name": "test"})
+        assert response.status_code == 200
+        jobs = json.loads(response.data)
+        assert [(job["payload"], job["status"], job["attempts"]) for job in jobs] == [({"fail": 1}, "done", 2), ({"fail": 5}, "failed", 2)]
+        assert jobs[0]["error"] == None
+        assert "test failure" in jobs[1]["error"]
+        response = client.get(url_for("jobsApi.all"), query_string={"name": "test", "limit": 1})
+        assert [job["id"] for job in json.loads(response.data)] == [jobs[0]["id"]]
+        response = client.get(url_for("jobsApi.all"), query_string={"name": "test", "cursor": response.headers["X-Next-Cursor"]})
+        assert [job["id"] for job in json.loads(response.data)] == [jobs[1]["id"]]
+        response = client.get(url_for("jobsApi.byid", id=jobs[1]["id"]))
+        assert response.status_code == 200
+        assert json.loads(response.data)["status"] == "failed"
+        response = client.get(url_for("jobsApi.all"), query_string={"status": "unknown"})
+        assert response.status_code == 422
+        response = client.get(url_for("jobsApi.byid", id=100))
+        assert response.status_code == 404
+
+    def test_expired_lease(self, db:SQLAlchemy):
+        calls = []
+        job("test")(lambda: calls.append(True))
+        # Left running by a worker which died
+        stale = enqueue_job("test")
+        stale.status = "running"
+        stale.attempts = 1
+        stale.locked_until = datetime.now() - timedelta(seconds=1)
+        running = enqueue_job("test")
+        running.status = "running"
+        running.attempts = 1
+        running.locked_until = datetime.now() + timedelta(seconds=60)
+        db.session.commit()
+        assert run_jobs() == 1
+        assert calls == [True]
+        assert (stale.status, stale.attempts) == ("done", 2)
+        assert running.status == "running"
+
+    def test_run_command(self, app:Flask, db:SQLAlchemy, monkeypatch:pytest.MonkeyPatch):
+        calls = []
+        job("test")(lambda: calls.append(True))
+        enqueue_job("test")
+        db.session.commit()
+        queue = app.extensions["job_queue"]
+        # Testing apps do not start workers
+        assert not queue._threads
+        def join():
+            deadline = time.monotonic() + 10
+            while not calls and time.monotonic() < deadline:
+                time.sleep(0.05)
+            raise KeyboardInterrupt
+        monkeypatch.setattr(queue, "join", join)
+        monkeypatch.setattr(queue, "workers", 0)
+        result = app.test_cli_runner().invoke(args=["jobs", "run", "--workers", "1"])
+        assert result.exit_code == 0
+        assert calls == [True]
+        assert not queue._threads
+
 if __name__ == "__main__":
     pytest.main()
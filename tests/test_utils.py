@@ -3,15 +3,21 @@
     Utils test suite
 """
 
-import pytest, os
-from flask import current_app
+import pytest, os, time, hashlib, zipfile, threading, sqlalchemy
+from io import BytesIO
+from flask import Flask, current_app
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 
 from sms.utils import check_piece, check_file, get_filename, create_piece, save_file, delete_piece, delete_file
-from sms.database import Piece, File, Instrumentation
+from sms.utils import HashingFile, spool, get_piecepath, get_filepath, get_blobpath, store_blob, release_blob_refs, purge_blobs, stream_archive
+from sms.utils import DirectoryIndex, ThumbnailCache, get_shard, scan_pieces, shard_files
+from sms.utils import Throttle, FileSystemBackend, S3Backend, StorageReader, compress_file, decode_file, decode_chunks
+from sms.utils import blob_store
+from sms.utils.upload import CHUNK_SIZE
+from sms.database import get_hashid_codec, Piece, File, Instrumentation, Blob
 
 class TestFileHandler:
 
@@ -27,7 +33,7 @@ class TestFileHandler:
         file = File(**file_args)
         db.session.add(file)
         db.session.flush()
-        assert get_filename(file) == f"test_0_{file.hash_id}.test_format"
+        assert get_filename(file) == f"test_0_{get_hashid_codec().encode(file.id)}.test_format"
         db.session.rollback()
 
     def test_fs_manipulate_functions(self, db:SQLAlchemy):
@@ -70,7 +76,7 @@ class TestFileHandler:
 
         assert delete_file(file)
         assert check_file(file)
-        assert not os.listdir(os.path.join(current_app.config["FILES_DIR"], secure_filename(piece.name)))
+        assert not os.listdir(get_piecepath(piece.name))
 
         assert delete_piece(piece)
         assert check_piece(piece)
@@ -78,3 +84,335 @@ class TestFileHandler:
 
         temp_file.close()
         os.remove("temp.temp_test")
+
+    def test_blob_dedup(self, db:SQLAlchemy):
+        """Test that identical contents are stored once and released with the last file"""
+        piece = Piece(name="test_blob")
+        instrumentation = Instrumentation(instrument_id=1)
+        instrumentation.piece = piece
+        files = [File(format="test_format", name=f"test{i}", type=0) for i in range(2)]
+        instrumentation.files.extend(files)
+        db.session.add(instrumentation)
+        db.session.commit()
+        assert create_piece(piece)
+        for file in files:
+            assert save_file(file, FileStorage(BytesIO(b"test_blob")))
+        db.session.commit()
+
+        sha256 = hashlib.sha256(b"test_blob").hexdigest()
+        blob = Blob.query.filter_by(sha256=sha256).one()
+        assert blob.ref_count == 2
+        assert blob.size == len(b"test_blob")
+        assert files[0].blob == files[1].blob == blob
+        assert os.path.samefile(get_filepath(files[0]), get_blobpath(sha256))
+        assert os.path.samefile(get_filepath(files[1]), get_blobpath(sha256))
+
+        assert delete_file(files[0])
+        db.session.delete(files[0])
+        db.session.commit()
+        assert purge_blobs() == 0
+        assert os.path.exists(get_blobpath(sha256))
+
+        assert delete_file(files[1])
+        db.session.delete(files[1])
+        db.session.commit()
+        assert purge_blobs() == 1
+        assert not os.path.exists(get_blobpath(sha256))
+        assert Blob.query.filter_by(sha256=sha256).first() == None
+
+        assert delete_piece(piece)
+        db.session.delete(instrumentation)
+        db.session.delete(piece)
+        db.session.commit()
+
+    def test_blob_reference(self, db:SQLAlchemy, app:Flask, monkeypatch:pytest.MonkeyPatch):
+        """Test that store_blob takes the reference with a short write and handles a concurrent insert of the content"""
+        sha256 = hashlib.sha256(b"test_reference").hexdigest()
+        # The content is written without holding the writer
+        put_content = blob_store._put_content
+        def put_unlocked(*args):
+            assert db.engine.pool.checkedout() == 0
+            return put_content(*args)
+        monkeypatch.setattr(blob_store, "_put_content", put_unlocked)
+        with spool(BytesIO(b"test_reference"), app.config["BLOBS_DIR"]) as spooled:
+            blob = store_blob(spooled)
+        db.session.commit()
+        Blob.query.filter_by(id=blob.id).update({"ref_count": 0})
+        db.session.commit()
+
+        # Committed right away, purge_blobs can not match it anymore
+        with spool(BytesIO(b"test_reference"), app.config["BLOBS_DIR"]) as spooled:
+            assert store_blob(spooled).ref_count == 1
+        assert not db.session.info.get("writing")
+        with db.engine.connect() as connection:
+            assert connection.execute(sqlalchemy.select(Blob.ref_count).where(Blob.id == blob.id)).scalar() == 1
+        # Until the upload fails
+        release_blob_refs()
+        assert Blob.query.filter_by(id=blob.id).populate_existing().one().ref_count == 0
+
+        # Inserted by another upload between the lookups and the insert
+        take_blob = blob_store._take_blob
+        calls = []
+        def concurrent_take(sha256):
+            calls.append(sha256)
+            return take_blob(sha256) if len(calls) > 2 else None
+        monkeypatch.setattr(blob_store, "_take_blob", concurrent_take)
+        with spool(BytesIO(b"test_reference"), app.config["BLOBS_DIR"]) as spooled:
+            assert store_blob(spooled).id == blob.id
+        assert len(calls) == 3
+        db.session.commit()
+        assert Blob.query.filter_by(sha256=sha256).populate_existing().one().ref_count == 1
+
+        Blob.query.filter_by(id=blob.id).update({"ref_count": 0})
+        db.session.commit()
+        assert purge_blobs() == 1
+        assert not os.path.exists(get_blobpath(sha256))
+
+class TestUpload:
+
+    def test_spool(self, app:Flask):
+        """Test HashingFile and spool"""
+        content = b"test" * 1024
+        spooled = spool(BytesIO(content), app.config["FILES_DIR"])
+        assert spooled.size == len(content)
+        assert spooled.hexdigest() == hashlib.sha256(content).hexdigest()
+        assert spool(spooled, app.config["FILES_DIR"]) is spooled
+
+        path = os.path.join(app.config["FILES_DIR"], "spooled.temp_test")
+        spooled.commit(path)
+        spooled.close()
+        assert not os.path.exists(spooled.name)
+        with open(path, "rb") as f:
+            assert f.read() == content
+        os.remove(path)
+
+        spooled = spool(BytesIO(content), app.config["FILES_DIR"])
+        spooled.close()
+        assert not os.path.exists(spooled.name)
+
+    def test_upload_request(self, app:Flask):
+        """Test that uploaded parts are spooled straight into BLOBS_DIR"""
+        content = b"test" * 1024
+        with app.test_request_context(method="POST", content_type="multipart/form-data",
+                data={"files[]": (BytesIO(content), "temp.test")}) as ctx:
+            stream = ctx.request.files["files[]"].stream
+            assert isinstance(stream, HashingFile)
+            assert os.path.dirname(stream.name) == os.path.abspath(app.config["BLOBS_DIR"])
+            assert stream.hexdigest() == hashlib.sha256(content).hexdigest()
+            assert stream.read() == content
+        assert not os.path.exists(stream.name)
+
+class TestArchive:
+
+    def test_stream_archive(self, app:Flask):
+        """Test that stream_archive streams a valid zip archive"""
+        contents = {"test.pdf": os.urandom(3 * CHUNK_SIZE), "test.xml": b"<test/>" * CHUNK_SIZE}
+        entries = []
+        for name, content in contents.items():
+            path = os.path.join(app.config["FILES_DIR"], name)
+            with open(path, "wb") as f:
+                f.write(content)
+            entries.append((f"test/{name}", name, len(content), None))
+        compressed = compress_file(os.path.join(app.config["FILES_DIR"], "test.xml"), "gzip", 6)
+        os.replace(compressed, os.path.join(app.config["FILES_DIR"], "test.xml.gz"))
+        entries.append(("test/decoded.xml", "test.xml.gz", len(contents["test.xml"]), "gzip"))
+        entries.append(("test/missing.pdf", "missing.pdf", 0, None))
+
+        chunks = list(stream_archive(entries, FileSystemBackend(app.config["FILES_DIR"])))
+        assert len(chunks) > len(contents)
+        assert max(len(chunk) for chunk in chunks) < 2 * CHUNK_SIZE
+        with zipfile.ZipFile(BytesIO(b"".join(chunks))) as archive:
+            assert archive.testzip() == None
+            assert archive.namelist() == ["test/test.pdf", "test/test.xml", "test/decoded.xml"]
+            assert archive.read("test/decoded.xml") == contents["test.xml"]
+            assert archive.getinfo("test/test.pdf").compress_type == zipfile.ZIP_STORED
+            assert archive.getinfo("test/test.xml").compress_type == zipfile.ZIP_DEFLATED
+            for name, content in contents.items():
+                assert archive.read(f"test/{name}") == content
+
+        for name in [*contents, "test.xml.gz"]:
+            os.remove(os.path.join(app.config["FILES_DIR"], name))
+
+class TestCompression:
+
+    def test_round_trip(self, tmp_path):
+        """Test that compressed files are decoded by both readers, and are reproducible"""
+        content = b"<note><pitch>C</pitch></note>" * CHUNK_SIZE
+        path = str(tmp_path / "score.xml")
+        with open(path, "wb") as f:
+            f.write(content)
+        compressed = compress_file(path, "gzip", 6)
+        again = compress_file(path, "gzip", 6)
+        with open(compressed, "rb") as f, open(again, "rb") as g:
+            encoded = f.read()
+            assert encoded == g.read()
+        assert len(encoded) < len(content) / 10
+        chunks = list(decode_chunks((encoded[i:i + 1000] for i in range(0, len(encoded), 1000)), "gzip"))
+        assert b"".join(chunks) == content
+        assert max(len(chunk) for chunk in chunks) <= CHUNK_SIZE
+        with pytest.raises(EOFError):
+            list(decode_chunks([encoded[:-100]], "gzip"))
+        with decode_file(open(compressed, "rb"), "gzip") as f:
+            f.seek(len(content) - 10)
+            assert f.read() == content[-10:]
+        with pytest.raises(ValueError):
+            compress_file(path, "br", 6)
+
+class TestStorage:
+
+    def check_backend(self, storage):
+        content = os.urandom(3 * CHUNK_SIZE)
+        storage.put_stream("aa/bb/blob", BytesIO(content))
+        assert storage.stat("aa/bb/blob").size == len(content)
+        assert storage.stat("aa/bb/missing") == None
+        assert b"".join(storage.get_stream("aa/bb/blob")) == content
+        assert b"".join(storage.get_stream("aa/bb/blob", 10, CHUNK_SIZE + 10)) == content[10:CHUNK_SIZE + 10]
+        with pytest.raises(FileNotFoundError):
+            b"".join(storage.get_stream("aa/bb/missing"))
+        reader = StorageReader(storage, "aa/bb/blob", len(content))
+        reader.seek(CHUNK_SIZE)
+        assert reader.read(5) == content[CHUNK_SIZE:CHUNK_SIZE + 5]
+        assert reader.read() == content[CHUNK_SIZE + 5:]
+        reader.close()
+
+        storage.put_stream("aa/cc/blob", BytesIO(b"other"))
+        assert storage.rename_prefix("aa", "moved/aa") == 2
+        assert storage.stat("aa/bb/blob") == None
+        assert b"".join(storage.get_stream("moved/aa/cc/blob")) == b"other"
+        storage.delete("moved/aa/bb/blob")
+        storage.delete("moved/aa/cc/blob")
+        storage.delete("moved/aa/cc/blob")
+        assert storage.stat("moved/aa/bb/blob") == None
+
+    def test_file_system_backend(self, tmp_path):
+        """Test that the file system backend stores, ranges, renames and deletes objects"""
+        storage = FileSystemBackend(str(tmp_path))
+        self.check_backend(storage)
+        # Fan out folders go with their last object
+        assert os.listdir(tmp_path) == []
+
+    def test_s3_backend(self):
+        """Test the S3 backend against a local stand-in of S3, with multipart uploads"""
+        boto3 = pytest.importorskip("boto3")
+        moto = pytest.importorskip("moto")
+        with moto.mock_aws():
+            client = boto3.client("s3", region_name="us-east-1",
+                aws_access_key_id="test", aws_secret_access_key="test")
+            client.create_bucket(Bucket="sms")
+            storage = S3Backend(client, "sms", prefix="blobs/", part_size=5 * 1024 * 1024)
+            self.check_backend(storage)
+
+            content = os.urandom(11 * 1024 * 1024)
+            storage.put_stream("large", BytesIO(content))
+            head = client.head_object(Bucket="sms", Key="blobs/large")
+            # Uploaded in 3 parts
+            assert head["ETag"].endswith('-3"')
+            assert b"".join(storage.get_stream("large", len(content) - 10)) == content[-10:]
+            with storage.open_local("large", os.getcwd()) as path:
+                with open(path, "rb") as f:
+                    assert f.read() == content
+            assert not os.path.exists(path)
+            storage.delete("large")
+            assert client.list_objects_v2(Bucket="sms").get("KeyCount") == 0
+
+class TestThrottle:
+
+    def test_rate(self):
+        """Test that the throttle holds the rate over several threads"""
+        throttle = Throttle(1000000)
+        start = time.monotonic()
+        threads = [threading.Thread(target=throttle.consume, args=(100000,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.monotonic() - start >= 0.3
+        start = time.monotonic()
+        Throttle(0).consume(100000)
+        assert time.monotonic() - start < 0.1
+
+class TestThumbnailCache:
+
+    def test_lru_eviction(self, tmp_path):
+        """Test that the least recently used renderings are removed beyond the size"""
+        paths = [str(tmp_path / f"{i}.thumbnail.png") for i in range(4)]
+        cache = ThumbnailCache(str(tmp_path), 300)
+        for i, path in enumerate(paths[:2]):
+            with open(path, "wb") as f:
+                f.write(b"0" * 100)
+            os.utime(path, (i, i))
+        # Renderings added before the ones on disk are listed stay the most recent
+        with open(paths[2], "wb") as f:
+            f.write(b"0" * 100)
+        cache.add(paths[2])
+        assert cache.size == 100
+        cache.load()
+        assert cache.size == 300
+        # The oldest one is used again, so the other one goes first
+        cache.touch(paths[0])
+        with open(paths[3], "wb") as f:
+            f.write(b"0" * 100)
+        cache.add(paths[3])
+        assert cache.size == 300
+        assert [os.path.exists(path) for path in paths] == [True, False, True, True]
+
+class TestFileIndex:
+
+    def test_directory_index(self, tmp_path):
+        """Test lookups, updates and re-checks of DirectoryIndex"""
+        (tmp_path / "piece").mkdir()
+        (tmp_path / "piece" / "test_0_abc.pdf").write_bytes(b"")
+        index = DirectoryIndex(str(tmp_path))
+        index.refresh()
+        assert index.has_piece("piece")
+        assert not index.has_piece("other")
+        assert index.find_file("piece", "test_0.pdf") == "test_0_abc.pdf"
+        assert index.find_file("piece", "test_1.pdf") == None
+
+        # Updates
+        (tmp_path / "other").mkdir()
+        index.add_piece("other")
+        (tmp_path / "other" / "test_1_def.pdf").write_bytes(b"")
+        index.add_file("other", "test_1_def.pdf")
+        assert index.find_file("other", "test_1.pdf") == "test_1_def.pdf"
+        (tmp_path / "other" / "test_1_def.pdf").unlink()
+        index.remove_file("other", "test_1_def.pdf")
+        assert index.find_file("other", "test_1.pdf") == None
+        (tmp_path / "other").rename(tmp_path / "renamed")
+        index.rename_piece("other", "renamed")
+        assert not index.has_piece("other")
+        assert index.has_piece("renamed")
+
+        # Stale entries are dropped, unknown folders are loaded from disk
+        (tmp_path / "piece" / "test_0_abc.pdf").unlink()
+        assert index.find_file("piece", "test_0.pdf") == None
+        (tmp_path / "renamed").rmdir()
+        assert not index.has_piece("renamed")
+        (tmp_path / "new").mkdir()
+        (tmp_path / "new" / "test_0_ghi.pdf").write_bytes(b"")
+        assert index.has_piece("new")
+        assert index.find_file("new", "test_0.pdf") == "test_0_ghi.pdf"
+        index.refresh()
+        assert index.has_piece("new")
+
+    def test_shard_files(self, tmp_path):
+        """Test the migration of the flat layout, while an index looks pieces up"""
+        for piece in ("piece", "ab", "other"):
+            (tmp_path / piece).mkdir()
+            (tmp_path / piece / "test_0_abc.pdf").write_bytes(piece.encode())
+        # Interrupted migration
+        (tmp_path / get_shard("other")).mkdir(parents=True)
+        (tmp_path / get_shard("other") / "test_1_def.pdf").write_bytes(b"")
+        index = DirectoryIndex(str(tmp_path))
+        index.refresh()
+        assert sorted(scan_pieces(str(tmp_path))) == sorted(["piece", "ab", "other", get_shard("other")])
+        assert index.locate("piece") == "piece"
+
+        assert shard_files(str(tmp_path), workers=2) == 3
+        assert sorted(scan_pieces(str(tmp_path))) == sorted(get_shard(piece) for piece in ("piece", "ab", "other"))
+        for piece in ("piece", "ab"):
+            assert (tmp_path / get_shard(piece) / "test_0_abc.pdf").read_bytes() == piece.encode()
+        assert sorted(os.listdir(tmp_path / get_shard("other"))) == ["test_0_abc.pdf", "test_1_def.pdf"]
+        assert index.locate("piece") == get_shard("piece")
+        assert index.find_file("piece", "test_0.pdf") == "test_0_abc.pdf"
+        assert shard_files(str(tmp_path)) == 0